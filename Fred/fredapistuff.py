@@ -1,6 +1,11 @@
+import os
+import sys
 import requests
 import pandas as pd
-import time
+
+# The shared rate limiter lives at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rate_limiter import get_limiter
 
 # Your FRED API key
 API_KEY = '...'
@@ -111,10 +116,21 @@ params = {
     'limit': '1'           # Limit to the most recent observation
 }
 
+# Requests are paced by the shared FRED limiter (120 requests per minute)
+limiter = get_limiter('fred')
+
 # Loop over each series and retrieve data
 for series_id, series_description in fred_series.items():
     params['series_id'] = series_id
+    limiter.acquire()
     response = requests.get(base_url, params=params)
+    if response.status_code == 429:
+        limiter.observe_error(requests.exceptions.HTTPError(response=response))
+        # One retry once the limiter allows it
+        limiter.acquire()
+        response = requests.get(base_url, params=params)
+    else:
+        limiter.success(response.headers)
     if response.status_code == 200:
         data_json = response.json()
         observations = data_json.get('observations', [])
@@ -128,7 +144,5 @@ for series_id, series_description in fred_series.items():
             print(f"No data available for series {series_id}\n")
     else:
         print(f"Error fetching data for series {series_id}: {response.status_code}\n")
-    # Optional: Pause to respect API rate limits
-    time.sleep(0.2)
 
 print("Data retrieval complete.")
\ No newline at end of file
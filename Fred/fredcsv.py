@@ -1,11 +1,19 @@
 import os
+import sys
 import json
 from openai import OpenAI
 from google.cloud import bigquery
 from google.cloud import aiplatform
 import time
+import logging
 from typing import List
 
+# The embedding cache lives at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from embedding_cache import get_embedding_cache
+from backfill_runner import BackfillProvider, BackfillRunner
+from rate_limiter import get_limiter
+
 # Set your Google Cloud credentials
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = '...'
 project_id = '...'
@@ -25,6 +33,9 @@ vertex_endpoint = aiplatform.Endpoint(endpoint_name=vertex_endpoint_name)
 openai_client = OpenAI(
     api_key="...")  # Replace with your actual API key
 
+# Embedding cache shared with the other pipelines on this host
+embedding_cache = get_embedding_cache()
+
 
 def generate_vertex_embeddings(text):
     text = str(text).strip()
@@ -36,8 +47,11 @@ def generate_vertex_embeddings(text):
     cleaned_text = ' '.join(text[:max_characters].split())
     instances = [{"inputs": cleaned_text}]
     try:
-        response = vertex_endpoint.predict(instances=instances)
-        return response.predictions[0]
+        prediction = embedding_cache.get_or_compute(
+            f"vertex:{vertex_endpoint_name}", cleaned_text,
+            lambda: get_limiter('vertex').call(vertex_endpoint.predict, instances=instances).predictions[0]
+        )
+        return prediction.tolist()
     except Exception as e:
         print(f"Error generating Vertex AI embeddings: {e}")
         return []
@@ -52,11 +66,15 @@ def generate_openai_embeddings(text):
     max_characters = 8000  # text-embedding-3-large can handle up to 8191 tokens
     cleaned_text = ' '.join(text[:max_characters].split())
     try:
-        response = openai_client.embeddings.create(
-            input=cleaned_text,
-            model="text-embedding-3-large"
+        embedding = embedding_cache.get_or_compute(
+            "openai:text-embedding-3-large", cleaned_text,
+            lambda: get_limiter('openai').call(
+                openai_client.embeddings.create,
+                input=cleaned_text,
+                model="text-embedding-3-large"
+            ).data[0].embedding
         )
-        return response.data[0].embedding
+        return embedding.tolist()
     except Exception as e:
         print(f"Error generating OpenAI embeddings: {e}")
         return []
@@ -94,10 +112,69 @@ def insert_indicator_with_embeddings(indicator: dict):
         print(f"Exception occurred while inserting Indicator: {ticker}: {e}")
 
 
-def insert_all_indicators(indicators: List[dict]):
-    for indicator in indicators:
-        insert_indicator_with_embeddings(indicator)
-        time.sleep(1)  # Optional: Pause to respect API rate limits
+def merge_indicators(batch):
+    """
+    Writes embedded indicators with one load job and one MERGE keyed on Indicator,
+    so committing the same batch twice leaves a single row per indicator.
+    """
+    rows = [
+        {
+            "Indicator": ticker,
+            "Name": sector_metrics_inv.get(ticker, "No Name Available"),
+            "Description": indicator_descriptions.get(ticker, "No description available."),
+            "Embedding_Model1": json.dumps(results['vertex']),
+            "Embedding_Model2": json.dumps(results['openai']),
+        }
+        for ticker, results in batch
+        if results['vertex'] is not None and results['openai'] is not None
+    ]
+    if not rows:
+        return
+    staging_table_id = f"{full_table_id}_staging"
+    load_config = bigquery.LoadJobConfig(
+        schema=client.get_table(full_table_id).schema,
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+    )
+    client.load_table_from_json(rows, staging_table_id, job_config=load_config).result()
+    try:
+        merge_query = f"""
+        MERGE `{full_table_id}` T
+        USING `{staging_table_id}` S
+        ON T.Indicator = S.Indicator
+        WHEN MATCHED THEN UPDATE SET
+            Name = S.Name, Description = S.Description,
+            Embedding_Model1 = S.Embedding_Model1, Embedding_Model2 = S.Embedding_Model2
+        WHEN NOT MATCHED THEN
+            INSERT (Indicator, Name, Description, Embedding_Model1, Embedding_Model2)
+            VALUES (S.Indicator, S.Name, S.Description, S.Embedding_Model1, S.Embedding_Model2)
+        """
+        client.query(merge_query).result()
+        print(f"Successfully merged {len(rows)} indicators")
+    finally:
+        client.delete_table(staging_table_id, not_found_ok=True)
+
+
+def insert_all_indicators(indicators: List[dict], workers: int = 4):
+    """
+    Embeds and writes every indicator as a resumable backfill: each provider
+    gets its own worker pool, and indicators committed by an interrupted run
+    are skipped on restart.
+    """
+    def embed_with(generate):
+        # The generators return [] on failure; the runner expects None
+        return lambda texts: [generate(text) or None for text in texts]
+
+    runner = BackfillRunner(
+        "fred_indicators",
+        [
+            BackfillProvider("vertex", embed_with(generate_vertex_embeddings), workers),
+            BackfillProvider("openai", embed_with(generate_openai_embeddings), workers),
+        ],
+        merge_indicators,
+        commit_batch_size=50,
+    )
+    runner.run([(indicator['ticker'], indicator['long_business_summary']) for indicator in indicators])
 
 
 # Updated sector_metrics with new indicators
@@ -422,6 +499,8 @@ for sector, indicators in sector_metrics.items():
         })
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
     # Check if the dataset exists; if not, create it
     try:
         client.get_dataset(dataset_id)
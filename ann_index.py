@@ -0,0 +1,335 @@
+import os
+import json
+import time
+import logging
+import argparse
+import numpy as np
+from similarity import SimilarityIndex, normalize_rows, normalize_queries, normalize_vector, select_top_k
+
+# -------------------- Configuration --------------------
+
+# Universes smaller than this are searched exactly; IVF only pays off above it
+MIN_ANN_UNIVERSE = 20000
+
+# Default number of inverted lists is roughly sqrt(N) * this factor
+NLIST_FACTOR = 1.0
+
+# Default number of lists probed per query (higher = better recall, slower)
+DEFAULT_NPROBE = 16
+
+# k-means settings used when building the coarse quantizer
+KMEANS_ITERATIONS = 20
+KMEANS_SAMPLE_SIZE = 50000
+KMEANS_ROWS_PER_LIST = 256
+
+# Rows assigned to lists per matrix product while building
+ASSIGN_CHUNK_ROWS = 8192
+
+ANN_METADATA_FILE = 'ann_metadata.json'
+
+# -------------------------------------------------------
+
+
+def _spherical_kmeans(matrix, nlist, iterations=KMEANS_ITERATIONS, sample_size=KMEANS_SAMPLE_SIZE, seed=0):
+    """
+    Clusters unit-length rows by cosine similarity.
+
+    Args:
+        matrix (numpy.ndarray): Unit-length float32 rows.
+        nlist (int): Number of centroids.
+        iterations (int): Lloyd iterations.
+        sample_size (int): Rows sampled for training.
+        seed (int): Seed for sampling and initialisation.
+
+    Returns:
+        numpy.ndarray: ``(nlist, dim)`` unit-length centroids.
+    """
+    rng = np.random.default_rng(seed)
+    n = matrix.shape[0]
+    # A few hundred training rows per centroid is plenty for a coarse quantizer
+    sample_size = min(sample_size, KMEANS_ROWS_PER_LIST * nlist)
+    sample = matrix if n <= sample_size else matrix[np.sort(rng.choice(n, sample_size, replace=False))]
+    sample = np.ascontiguousarray(sample, dtype=np.float32)
+    centroids = np.array(sample[rng.choice(sample.shape[0], nlist, replace=False)], dtype=np.float32)
+
+    for _ in range(iterations):
+        sums = np.zeros_like(centroids)
+        for start in range(0, sample.shape[0], ASSIGN_CHUNK_ROWS):
+            chunk = sample[start:start + ASSIGN_CHUNK_ROWS]
+            assignment = np.argmax(chunk @ centroids.T, axis=1)
+            # One-hot product keeps the centroid update inside BLAS
+            one_hot = np.zeros((nlist, chunk.shape[0]), dtype=np.float32)
+            one_hot[assignment, np.arange(chunk.shape[0])] = 1.0
+            sums += one_hot @ chunk
+        empty = ~sums.any(axis=1)
+        if empty.any():
+            # Re-seed empty clusters with random training rows
+            sums[empty] = sample[rng.choice(sample.shape[0], int(empty.sum()), replace=False)]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class IVFIndex:
+    """
+    Approximate cosine search with an inverted-file (IVF) index.
+
+    Rows are clustered by a spherical k-means coarse quantizer and stored
+    grouped by cluster, so each inverted list is a contiguous slice of the
+    matrix. A query scores the centroids, then only the ``nprobe`` closest
+    lists. It exposes the same ``top_k`` / ``top_k_positions`` / batch
+    interface as SimilarityIndex, with positions referring to the original
+    row order, so it can stand in for an exact index in two_stage_rerank().
+    """
+
+    def __init__(self, tickers, matrix, centroids, order, offsets, nprobe=DEFAULT_NPROBE):
+        """
+        Args:
+            tickers (list of str): Ticker for each original row.
+            matrix (numpy.ndarray): Unit-length rows grouped by list.
+            centroids (numpy.ndarray): ``(nlist, dim)`` unit-length centroids.
+            order (numpy.ndarray): Original row position of each row of ``matrix``.
+            offsets (numpy.ndarray): ``nlist + 1`` list boundaries into ``matrix``.
+            nprobe (int): Lists scanned per query.
+        """
+        self.tickers = list(tickers)
+        self.matrix = matrix
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.nprobe = nprobe
+        self._inverse = np.empty_like(order)
+        self._inverse[order] = np.arange(order.shape[0])
+
+    @classmethod
+    def build(cls, tickers, matrix, nlist=None, nprobe=DEFAULT_NPROBE, normalized=False, seed=0):
+        """
+        Trains the coarse quantizer and groups the universe into inverted lists.
+
+        Args:
+            tickers (list of str): Ticker for each row.
+            matrix (array-like): One embedding per ticker.
+            nlist (int, optional): Number of lists. Defaults to ~sqrt(N).
+            nprobe (int): Lists scanned per query.
+            normalized (bool): Set when ``matrix`` already holds unit-length rows.
+            seed (int): Seed for k-means.
+
+        Returns:
+            IVFIndex: The built index.
+        """
+        start_time = time.time()
+        matrix = np.asarray(matrix, dtype=np.float32) if normalized else normalize_rows(matrix)
+        n = matrix.shape[0]
+        if nlist is None:
+            nlist = max(1, int(np.sqrt(n) * NLIST_FACTOR))
+        nlist = min(nlist, n)
+
+        centroids = _spherical_kmeans(matrix, nlist, seed=seed)
+        assignment = np.empty(n, dtype=np.int64)
+        for start in range(0, n, ASSIGN_CHUNK_ROWS):
+            assignment[start:start + ASSIGN_CHUNK_ROWS] = np.argmax(matrix[start:start + ASSIGN_CHUNK_ROWS] @ centroids.T, axis=1)
+
+        order = np.argsort(assignment, kind='stable')
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignment, minlength=nlist))
+        grouped = np.ascontiguousarray(matrix[order])
+        logging.info(f"Built IVF index over {n} rows with {nlist} lists in {time.time() - start_time:.2f} seconds")
+        return cls(tickers, grouped, centroids, order, offsets, nprobe=nprobe)
+
+    def save(self, path):
+        """
+        Persists the index as ``.npy`` files so it can be memory-mapped on load.
+
+        Args:
+            path (str): Directory to write to (created if missing).
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'ann_matrix.npy'), self.matrix)
+        np.save(os.path.join(path, 'ann_centroids.npy'), self.centroids)
+        np.save(os.path.join(path, 'ann_order.npy'), self.order)
+        np.save(os.path.join(path, 'ann_offsets.npy'), self.offsets)
+        with open(os.path.join(path, ANN_METADATA_FILE), 'w') as file:
+            json.dump({'tickers': self.tickers, 'nprobe': self.nprobe}, file)
+
+    @classmethod
+    def load(cls, path, nprobe=None, mmap=True):
+        """
+        Loads an index written by save().
+
+        Args:
+            path (str): Directory the index was saved to.
+            nprobe (int, optional): Override the saved ``nprobe``.
+            mmap (bool): Memory-map the grouped matrix instead of reading it.
+
+        Returns:
+            IVFIndex: The loaded index.
+        """
+        with open(os.path.join(path, ANN_METADATA_FILE), 'r') as file:
+            metadata = json.load(file)
+        return cls(
+            metadata['tickers'],
+            np.load(os.path.join(path, 'ann_matrix.npy'), mmap_mode='r' if mmap else None),
+            np.load(os.path.join(path, 'ann_centroids.npy')),
+            np.load(os.path.join(path, 'ann_order.npy')),
+            np.load(os.path.join(path, 'ann_offsets.npy')),
+            nprobe=nprobe if nprobe is not None else metadata['nprobe'],
+        )
+
+    def __len__(self):
+        return len(self.tickers)
+
+    @property
+    def dimension(self):
+        return self.matrix.shape[1]
+
+    @property
+    def nlist(self):
+        return self.centroids.shape[0]
+
+    def _search(self, query, k, nprobe):
+        lists = np.sort(select_top_k(self.centroids @ query, nprobe))
+        # Each probed list is a contiguous slice, so no rows are gathered or copied
+        scores = np.concatenate([self.matrix[self.offsets[i]:self.offsets[i + 1]] @ query for i in lists])
+        rows = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in lists])
+        # Select on original positions so ties break like the exact index
+        positions = self.order[rows]
+        selected = select_top_k(scores, k, tiebreak=positions)
+        return positions[selected], scores[selected]
+
+    def top_k_positions(self, query, k, candidates=None, nprobe=None):
+        """
+        Returns original row positions and scores of the approximate top k.
+
+        When ``candidates`` is given the search is exact over those rows, which
+        is what the rerank stage of two_stage_rerank() needs.
+        """
+        query = normalize_vector(query)
+        if query.shape[0] != self.dimension:
+            raise ValueError(f"Query has {query.shape[0]} dimensions, index has {self.dimension}")
+        if candidates is not None:
+            candidates = np.asarray(candidates, dtype=np.int64)
+            scores = self.matrix[self._inverse[candidates]] @ query
+            selected = select_top_k(scores, k)
+            return candidates[selected], scores[selected]
+        return self._search(query, k, nprobe or self.nprobe)
+
+    def top_k(self, query, k, candidates=None, nprobe=None):
+        positions, scores = self.top_k_positions(query, k, candidates, nprobe)
+        return [(self.tickers[i], float(score)) for i, score in zip(positions, scores)]
+
+    def top_k_positions_batch(self, queries, k, candidates=None, nprobe=None):
+        queries = normalize_queries(queries)
+        if candidates is None:
+            return [self._search(query, k, nprobe or self.nprobe) for query in queries]
+        return [self.top_k_positions(query, k, rows) for query, rows in zip(queries, candidates)]
+
+    def top_k_batch(self, queries, k, candidates=None, nprobe=None):
+        return [
+            [(self.tickers[i], float(score)) for i, score in zip(positions, scores)]
+            for positions, scores in self.top_k_positions_batch(queries, k, candidates, nprobe)
+        ]
+
+    def exact_index(self):
+        """
+        Returns an exact SimilarityIndex over the same rows in original order.
+        """
+        return SimilarityIndex(self.tickers, self.matrix[self._inverse], normalized=True)
+
+    def measure_recall(self, queries, k=10, nprobe_values=None):
+        """
+        Measures recall@k and latency against exact search for several ``nprobe`` settings.
+
+        Args:
+            queries (array-like): Sample query embeddings (e.g. recent articles).
+            k (int): Depth at which recall is measured.
+            nprobe_values (list of int, optional): Settings to evaluate.
+                Defaults to powers of two up to ``nlist``.
+
+        Returns:
+            list of dict: One entry per setting with ``nprobe``, ``recall`` and
+            ``mean_latency_ms``, plus the exact-search baseline latency.
+        """
+        queries = normalize_queries(queries)
+        exact = self.exact_index()
+        start_time = time.perf_counter()
+        truth = [set(exact.top_k_positions(query, k)[0].tolist()) for query in queries]
+        exact_latency = (time.perf_counter() - start_time) / len(queries) * 1000
+
+        if nprobe_values is None:
+            nprobe_values = []
+            value = 1
+            while value < self.nlist:
+                nprobe_values.append(value)
+                value *= 2
+            nprobe_values.append(self.nlist)
+
+        report = []
+        for nprobe in nprobe_values:
+            hits = 0
+            start_time = time.perf_counter()
+            for query, expected in zip(queries, truth):
+                positions, _ = self._search(query, k, nprobe)
+                hits += len(expected.intersection(positions.tolist()))
+            latency = (time.perf_counter() - start_time) / len(queries) * 1000
+            report.append({
+                'nprobe': nprobe,
+                'recall': hits / max(1, sum(len(expected) for expected in truth)),
+                'mean_latency_ms': latency,
+                'exact_latency_ms': exact_latency,
+            })
+            logging.info(f"nprobe={nprobe}: recall@{k}={report[-1]['recall']:.4f}, "
+                         f"{latency:.3f} ms/query (exact {exact_latency:.3f} ms)")
+        return report
+
+
+def build_index(tickers, matrix, normalized=False, min_ann_universe=MIN_ANN_UNIVERSE, **ivf_options):
+    """
+    Returns an IVFIndex for large universes and an exact SimilarityIndex otherwise.
+
+    Args:
+        tickers (list of str): Ticker for each row.
+        matrix (array-like): One embedding per ticker.
+        normalized (bool): Set when ``matrix`` already holds unit-length rows.
+        min_ann_universe (int): Smallest universe that gets an IVF index.
+        **ivf_options: Passed to IVFIndex.build().
+
+    Returns:
+        SimilarityIndex or IVFIndex: The index.
+    """
+    if len(tickers) < min_ann_universe:
+        return SimilarityIndex(tickers, matrix, normalized=normalized)
+    return IVFIndex.build(tickers, matrix, normalized=normalized, **ivf_options)
+
+
+def main():
+    from embedding_snapshot import SNAPSHOT_DIR, load_snapshot
+
+    parser = argparse.ArgumentParser(description="Report IVF recall against exact search on the local snapshot.")
+    parser.add_argument('--snapshot-dir', default=SNAPSHOT_DIR)
+    parser.add_argument('--model', default='vertex')
+    parser.add_argument('--nlist', type=int, default=None)
+    parser.add_argument('--k', type=int, default=100)
+    parser.add_argument('--queries', type=int, default=200,
+                        help="Number of universe rows sampled as queries")
+    parser.add_argument('--output', default=None, help="Write the report as JSON to this path")
+    args = parser.parse_args()
+
+    snapshot = load_snapshot(args.snapshot_dir)
+    if snapshot is None:
+        raise SystemExit(f"No embedding snapshot found in {args.snapshot_dir}")
+    matrix = snapshot.matrices[args.model]
+    index = IVFIndex.build(snapshot.tickers, matrix, nlist=args.nlist, normalized=True)
+
+    rng = np.random.default_rng(0)
+    sample = rng.choice(matrix.shape[0], min(args.queries, matrix.shape[0]), replace=False)
+    # Perturb the sampled rows so queries are not exact copies of indexed vectors
+    queries = matrix[np.sort(sample)] + rng.normal(scale=0.02, size=(len(sample), matrix.shape[1]))
+    report = index.measure_recall(queries, k=args.k)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'model': args.model, 'universe': len(snapshot), 'nlist': index.nlist,
+                       'k': args.k, 'results': report}, file, indent=2)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
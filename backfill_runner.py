@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import logging
+import threading
+import concurrent.futures
+from embedding_storage import content_fingerprint
+
+# -------------------- Configuration --------------------
+
+# Directory holding one checkpoint journal per backfill
+BACKFILL_JOURNAL_DIR = os.getenv(
+    'BACKFILL_JOURNAL_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'backfill'),
+)
+
+# Finished items handed to the commit function at once
+COMMIT_BATCH_SIZE = 500
+
+# Seconds between progress reports
+PROGRESS_INTERVAL = 30
+
+# -------------------------------------------------------
+
+
+class CheckpointJournal:
+    """
+    Append-only JSONL record of the items a backfill has committed.
+
+    Entries are ``(key, model, fingerprint)``: the item, the models that
+    embedded it and the content fingerprint of its text, so an item whose
+    text or model changed since it was recorded runs again. A line is written
+    only after its item's commit succeeded, so a restarted run skips exactly
+    the work that already reached the destination.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._done = set()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if os.path.exists(path):
+            with open(path) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                        self._done.add((entry['key'], entry['model'], entry['fingerprint']))
+                    except (ValueError, KeyError, TypeError):
+                        # A crash can leave a torn last line; that item simply runs again
+                        continue
+
+    def done(self):
+        with self._lock:
+            return set(self._done)
+
+    def record(self, entries):
+        """
+        Marks ``(key, model, fingerprint)`` entries as committed, durably, before returning.
+        """
+        if not entries:
+            return
+        now = time.time()
+        with self._lock:
+            with open(self.path, 'a') as file:
+                for key, model, fingerprint in entries:
+                    file.write(json.dumps({'key': key, 'model': model, 'fingerprint': fingerprint,
+                                           'committed_at': now}) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            self._done.update(entries)
+
+    def clear(self):
+        with self._lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self._done.clear()
+
+
+class BackfillProvider:
+    """
+    One embedding provider of a backfill and its worker pool.
+    """
+
+    def __init__(self, name, embed_batch, workers=4, batch_size=1, model=None):
+        """
+        Args:
+            name (str): Provider name, also the key of its result per item.
+            embed_batch (callable): Takes a list of texts and returns one
+                result (or None on failure) per text.
+            workers (int): Batches of this provider in flight at once; raise
+                it until the provider's quota is reached.
+            batch_size (int): Texts per embed_batch call.
+            model (str, optional): Identity of the model and version behind
+                the provider, recorded in the journal; defaults to ``name``.
+        """
+        self.name = name
+        self.embed_batch = embed_batch
+        self.workers = workers
+        self.batch_size = batch_size
+        self.model = model or name
+
+
+class BackfillRunner:
+    """
+    Runs a resumable backfill: every item is embedded by every provider, each
+    provider with its own bounded worker pool, and finished items are handed
+    to ``commit`` in batches.
+
+    ``commit`` must be idempotent (a MERGE keyed on the item), because a crash
+    between a commit and its journal write replays that batch once. With the
+    journal skipping everything recorded, each result lands exactly once.
+    Results computed but not yet committed when a run dies are recomputed on
+    restart; the embedding cache answers those without a provider call.
+    """
+
+    def __init__(self, name, providers, commit, journal_path=None,
+                 commit_batch_size=COMMIT_BATCH_SIZE, progress_interval=PROGRESS_INTERVAL):
+        """
+        Args:
+            name (str): Backfill name used in logs and the default journal file.
+            providers (list of BackfillProvider): Providers run for every item.
+            commit (callable): Takes a list of ``(key, {provider: result})``
+                and writes them; raises if the write did not succeed.
+            journal_path (str, optional): Checkpoint journal file.
+            commit_batch_size (int): Finished items per commit call.
+            progress_interval (float): Seconds between progress reports.
+        """
+        self.name = name
+        self.providers = list(providers)
+        self.commit = commit
+        self.journal = CheckpointJournal(journal_path or os.path.join(BACKFILL_JOURNAL_DIR, f"{name}.jsonl"))
+        self.model = '+'.join(provider.model for provider in self.providers)
+        self.commit_batch_size = commit_batch_size
+        self.progress_interval = progress_interval
+
+    def _embed(self, provider, texts):
+        try:
+            results = list(provider.embed_batch(texts))
+            if len(results) != len(texts):
+                raise ValueError(f"got {len(results)} results for {len(texts)} inputs")
+            return results
+        except Exception as e:
+            logging.error(f"{self.name}: {provider.name} failed for a batch of {len(texts)}: {e}")
+            return [None] * len(texts)
+
+    def _commit(self, keys, results, fingerprints, stats):
+        batch = [(key, results.pop(key)) for key in keys]
+        writable = [(key, values) for key, values in batch if any(value is not None for value in values.values())]
+        complete = [key for key, values in batch if all(value is not None for value in values.values())]
+        stats['failed'] += len(batch) - len(complete)
+        if not writable:
+            return
+        try:
+            self.commit(writable)
+        except Exception as e:
+            logging.error(f"{self.name}: commit of {len(writable)} items failed, they will run again: {e}")
+            stats['failed'] += len(complete)
+            return
+        # Items with a failed provider were written partially and stay out of
+        # the journal, so the next run retries them
+        self.journal.record([(key, self.model, fingerprints[key]) for key in complete])
+        stats['committed'] += len(complete)
+
+    def _report(self, finished, total, start_time):
+        elapsed = time.monotonic() - start_time
+        rate = finished / elapsed if elapsed > 0 else 0.0
+        eta = (total - finished) / rate if rate > 0 else float('inf')
+        logging.info(f"{self.name}: {finished}/{total} items ({finished / total:.0%}), "
+                     f"{rate:.1f} items/s, ETA {eta / 60:.1f} min")
+
+    def run(self, items):
+        """
+        Runs the backfill over ``items``, skipping those already committed
+        with the same models and text.
+
+        Args:
+            items (list of tuple): ``(key, text)`` pairs; keys must be hashable
+                and JSON-serializable.
+
+        Returns:
+            dict: 'total', 'skipped', 'committed' and 'failed' item counts.
+        """
+        done = self.journal.done()
+        fingerprints = {key: content_fingerprint(text) for key, text in items}
+        pending = [(key, text) for key, text in items if (key, self.model, fingerprints[key]) not in done]
+        stats = {'total': len(items), 'skipped': len(items) - len(pending), 'committed': 0, 'failed': 0}
+        if stats['skipped']:
+            logging.info(f"{self.name}: skipping {stats['skipped']} items committed by an earlier run")
+        if not pending:
+            self.journal.clear()
+            return stats
+
+        results = {key: {} for key, _ in pending}
+        ready = []
+        executors = {
+            provider.name: concurrent.futures.ThreadPoolExecutor(
+                max_workers=provider.workers, thread_name_prefix=f"{self.name}-{provider.name}"
+            )
+            for provider in self.providers
+        }
+        futures = {}
+        try:
+            for provider in self.providers:
+                for start in range(0, len(pending), provider.batch_size):
+                    chunk = pending[start:start + provider.batch_size]
+                    future = executors[provider.name].submit(self._embed, provider, [text for _, text in chunk])
+                    futures[future] = (provider.name, [key for key, _ in chunk])
+
+            start_time = last_report = time.monotonic()
+            finished = 0
+            for future in concurrent.futures.as_completed(futures):
+                provider_name, keys = futures.pop(future)
+                for key, result in zip(keys, future.result()):
+                    results[key][provider_name] = result
+                    if len(results[key]) == len(self.providers):
+                        ready.append(key)
+                        finished += 1
+                if len(ready) >= self.commit_batch_size:
+                    self._commit(ready, results, fingerprints, stats)
+                    ready = []
+                if time.monotonic() - last_report >= self.progress_interval:
+                    self._report(finished, len(pending), start_time)
+                    last_report = time.monotonic()
+            self._commit(ready, results, fingerprints, stats)
+            self._report(finished, len(pending), start_time)
+        finally:
+            for executor in executors.values():
+                executor.shutdown(wait=False, cancel_futures=True)
+
+        logging.info(f"{self.name}: committed {stats['committed']} items, {stats['failed']} failed, "
+                     f"{stats['skipped']} skipped")
+        if not stats['failed']:
+            # Everything reached the destination; the next run starts clean
+            self.journal.clear()
+        return stats
@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import resource
+import subprocess
+import concurrent.futures
+import multiprocessing
+from datetime import datetime, timezone
+import numpy as np
+from similarity import SimilarityIndex, normalize_rows
+from ann_index import IVFIndex
+from quantization import QuantizedIndex
+from reduced_index import ReducedIndex
+
+# -------------------- Configuration --------------------
+
+DEFAULT_SIZES = [1000, 10000, 100000, 500000]
+DEFAULT_DIMENSIONS = [1024, 3072]
+DEFAULT_STRATEGIES = ['scipy_loop', 'exact', 'int8', 'binary', 'ivf', 'reduced']
+
+# The per-ticker scipy loop is far too slow to run on the largest universes
+LOOP_MAX_UNIVERSE = 100000
+LOOP_MAX_QUERIES = 20
+
+# Number of latent topics the synthetic tickers are drawn around
+SYNTHETIC_CLUSTERS = 256
+
+# Rows generated per chunk so float64 temporaries stay small
+GENERATE_CHUNK_ROWS = 50000
+
+# -------------------------------------------------------
+
+
+def _peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def generate_universe(size, dimension, seed=0):
+    """
+    Generates unit-length synthetic ticker embeddings clustered around latent topics,
+    so nearest-neighbour structure resembles real business-summary embeddings.
+
+    Returns:
+        tuple: ``(tickers, matrix, centers)``.
+    """
+    rng = np.random.default_rng(seed)
+    centers = normalize_rows(rng.standard_normal((SYNTHETIC_CLUSTERS, dimension), dtype=np.float32))
+    matrix = np.empty((size, dimension), dtype=np.float32)
+    for start in range(0, size, GENERATE_CHUNK_ROWS):
+        rows = min(GENERATE_CHUNK_ROWS, size - start)
+        assignment = rng.integers(0, SYNTHETIC_CLUSTERS, rows)
+        noise = rng.standard_normal((rows, dimension), dtype=np.float32) / np.sqrt(dimension)
+        matrix[start:start + rows] = normalize_rows(centers[assignment] + 1.5 * noise)
+    tickers = [f"SYN{i}" for i in range(size)]
+    return tickers, matrix, centers
+
+
+def generate_articles(matrix, count, seed=1):
+    """
+    Generates synthetic article embeddings near random tickers.
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, matrix.shape[0], count)
+    noise = rng.standard_normal((count, matrix.shape[1]), dtype=np.float32) / np.sqrt(matrix.shape[1])
+    return normalize_rows(matrix[rows] + noise)
+
+
+class ScipyLoopIndex:
+    """
+    The original mainpredictions path: scipy cosine per ticker plus a full sort.
+    """
+
+    def __init__(self, tickers, matrix):
+        from scipy.spatial.distance import cosine
+        self._cosine = cosine
+        self.tickers = tickers
+        self.rows = [np.asarray(row, dtype=np.float64) for row in matrix]
+
+    def _similarity(self, v1, v2):
+        if np.linalg.norm(v1) == 0 or np.linalg.norm(v2) == 0:
+            return 0
+        return 1 - self._cosine(v1, v2)
+
+    def top_k_positions(self, query, k):
+        query = np.asarray(query, dtype=np.float64).ravel()
+        similarities = [(i, self._similarity(query, row)) for i, row in enumerate(self.rows)]
+        top = sorted(similarities, key=lambda x: x[1], reverse=True)[:k]
+        return np.array([i for i, _ in top]), np.array([s for _, s in top])
+
+    def top_k_positions_batch(self, queries, k):
+        return [self.top_k_positions(query, k) for query in queries]
+
+
+def build_strategy(strategy, tickers, matrix, options):
+    exact = SimilarityIndex(tickers, matrix, normalized=True)
+    if strategy == 'scipy_loop':
+        return ScipyLoopIndex(tickers, matrix)
+    if strategy == 'exact':
+        return exact
+    if strategy in ('int8', 'binary'):
+        return QuantizedIndex(tickers, matrix, mode=strategy)
+    if strategy == 'ivf':
+        return IVFIndex.build(tickers, matrix, nprobe=options['nprobe'], normalized=True)
+    if strategy == 'reduced':
+        return ReducedIndex.build(exact, 'pca', options['reduced_dims'])
+    raise ValueError(f"Unknown strategy '{strategy}'")
+
+
+def run_case(size, dimension, strategy, options):
+    """
+    Runs one (universe size, dimension, strategy) case. Called in a fresh
+    process so peak RSS belongs to this case alone.
+
+    Returns:
+        dict: Machine-readable result row.
+    """
+    result = {'strategy': strategy, 'universe': size, 'dimension': dimension, 'k': options['k']}
+    tickers, matrix, _ = generate_universe(size, dimension, seed=options['seed'])
+    queries = options['queries']
+    if strategy == 'scipy_loop':
+        queries = min(queries, LOOP_MAX_QUERIES)
+    articles = generate_articles(matrix, queries, seed=options['seed'] + 1)
+    result['rss_after_universe_mb'] = _peak_rss_mb()
+
+    start_time = time.perf_counter()
+    try:
+        index = build_strategy(strategy, tickers, matrix, options)
+    except ImportError as e:
+        result['skipped'] = f"missing dependency: {e}"
+        return result
+    result['build_seconds'] = time.perf_counter() - start_time
+    # Bytes the first stage keeps resident, where the strategy exposes it
+    result['index_bytes'] = int(getattr(index, 'nbytes', matrix.nbytes))
+
+    k = options['k']
+    latencies = []
+    found = []
+    for article in articles:
+        start_time = time.perf_counter()
+        positions, _ = index.top_k_positions(article, k)
+        latencies.append((time.perf_counter() - start_time) * 1000)
+        found.append(positions)
+
+    if hasattr(index, 'top_k_positions_batch') and strategy != 'scipy_loop':
+        start_time = time.perf_counter()
+        index.top_k_positions_batch(articles, k)
+        batch_seconds = time.perf_counter() - start_time
+    else:
+        batch_seconds = sum(latencies) / 1000
+    result['peak_rss_mb'] = _peak_rss_mb()
+
+    exact = SimilarityIndex(tickers, matrix, normalized=True)
+    truth = exact.top_k_positions_batch(articles, k)
+    agreement = [len(set(t.tolist()) & set(np.asarray(f).tolist())) / k for (t, _), f in zip(truth, found)]
+    top3 = [list(t[:3]) == list(np.asarray(f)[:3]) for (t, _), f in zip(truth, found)]
+
+    latencies = np.array(latencies)
+    result.update({
+        'queries': len(articles),
+        'latency_ms': {
+            'p50': float(np.percentile(latencies, 50)),
+            'p90': float(np.percentile(latencies, 90)),
+            'p99': float(np.percentile(latencies, 99)),
+            'mean': float(latencies.mean()),
+        },
+        'throughput_qps': len(articles) / sum(latencies) * 1000,
+        'batch_throughput_qps': len(articles) / batch_seconds if batch_seconds else None,
+        'topk_agreement': float(np.mean(agreement)),
+        'top3_identical_fraction': float(np.mean(top3)),
+    })
+    logging.info(f"{strategy} n={size} d={dimension}: p50 {result['latency_ms']['p50']:.2f} ms, "
+                 f"agreement {result['topk_agreement']:.4f}, peak RSS {result['peak_rss_mb']:.0f} MB")
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ticker retrieval strategies on synthetic universes.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--dimensions', type=int, nargs='+', default=DEFAULT_DIMENSIONS)
+    parser.add_argument('--strategies', nargs='+', default=DEFAULT_STRATEGIES, choices=DEFAULT_STRATEGIES)
+    parser.add_argument('--queries', type=int, default=200, help="Synthetic articles per case")
+    parser.add_argument('--k', type=int, default=100, help="Top-k depth (the Vertex shortlist size)")
+    parser.add_argument('--nprobe', type=int, default=16)
+    parser.add_argument('--reduced-dims', type=int, default=256)
+    parser.add_argument('--loop-max-universe', type=int, default=LOOP_MAX_UNIVERSE)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='retrieval_benchmark.json')
+    args = parser.parse_args()
+
+    options = {
+        'queries': args.queries,
+        'k': args.k,
+        'nprobe': args.nprobe,
+        'reduced_dims': args.reduced_dims,
+        'seed': args.seed,
+    }
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for dimension in args.dimensions:
+        for size in args.sizes:
+            for strategy in args.strategies:
+                if strategy == 'scipy_loop' and size > args.loop_max_universe:
+                    results.append({'strategy': strategy, 'universe': size, 'dimension': dimension,
+                                    'skipped': f"universe larger than --loop-max-universe {args.loop_max_universe}"})
+                    continue
+                # A fresh process per case keeps peak RSS and warm caches from leaking between cases
+                with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    try:
+                        results.append(executor.submit(run_case, size, dimension, strategy, options).result())
+                    except Exception as e:
+                        logging.error(f"Case {strategy} n={size} d={dimension} failed: {e}")
+                        results.append({'strategy': strategy, 'universe': size, 'dimension': dimension,
+                                        'error': str(e)})
+
+    report = {
+        'meta': {
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'git_commit': _git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'options': options,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    logging.info(f"Wrote {len(results)} results to {args.output}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -5,6 +5,8 @@ import yfinance as yf
 from google.cloud import bigquery
 from google.api_core.exceptions import NotFound
 import pandas as pd
+from rate_limiter import get_limiter
+from embedding_storage import FINGERPRINT_COLUMN, content_fingerprint
 
 # -------------------- Configuration --------------------
 
@@ -27,6 +29,11 @@ DESTINATION_SCHEMA = [
     bigquery.SchemaField("embeddings_large", "STRING", mode="NULLABLE"),
     bigquery.SchemaField("openai_embeddings", "STRING", mode="NULLABLE"),
     bigquery.SchemaField("embeddings_large_instruct", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("embeddings_vec", "FLOAT64", mode="REPEATED"),
+    bigquery.SchemaField("embeddings_large_vec", "FLOAT64", mode="REPEATED"),
+    bigquery.SchemaField("openai_embeddings_vec", "FLOAT64", mode="REPEATED"),
+    bigquery.SchemaField("embeddings_large_instruct_vec", "FLOAT64", mode="REPEATED"),
+    bigquery.SchemaField("embeddings_fingerprint", "STRING", mode="NULLABLE"),
     bigquery.SchemaField("row", "INTEGER", mode="NULLABLE"),
 ]
 
@@ -76,7 +83,7 @@ def fetch_stock_info(ticker):
     for attempt in range(1, MAX_RETRIES + 1):
         try:
             stock = yf.Ticker(ticker)
-            info = stock.info
+            info = get_limiter('yahoo_finance').call(lambda: stock.info)
             sector = info.get('sector', None)
             long_business_summary = info.get('longBusinessSummary', None)
             if not long_business_summary:
@@ -128,6 +135,8 @@ def prepare_rows(df):
             "embeddings_large": None,
             "openai_embeddings": None,
             "embeddings_large_instruct": None,
+            # Fingerprint of the summary the row's embeddings are (to be) built from
+            FINGERPRINT_COLUMN: content_fingerprint(stock_info['long_business_summary']),
             "row": index + 1  # Assuming row numbers start at 1
         }
         rows_to_insert.append(row_data)
@@ -0,0 +1,71 @@
+import time
+
+# -------------------- Configuration --------------------
+
+# A retry is not started with less budget left than this, in seconds
+MIN_ATTEMPT_SECONDS = 1.0
+
+# -------------------------------------------------------
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline:
+    """
+    Absolute time budget handed down a call chain.
+
+    Created once per unit of work (one article), then every request, retry
+    wait and sleep underneath takes its timeout from ``remaining()``, so the
+    whole unit finishes within ``seconds`` however the time is spent.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self, what="operation"):
+        """
+        Raises:
+            DeadlineExceeded: If the budget is used up.
+        """
+        if self.expired():
+            raise DeadlineExceeded(f"{what} exceeded its {self.seconds}s deadline")
+
+    def timeout(self, cap=None, what="operation"):
+        """
+        Returns the timeout for the next request: the remaining budget, capped at ``cap``.
+
+        Raises:
+            DeadlineExceeded: If the budget is used up.
+        """
+        self.check(what)
+        remaining = self.remaining()
+        return min(remaining, cap) if cap is not None else remaining
+
+    def sleep(self, seconds):
+        """
+        Sleeps for ``seconds``, or until the deadline if that comes first.
+        """
+        time.sleep(min(seconds, self.remaining()))
+
+
+def stop_at_deadline(deadline, min_attempt_seconds=MIN_ATTEMPT_SECONDS):
+    """
+    tenacity stop condition: no further attempt once too little budget is left.
+    """
+    return lambda retry_state: deadline.remaining() < min_attempt_seconds
+
+
+def wait_within(deadline, wait):
+    """
+    Wraps a tenacity wait strategy so a retry never waits past the deadline.
+    """
+    return lambda retry_state: min(wait(retry_state), deadline.remaining())
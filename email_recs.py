@@ -7,6 +7,7 @@ from datetime import datetime, timedelta
 import pytz
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail, Content
+from rate_limiter import get_limiter
 
 # Set your Google Cloud credentials
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = '...'
@@ -55,7 +56,8 @@ def send_email(subject, html_body, recipient_emails):
                 html_content=html_body
             )
             sg = SendGridAPIClient(sendgrid_api_key)
-            response = sg.send(message)
+            response = get_limiter('sendgrid').call(sg.send, message)
+            get_limiter('sendgrid').update(response.headers)
             logging.info(f"Email sent to {recipient_email}: Status code {response.status_code}")
         except Exception as e:
             logging.error(f"Failed to send email to {recipient_email}: {e}")
@@ -70,7 +72,7 @@ def query_database():
     logging.info(f"Querying for articles since: {time_threshold_str} PST")
 
     query = f"""
-        SELECT *
+        SELECT id, date, sources, stock_prediction
         FROM `{full_table_id}`
         WHERE DATETIME(PARSE_DATETIME('%m-%d-%Y %I:%M %p', date)) >= PARSE_DATETIME('%m-%d-%Y %I:%M %p', '{time_threshold_str}')
         AND EXISTS (
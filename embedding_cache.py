@@ -0,0 +1,285 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import concurrent.futures
+import numpy as np
+
+# -------------------- Configuration --------------------
+
+# One cache file shared by every pipeline on the host, wherever it is started from
+EMBEDDING_CACHE_PATH = os.getenv(
+    'EMBEDDING_CACHE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'embeddings.sqlite'),
+)
+
+# Vector bytes kept on disk; least recently used entries are evicted beyond this
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv('EMBEDDING_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+
+# Eviction trims the cache to this fraction of the limit so it does not run on every insert
+EVICTION_TARGET = 0.9
+
+# Inserts between size checks
+EVICTION_CHECK_INTERVAL = 200
+
+# -------------------------------------------------------
+
+
+def text_key(text):
+    """
+    Returns the cache key for an embedding input.
+
+    Whitespace is collapsed first, matching how every pipeline cleans text
+    before sending it, so cosmetic differences still hit the same entry.
+
+    Returns:
+        bytes: SHA-256 digest of the normalized text.
+    """
+    return hashlib.sha256(' '.join(str(text).split()).encode('utf-8')).digest()
+
+
+def _encode(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    return ','.join(str(n) for n in vector.shape), vector.tobytes()
+
+
+def _decode(shape, blob):
+    shape = tuple(int(n) for n in shape.split(',')) if shape else ()
+    return np.frombuffer(blob, dtype=np.float32).reshape(shape)
+
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache keyed by (model, normalized text hash).
+
+    Vectors are stored as raw float32 BLOBs in SQLite (WAL mode, so several
+    processes can share the file) with their original shape, and evicted
+    least-recently-used once the stored bytes exceed ``max_bytes``.
+
+    Within a process, concurrent lookups of the same missing key are
+    coalesced: the first caller computes the embedding and the others wait
+    for its result instead of making their own upstream call.
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_bytes=EMBEDDING_CACHE_MAX_BYTES):
+        """
+        Args:
+            path (str): SQLite file, created if missing.
+            max_bytes (int): Vector bytes kept before LRU eviction.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._inserts = 0
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    text_hash BLOB NOT NULL,
+                    shape TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (model, text_hash)
+                ) WITHOUT ROWID
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get_many(self, model, texts):
+        """
+        Looks up cached vectors.
+
+        Returns:
+            list: One numpy array per text, or None where there is no entry.
+        """
+        keys = [text_key(text) for text in texts]
+        found = {}
+        connection = self._connection()
+        unique = list(set(keys))
+        # SQLite limits bound parameters, so look keys up in slices
+        for start in range(0, len(unique), 500):
+            chunk = unique[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = connection.execute(
+                f"SELECT text_hash, shape, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                [model, *chunk],
+            ).fetchall()
+            found.update((bytes(key), _decode(shape, blob)) for key, shape, blob in rows)
+        if found:
+            with connection:
+                connection.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                    [(time.time(), model, key) for key in found],
+                )
+        results = [found.get(key) for key in keys]
+        with self._lock:
+            hits = sum(result is not None for result in results)
+            self.hits += hits
+            self.misses += len(results) - hits
+        return results
+
+    def get(self, model, text):
+        return self.get_many(model, [text])[0]
+
+    def put_many(self, model, texts, vectors):
+        """
+        Stores vectors; None entries (failed calls) are skipped.
+        """
+        now = time.time()
+        rows = [(model, text_key(text), *_encode(vector), now)
+                for text, vector in zip(texts, vectors) if vector is not None]
+        if not rows:
+            return
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, shape, vector, last_used) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+        with self._lock:
+            self._inserts += len(rows)
+            check = self._inserts >= EVICTION_CHECK_INTERVAL
+            if check:
+                self._inserts = 0
+        if check:
+            self.evict()
+
+    def put(self, model, text, vector):
+        self.put_many(model, [text], [vector])
+
+    def evict(self):
+        """
+        Deletes least recently used entries until the cache fits its size limit.
+        """
+        connection = self._connection()
+        total = connection.execute("SELECT IFNULL(SUM(LENGTH(vector)), 0) FROM embeddings").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        excess = total - int(self.max_bytes * EVICTION_TARGET)
+        removed = freed = 0
+        with connection:
+            rows = connection.execute(
+                "SELECT model, text_hash, LENGTH(vector) FROM embeddings ORDER BY last_used"
+            )
+            victims = []
+            for model, key, size in rows:
+                if freed >= excess:
+                    break
+                victims.append((model, key))
+                freed += size
+            connection.executemany("DELETE FROM embeddings WHERE model = ? AND text_hash = ?", victims)
+            removed = len(victims)
+        logging.info(f"Evicted {removed} cached embeddings ({freed / 1024 ** 2:.1f} MB)")
+
+    def get_or_compute_many(self, model, texts, compute):
+        """
+        Returns cached vectors, computing the missing ones with one call.
+
+        Args:
+            model (str): Model identifier, part of the cache key.
+            texts (list of str): Inputs exactly as they are sent upstream.
+            compute (callable): Takes the list of missing texts and returns one
+                vector (or None on failure) per text, in order.
+
+        Returns:
+            list: One numpy array (or None if computing it failed) per text.
+
+        Raises:
+            Exception: Whatever ``compute`` raised, for the texts it was computing.
+        """
+        results = self.get_many(model, texts)
+        owned, waiting = {}, {}
+        with self._lock:
+            for i, (text, result) in enumerate(zip(texts, results)):
+                if result is not None:
+                    continue
+                key = (model, text_key(text))
+                if key in owned:
+                    owned[key][1].append(i)
+                elif key in self._inflight:
+                    waiting.setdefault(key, (self._inflight[key], []))[1].append(i)
+                    self.coalesced += 1
+                else:
+                    future = concurrent.futures.Future()
+                    self._inflight[key] = future
+                    owned[key] = (future, [i])
+
+        if owned:
+            missing = [texts[positions[0]] for _, positions in owned.values()]
+            try:
+                vectors = list(compute(missing))
+                if len(vectors) != len(missing):
+                    raise ValueError(f"Got {len(vectors)} embeddings for {len(missing)} texts")
+                vectors = [None if vector is None else np.asarray(vector, dtype=np.float32) for vector in vectors]
+                self.put_many(model, missing, vectors)
+            except Exception as e:
+                with self._lock:
+                    for key, (future, _) in owned.items():
+                        del self._inflight[key]
+                        future.set_exception(e)
+                raise
+            with self._lock:
+                for (key, (future, positions)), vector in zip(owned.items(), vectors):
+                    del self._inflight[key]
+                    future.set_result(vector)
+                    for i in positions:
+                        results[i] = vector
+
+        for future, positions in waiting.values():
+            try:
+                vector = future.result()
+            except Exception:
+                vector = None
+            for i in positions:
+                results[i] = vector
+        return results
+
+    def get_or_compute(self, model, text, compute):
+        """
+        Single-text get_or_compute_many(); ``compute`` takes no arguments.
+        """
+        return self.get_or_compute_many(model, [text], lambda _: [compute()])[0]
+
+    def stats(self):
+        """
+        Returns the hit, miss and coalesced-request counters for this process.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """
+    Returns the process-wide EmbeddingCache.
+    """
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache()
+        return _default_cache
@@ -0,0 +1,201 @@
+import time
+import logging
+import threading
+import collections
+import concurrent.futures
+import numpy as np
+
+# -------------------- Configuration --------------------
+
+# A duplicate request is sent once the first has been outstanding this long,
+# as a percentile of the provider's recent successful latencies
+HEDGE_PERCENTILE = 95
+
+# Hedge delay used until enough latencies have been seen, and its bounds, in seconds
+DEFAULT_HEDGE_DELAY = 2.0
+MIN_HEDGE_DELAY = 0.05
+MAX_HEDGE_DELAY = 10.0
+
+# Recent latencies kept per provider, and how many are needed before trusting the percentile
+LATENCY_WINDOW = 500
+MIN_LATENCY_SAMPLES = 20
+
+# Hedges allowed as a fraction of calls, so hedging cannot multiply spend
+MAX_HEDGE_RATIO = 0.1
+
+# Threads shared by every provider for in-flight attempts
+HEDGE_WORKERS = 16
+
+# -------------------------------------------------------
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix='hedged')
+
+
+class LatencyTracker:
+    """
+    Rolling window of request latencies for one provider.
+    """
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def percentile(self, percentile, default=None):
+        """
+        Returns the latency percentile, or ``default`` with too few samples.
+        """
+        with self._lock:
+            if len(self._latencies) < MIN_LATENCY_SAMPLES:
+                return default
+            return float(np.percentile(self._latencies, percentile))
+
+
+class HedgedProvider:
+    """
+    Calls one embedding provider with hedging and failover.
+
+    ``targets`` are interchangeable ways of reaching the provider: the
+    primary endpoint first, then secondary regions or endpoints. A call goes
+    to the primary; if it is still outstanding after the provider's p95
+    latency, a duplicate goes to the next target and the first successful
+    answer wins. A failed attempt fails over to the next target straight
+    away. Hedges are capped at MAX_HEDGE_RATIO of calls.
+
+    With a ``limiter``, every attempt takes a token first. Latencies, and the
+    hedge delay, are measured from when the token was granted, so time queued
+    behind the rate limit never looks like a slow provider.
+    """
+
+    def __init__(self, name, targets, limiter=None, hedge_percentile=HEDGE_PERCENTILE,
+                 max_hedge_ratio=MAX_HEDGE_RATIO):
+        """
+        Args:
+            name (str): Provider name used in logs.
+            targets (list): Endpoints, clients or keyword sets, primary first.
+            limiter (RateLimiter, optional): Provider rate limiter each attempt draws from.
+            hedge_percentile (float): Latency percentile that triggers a hedge.
+            max_hedge_ratio (float): Largest fraction of calls that may be hedged.
+        """
+        if not targets:
+            raise ValueError(f"{name} needs at least one target")
+        self.name = name
+        self.targets = list(targets)
+        self.limiter = limiter
+        self.hedge_percentile = hedge_percentile
+        self.max_hedge_ratio = max_hedge_ratio
+        self.latency = LatencyTracker()
+        self.calls = 0
+        self.hedges = 0
+        self.failovers = 0
+        self._lock = threading.Lock()
+
+    def hedge_delay(self):
+        delay = self.latency.percentile(self.hedge_percentile, DEFAULT_HEDGE_DELAY)
+        return min(max(delay, MIN_HEDGE_DELAY), MAX_HEDGE_DELAY)
+
+    def _attempt(self, request, target, started):
+        if self.limiter is not None:
+            self.limiter.acquire()
+        start_time = time.monotonic()
+        started.append(start_time)
+        try:
+            result = request(target)
+        except Exception as e:
+            if self.limiter is not None:
+                self.limiter.observe_error(e)
+            raise
+        self.latency.record(time.monotonic() - start_time)
+        if self.limiter is not None:
+            self.limiter.success()
+        return result
+
+    def _may_hedge(self):
+        with self._lock:
+            if self.hedges + 1 > self.max_hedge_ratio * self.calls:
+                return False
+            self.hedges += 1
+            return True
+
+    def call(self, request, timeout=None):
+        """
+        Runs ``request(target)`` with hedging and failover.
+
+        Args:
+            request (callable): Takes one target and performs the request.
+            timeout (float, optional): Overall seconds before giving up.
+
+        Returns:
+            The first successful result.
+
+        Raises:
+            TimeoutError: If no attempt succeeded within ``timeout``.
+            Exception: The last error, if every target failed.
+        """
+        with self._lock:
+            self.calls += 1
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        next_target = 0
+        pending = set()
+        errors = []
+        # Times at which attempts got past the rate limiter and were sent
+        started = []
+
+        def launch():
+            nonlocal next_target
+            target = self.targets[next_target % len(self.targets)]
+            next_target += 1
+            pending.add(_executor.submit(self._attempt, request, target, started))
+
+        launch()
+        hedge_at = time.monotonic() + self.hedge_delay()
+        while pending:
+            if hedge_at is not None:
+                # The hedge clock runs from when the first attempt was sent
+                hedge_at = (started[0] if started else time.monotonic()) + self.hedge_delay()
+            now = time.monotonic()
+            wait_until = hedge_at if hedge_at is not None else deadline
+            if deadline is not None and wait_until is not None:
+                wait_until = min(wait_until, deadline)
+            done, pending = concurrent.futures.wait(
+                pending,
+                timeout=None if wait_until is None else max(0.0, wait_until - now),
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                if future.exception() is None:
+                    # Losing attempts finish in the background and are discarded
+                    return future.result()
+                errors.append(future.exception())
+                logging.warning(f"{self.name} attempt failed: {future.exception()}")
+                if next_target < len(self.targets):
+                    with self._lock:
+                        self.failovers += 1
+                    launch()
+
+            now = time.monotonic()
+            if deadline is not None and now >= deadline:
+                raise TimeoutError(f"{self.name} did not answer within {timeout}s")
+            if hedge_at is not None and now >= hedge_at and pending:
+                if self._may_hedge():
+                    logging.info(f"{self.name} slower than p{self.hedge_percentile:g} "
+                                 f"({self.hedge_delay():.2f}s), sending a hedged request")
+                    launch()
+                hedge_at = None
+
+        raise errors[-1] if errors else RuntimeError(f"{self.name} request failed")
+
+    def stats(self):
+        """
+        Returns call, hedge and failover counters and the current hedge delay.
+        """
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'hedges': self.hedges,
+                'failovers': self.failovers,
+                'hedge_delay': self.hedge_delay(),
+            }
@@ -0,0 +1,174 @@
+import os
+import json
+import threading
+import numpy as np
+from rate_limiter import get_limiter
+
+# -------------------- Configuration --------------------
+
+# Optional JSON file with extra model definitions (a list of EmbeddingModel
+# keyword sets), so a model can be tried without a code change
+EMBEDDING_MODELS_CONFIG = os.getenv('EMBEDDING_MODELS_CONFIG')
+
+# -------------------------------------------------------
+
+
+class EmbeddingModel:
+    """
+    One registered embedding model.
+
+    Stored vectors are keyed by (entity, name, version): bumping ``version``
+    (a redeployed endpoint, a new API model) makes every entity missing for
+    the new version, while other models keep theirs.
+    """
+
+    def __init__(self, name, provider, model_id, version='1', label=None, column=None,
+                 max_characters=1450, batch_size=16):
+        """
+        Args:
+            name (str): Registry and snapshot name, e.g. 'vertex'.
+            provider (str): 'vertex' (custom Vertex AI endpoint) or 'openai'.
+            model_id (str): Vertex AI endpoint name or OpenAI model name.
+            version (str): Version of the vectors the model produces.
+            label (str, optional): Name used in prompts and logs.
+            column (str, optional): Legacy JSON column in the stocks tables;
+                models without one live only in the long-format store.
+            max_characters (int): Input characters sent per text.
+            batch_size (int): Inputs per provider request.
+        """
+        if provider not in ('vertex', 'openai'):
+            raise ValueError(f"Unknown embedding provider {provider!r} for model {name}")
+        self.name = name
+        self.provider = provider
+        self.model_id = model_id
+        self.version = str(version)
+        self.label = label or name
+        self.column = column
+        self.max_characters = max_characters
+        self.batch_size = batch_size
+
+    @property
+    def cache_key(self):
+        """
+        Model key in the shared embedding cache. Version 1 keeps the keys the
+        pipelines used before the registry, so existing entries stay valid.
+        """
+        key = f"{self.provider}:{self.model_id}"
+        return key if self.version == '1' else f"{key}@{self.version}"
+
+    def __repr__(self):
+        return f"EmbeddingModel({self.name!r}, {self.provider!r}, version={self.version!r})"
+
+
+EMBEDDING_MODELS = {
+    model.name: model for model in [
+        EmbeddingModel('vertex', 'vertex', "...", label='Vertex AI', column='embeddings'),
+        EmbeddingModel('openai', 'openai', 'text-embedding-3-large', label='OpenAI',
+                       column='openai_embeddings', max_characters=8000, batch_size=64),
+        EmbeddingModel('vertex_large_instruct', 'vertex', "...", label='Vertex AI Large Instruct',
+                       column='embeddings_large_instruct'),
+    ]
+}
+
+if EMBEDDING_MODELS_CONFIG:
+    with open(EMBEDDING_MODELS_CONFIG) as file:
+        for definition in json.load(file):
+            model = EmbeddingModel(**definition)
+            EMBEDDING_MODELS[model.name] = model
+
+
+def get_model(name):
+    """
+    Returns a registered model.
+
+    Raises:
+        KeyError: If no model has that name.
+    """
+    try:
+        return EMBEDDING_MODELS[name]
+    except KeyError:
+        raise KeyError(f"Unknown embedding model {name!r}; registered: {', '.join(EMBEDDING_MODELS)}") from None
+
+
+def configured_models(variable, default):
+    """
+    Reads a comma-separated list of model names from an environment variable.
+
+    Args:
+        variable (str): Environment variable name.
+        default (tuple of str): Names used when the variable is unset.
+
+    Returns:
+        tuple of str: Registered model names, in the configured order.
+    """
+    value = os.getenv(variable)
+    names = tuple(name.strip() for name in value.split(',') if name.strip()) if value else tuple(default)
+    for name in names:
+        get_model(name)
+    return names
+
+
+_endpoints = {}
+_endpoints_lock = threading.Lock()
+
+
+def _endpoint(model):
+    from google.cloud import aiplatform
+
+    with _endpoints_lock:
+        if model.model_id not in _endpoints:
+            _endpoints[model.model_id] = aiplatform.Endpoint(endpoint_name=model.model_id)
+        return _endpoints[model.model_id]
+
+
+def clean_text(text, max_characters):
+    """
+    Applies the pipelines' input cleaning: NaN and blank texts become '',
+    others are truncated and whitespace-collapsed.
+    """
+    text = str(text).strip()
+    if text == '' or text.lower() == 'nan':
+        return ''
+    return ' '.join(text[:max_characters].split())
+
+
+def embed_documents(model, texts, cache=None):
+    """
+    Embeds entity documents (business summaries, indicator descriptions) with
+    one registered model, through the shared embedding cache.
+
+    Args:
+        model (EmbeddingModel): Model to use.
+        texts (list of str): Raw texts; they are cleaned here.
+        cache (EmbeddingCache, optional): Defaults to the process-wide cache.
+
+    Returns:
+        list: One flat float32 vector per text, or None for empty texts.
+
+    Raises:
+        Exception: The provider's error, if a request failed.
+    """
+    if cache is None:
+        from embedding_cache import get_embedding_cache
+        cache = get_embedding_cache()
+
+    cleaned = [clean_text(text, model.max_characters) for text in texts]
+    present = [i for i, text in enumerate(cleaned) if text]
+
+    if model.provider == 'vertex':
+        def compute(missing):
+            return get_limiter('vertex').call(_endpoint(model).predict, instances=[{"inputs": text} for text in missing]).predictions
+    else:
+        def compute(missing):
+            import openai
+            response = get_limiter('openai').call(openai.embeddings.create, input=missing, model=model.model_id)
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+    results = [None] * len(texts)
+    for start in range(0, len(present), model.batch_size):
+        chunk = present[start:start + model.batch_size]
+        vectors = cache.get_or_compute_many(model.cache_key, [cleaned[i] for i in chunk], compute)
+        for i, vector in zip(chunk, vectors):
+            # Vertex AI endpoints answer with one nested list per input
+            results[i] = np.asarray(vector, dtype=np.float32).ravel() if vector is not None else None
+    return results
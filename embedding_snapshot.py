@@ -0,0 +1,619 @@
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import numpy as np
+from datetime import datetime, timezone
+from google.cloud import bigquery
+from similarity import SimilarityIndex, normalize_rows
+from entity_matcher import EntityMatcher, BM25Index
+from ann_index import MIN_ANN_UNIVERSE, ANN_METADATA_FILE, IVFIndex
+from quantization import save_quantized, load_quantized
+from reduced_index import ReducedIndex, reduction_for
+from local_embeddings import get_local_embedder
+from embedding_storage import has_vector_columns, vector_select, decode_vectors, read_store_vectors
+from embedding_models import get_model, configured_models
+
+# -------------------- Configuration --------------------
+
+# Local directory holding the versioned snapshots
+SNAPSHOT_DIR = os.getenv('EMBEDDING_SNAPSHOT_DIR', 'snapshots/stocks')
+
+# Source table for the ticker universe
+PROJECT_ID = 'test1-427219'
+STOCKS_TABLE_ID = f"{PROJECT_ID}.stock_datasets.stocks"
+
+# Long-format embedding store, one row per (ticker, model, model_version)
+EMBEDDING_STORE_TABLE_ID = f"{PROJECT_ID}.stock_datasets.entity_embeddings"
+
+# Snapshot model name -> embedding column in the stocks table, for the
+# registered models (embedding_models.py) listed in SNAPSHOT_MODELS. Models
+# without a column are read from EMBEDDING_STORE_TABLE_ID.
+SNAPSHOT_MODELS = {
+    name: get_model(name).column
+    for name in configured_models('SNAPSHOT_MODELS', ('vertex', 'openai', 'vertex_large_instruct'))
+}
+
+# Snapshot model embedded locally from long_business_summary when a local
+# backend is installed; it has no column in the stocks table
+LOCAL_MODEL = 'local'
+
+# Number of old versions kept on disk for processes still mapping them
+KEEP_VERSIONS = 3
+
+CURRENT_FILE = 'CURRENT'
+METADATA_FILE = 'metadata.json'
+SUMMARIES_FILE = 'summaries.json'
+
+# -------------------------------------------------------
+
+
+class EmbeddingSnapshot:
+    """
+    A read-only, memory-mapped version of the stocks embedding table.
+
+    Each model is stored as a ``.npy`` file of unit-length float32 rows in the
+    same ticker order, so every process on the host shares the same pages
+    through the OS page cache.
+    """
+
+    def __init__(self, path, metadata, matrices):
+        self.path = path
+        self.version = metadata['version']
+        self.tickers = metadata['tickers']
+        self.names = metadata['names']
+        self.sectors = metadata['sectors']
+        self.fingerprints = metadata['fingerprints']
+        self.local_model = metadata.get('local_model')
+        self.matrices = matrices
+        self._indexes = {}
+        self._summaries = None
+
+    @classmethod
+    def load(cls, path):
+        """
+        Maps a snapshot version directory into memory.
+
+        Args:
+            path (str): Path of a single version directory.
+
+        Returns:
+            EmbeddingSnapshot: The mapped snapshot.
+        """
+        with open(os.path.join(path, METADATA_FILE), 'r') as file:
+            metadata = json.load(file)
+        matrices = {
+            model: np.load(os.path.join(path, f"{model}.npy"), mmap_mode='r')
+            for model in metadata['models']
+        }
+        logging.info(f"Loaded embedding snapshot {metadata['version']} with {len(metadata['tickers'])} tickers")
+        return cls(path, metadata, matrices)
+
+    def __len__(self):
+        return len(self.tickers)
+
+    @property
+    def summaries(self):
+        """
+        Long business summaries in ticker order, read on first use.
+
+        Snapshots written before summaries were stored return empty strings.
+        """
+        if self._summaries is None:
+            try:
+                with open(os.path.join(self.path, SUMMARIES_FILE), 'r') as file:
+                    self._summaries = json.load(file)
+            except FileNotFoundError:
+                self._summaries = [''] * len(self.tickers)
+        return self._summaries
+
+    def entity_matcher(self):
+        """
+        Returns the company-name and ticker mention matcher for this version.
+
+        Returns:
+            EntityMatcher: The matcher.
+        """
+        if 'entities' not in self._indexes:
+            self._indexes['entities'] = EntityMatcher(self.tickers, self.names)
+        return self._indexes['entities']
+
+    def lexical_index(self):
+        """
+        Returns the BM25 index over the business summaries for this version.
+
+        Returns:
+            BM25Index: The index.
+        """
+        if 'bm25' not in self._indexes:
+            self._indexes['bm25'] = BM25Index(self.tickers, self.summaries)
+        return self._indexes['bm25']
+
+    def index(self, model):
+        """
+        Returns a SimilarityIndex over one model's matrix without copying it.
+
+        Args:
+            model (str): A key of SNAPSHOT_MODELS.
+
+        Returns:
+            SimilarityIndex: The index for that model.
+        """
+        if model not in self._indexes:
+            self._indexes[model] = SimilarityIndex(self.tickers, self.matrices[model], normalized=True)
+        return self._indexes[model]
+
+    def quantized_index(self, model, mode='int8'):
+        """
+        Returns an int8 or binary first-stage index that rescores its shortlist
+        against this snapshot's float32 rows.
+
+        Args:
+            model (str): A key of SNAPSHOT_MODELS.
+            mode (str): 'int8' or 'binary'.
+
+        Returns:
+            QuantizedIndex: The index.
+        """
+        key = (mode, model)
+        if key not in self._indexes:
+            self._indexes[key] = load_quantized(self.path, model, self.tickers, self.matrices[model], mode)
+        return self._indexes[key]
+
+    def reduced_index(self, model):
+        """
+        Returns a reduced-dimension first-stage index for one model, building
+        and saving it into the version directory the first time it is needed.
+
+        Args:
+            model (str): A snapshot model; see reduced_index.reduction_for.
+
+        Returns:
+            ReducedIndex: The index.
+        """
+        key = ('reduced', model)
+        if key not in self._indexes:
+            index = ReducedIndex.load(self.path, model, self.index(model))
+            if index is None:
+                method, dims = reduction_for(model)
+                index = ReducedIndex.build(self.index(model), method, dims)
+                index.save(self.path, model)
+            self._indexes[key] = index
+        return self._indexes[key]
+
+    def search_index(self, model, min_ann_universe=MIN_ANN_UNIVERSE):
+        """
+        Returns the index to use for a full-universe search with one model.
+
+        Small universes get the exact index. Larger ones get an IVF index that
+        is built once per snapshot version, saved next to the matrices and
+        memory-mapped by every other process.
+
+        Args:
+            model (str): A key of SNAPSHOT_MODELS.
+            min_ann_universe (int): Smallest universe that gets an IVF index.
+
+        Returns:
+            SimilarityIndex or IVFIndex: The index.
+        """
+        if len(self.tickers) < min_ann_universe:
+            return self.index(model)
+        key = ('ann', model)
+        if key not in self._indexes:
+            ann_dir = os.path.join(self.path, 'ann', model)
+            if not os.path.exists(os.path.join(ann_dir, ANN_METADATA_FILE)):
+                index = IVFIndex.build(self.tickers, self.matrices[model], normalized=True)
+                staging_dir = tempfile.mkdtemp(prefix='.staging-', dir=self.path)
+                index.save(staging_dir)
+                os.makedirs(os.path.dirname(ann_dir), exist_ok=True)
+                try:
+                    os.rename(staging_dir, ann_dir)
+                except OSError:
+                    # Another process published the same index first
+                    shutil.rmtree(staging_dir, ignore_errors=True)
+            self._indexes[key] = IVFIndex.load(ann_dir)
+        return self._indexes[key]
+
+
+def read_current_version(snapshot_dir=SNAPSHOT_DIR):
+    """
+    Reads the name of the active snapshot version.
+
+    Returns:
+        str or None: The version directory name, or None if no snapshot exists.
+    """
+    try:
+        with open(os.path.join(snapshot_dir, CURRENT_FILE), 'r') as file:
+            return file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def load_snapshot(snapshot_dir=SNAPSHOT_DIR):
+    """
+    Loads the active snapshot version.
+
+    Returns:
+        EmbeddingSnapshot or None: The snapshot, or None if none has been built.
+    """
+    version = read_current_version(snapshot_dir)
+    if version is None:
+        return None
+    return EmbeddingSnapshot.load(os.path.join(snapshot_dir, version))
+
+
+class SnapshotWatcher:
+    """
+    Hands out the active snapshot and swaps to a new version when the
+    ``CURRENT`` pointer changes, so a running loop never needs a restart.
+    """
+
+    def __init__(self, snapshot_dir=SNAPSHOT_DIR):
+        self.snapshot_dir = snapshot_dir
+        self.snapshot = None
+
+    def get(self):
+        """
+        Returns the active snapshot, reloading it if a newer version was published.
+
+        Returns:
+            EmbeddingSnapshot or None: The active snapshot.
+        """
+        version = read_current_version(self.snapshot_dir)
+        if version is None:
+            return self.snapshot
+        if self.snapshot is None or self.snapshot.version != version:
+            previous = self.snapshot.version if self.snapshot else None
+            self.snapshot = EmbeddingSnapshot.load(os.path.join(self.snapshot_dir, version))
+            if previous:
+                logging.info(f"Switched embedding snapshot from {previous} to {version}")
+        return self.snapshot
+
+
+def _parse_embedding(value):
+    if not value:
+        return None
+    return np.asarray(json.loads(value), dtype=np.float32).ravel()
+
+
+def fetch_fingerprints(client):
+    """
+    Fetches one fingerprint per ticker covering its embeddings, name, sector and summary.
+
+    Only integers cross the wire, so comparing against the local snapshot is cheap.
+
+    Returns:
+        dict: Ticker -> fingerprint, in ticker order.
+    """
+    columns = "".join(f"IFNULL({column}, ''), '|', " for column in _column_models().values())
+    store_models = _store_models()
+    store_join = store_state = ""
+    if store_models:
+        # Stored vectors count through their write time, so a re-embedded model refreshes its rows
+        versions = " OR ".join(f"(model = '{model.name}' AND model_version = '{model.version}')" for model in store_models)
+        store_join = f"""
+    LEFT JOIN (
+        SELECT entity, STRING_AGG(CONCAT(model, ':', CAST(UNIX_MICROS(updated_at) AS STRING)), ',' ORDER BY model) AS state
+        FROM `{EMBEDDING_STORE_TABLE_ID}`
+        WHERE {versions}
+        GROUP BY entity
+    ) store ON store.entity = stocks.ticker"""
+        store_state = "'|', IFNULL(store.state, ''), "
+    query = f"""
+    SELECT ticker,
+           FARM_FINGERPRINT(CONCAT({columns}{store_state}IFNULL(name, ''), '|', IFNULL(sector, ''),
+                             '|', IFNULL(long_business_summary, ''))) AS fingerprint
+    FROM `{STOCKS_TABLE_ID}` stocks{store_join}
+    WHERE ticker IS NOT NULL
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY ticker ORDER BY row) = 1
+    ORDER BY ticker
+    """
+    return {row.ticker: row.fingerprint for row in client.query(query)}
+
+
+def _column_models():
+    return {model: column for model, column in SNAPSHOT_MODELS.items() if column}
+
+
+def _store_models():
+    return [get_model(model) for model, column in SNAPSHOT_MODELS.items() if not column]
+
+
+def _add_store_vectors(client, rows):
+    for model in _store_models():
+        vectors = read_store_vectors(client, EMBEDDING_STORE_TABLE_ID, model, rows)
+        for ticker, entry in rows.items():
+            entry[model.name] = vectors.get(ticker)
+    return rows
+
+
+def fetch_rows(client, tickers):
+    """
+    Fetches and parses the embedding rows for the given tickers.
+
+    Reads the native array columns through Arrow once the table has been
+    migrated (see embedding_storage.py), and the JSON columns otherwise.
+
+    Returns:
+        dict: Ticker -> dict with 'name', 'sector', 'summary' and one parsed vector per model.
+    """
+    if has_vector_columns(client, STOCKS_TABLE_ID, tuple(_column_models().values())):
+        return _add_store_vectors(client, fetch_rows_arrow(client, tickers))
+
+    columns = "".join(f", {column}" for column in _column_models().values())
+    query = f"""
+    SELECT ticker, name, sector, long_business_summary{columns}
+    FROM `{STOCKS_TABLE_ID}`
+    WHERE ticker IN UNNEST(@tickers)
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY ticker ORDER BY row) = 1
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter("tickers", "STRING", list(tickers))]
+    )
+    rows = {}
+    for row in client.query(query, job_config=job_config):
+        entry = {'name': row.name, 'sector': row.sector, 'summary': row.long_business_summary or ''}
+        for model, column in _column_models().items():
+            try:
+                entry[model] = _parse_embedding(row[column])
+            except (ValueError, TypeError) as e:
+                logging.warning(f"Could not parse {column} for {row.ticker}: {e}")
+                entry[model] = None
+        rows[row.ticker] = entry
+    return _add_store_vectors(client, rows)
+
+
+def fetch_rows_arrow(client, tickers):
+    """
+    Bulk-reads the embedding rows for the given tickers as Arrow and decodes
+    each model into one matrix, without parsing vectors row by row.
+
+    Returns:
+        dict: Same shape as fetch_rows().
+    """
+    vectors = vector_select(_column_models().values())
+    query = f"""
+    SELECT ticker, name, sector, long_business_summary{',' if vectors else ''}
+           {vectors}
+    FROM `{STOCKS_TABLE_ID}`
+    WHERE ticker IN UNNEST(@tickers)
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY ticker ORDER BY row) = 1
+    """
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ArrayQueryParameter("tickers", "STRING", list(tickers))]
+    )
+    table = client.query(query, job_config=job_config).to_arrow(create_bqstorage_client=True)
+    matrices = {model: decode_vectors(table, column) for model, column in _column_models().items()}
+    present = {model: np.any(matrix != 0, axis=1) for model, matrix in matrices.items()}
+
+    columns = table.select(['ticker', 'name', 'sector', 'long_business_summary']).to_pydict()
+    rows = {}
+    for i, ticker in enumerate(columns['ticker']):
+        entry = {
+            'name': columns['name'][i],
+            'sector': columns['sector'][i],
+            'summary': columns['long_business_summary'][i] or '',
+        }
+        for model, matrix in matrices.items():
+            entry[model] = matrix[i] if present[model][i] else None
+        rows[ticker] = entry
+    return rows
+
+
+def _claim_version(snapshot_dir):
+    # os.mkdir fails if the directory exists, so two concurrent refreshes never
+    # get the same version; the loser moves on to the next number.
+    while True:
+        versions = [name for name in os.listdir(snapshot_dir) if name.startswith('v') and name[1:].isdigit()]
+        version = f"v{max((int(name[1:]) for name in versions), default=0) + 1:06d}"
+        try:
+            os.mkdir(os.path.join(snapshot_dir, version))
+            return version
+        except FileExistsError:
+            continue
+
+
+def _publish(snapshot_dir, version):
+    current = read_current_version(snapshot_dir)
+    if current is not None and current > version:
+        # A concurrent refresh already published a newer version
+        logging.info(f"Not publishing {version}: {current} is newer")
+        return
+    descriptor, pointer_tmp = tempfile.mkstemp(prefix=f".{CURRENT_FILE}.", dir=snapshot_dir)
+    with os.fdopen(descriptor, 'w') as file:
+        file.write(version)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(pointer_tmp, os.path.join(snapshot_dir, CURRENT_FILE))
+
+
+def _prune(snapshot_dir, keep=KEEP_VERSIONS):
+    versions = sorted(name for name in os.listdir(snapshot_dir) if name.startswith('v') and name[1:].isdigit())
+    for name in versions[:-keep]:
+        # Processes still mapping an old version keep their pages until they swap.
+        shutil.rmtree(os.path.join(snapshot_dir, name), ignore_errors=True)
+
+
+def build_matrix(tickers, fresh_rows, previous, model):
+    """
+    Assembles one model's normalized matrix, reusing unchanged rows from the
+    previous snapshot and parsed vectors for changed ones.
+
+    Rows with no usable vector are stored as zeros and therefore score 0.
+    The width comes from the fresh rows when any has a vector; previous rows
+    are reused only when their width matches, so a model that was added (and
+    was all NULL, 0 wide, in the previous version) fills in as it is backfilled.
+    """
+    old_positions = {ticker: i for i, ticker in enumerate(previous.tickers)} if previous else {}
+    old_matrix = previous.matrices.get(model) if previous is not None else None
+    dimension = None
+    for entry in fresh_rows.values():
+        if entry[model] is not None:
+            dimension = entry[model].shape[0]
+            break
+    if dimension is None and old_matrix is not None and old_matrix.shape[1]:
+        dimension = old_matrix.shape[1]
+    if dimension is None:
+        return np.zeros((len(tickers), 0), dtype=np.float32)
+    if old_matrix is not None and old_matrix.shape[1] != dimension:
+        if old_matrix.shape[1]:
+            logging.warning(f"Dropping previous {model} rows: {old_matrix.shape[1]} dimensions, now {dimension}")
+        old_matrix = None
+
+    matrix = np.zeros((len(tickers), dimension), dtype=np.float32)
+    for i, ticker in enumerate(tickers):
+        if ticker in fresh_rows:
+            vector = fresh_rows[ticker][model]
+            if vector is None:
+                continue
+            if vector.shape[0] != dimension:
+                logging.warning(f"Skipping {model} vector for {ticker}: {vector.shape[0]} dimensions, expected {dimension}")
+                continue
+            matrix[i] = vector
+        elif old_matrix is not None:
+            matrix[i] = old_matrix[old_positions[ticker]]
+    return normalize_rows(matrix)
+
+
+def build_local_matrix(tickers, summaries, fresh_tickers, previous, embedder):
+    """
+    Assembles the locally embedded matrix, embedding only the summaries of
+    changed tickers when the previous version used the same local model.
+    """
+    dimension = embedder.dimension
+    reuse = (previous is not None and LOCAL_MODEL in previous.matrices and previous.local_model == embedder.model_id
+             and previous.matrices[LOCAL_MODEL].shape[1] == dimension)
+    targets = [i for i, ticker in enumerate(tickers) if not reuse or ticker in fresh_tickers]
+
+    matrix = np.zeros((len(tickers), dimension), dtype=np.float32)
+    if reuse:
+        old_positions = {ticker: i for i, ticker in enumerate(previous.tickers)}
+        for i, ticker in enumerate(tickers):
+            if ticker not in fresh_tickers:
+                matrix[i] = previous.matrices[LOCAL_MODEL][old_positions[ticker]]
+    if targets:
+        matrix[targets] = embedder.embed([summaries[i] for i in targets])
+    logging.info(f"Embedded {len(targets)} business summaries with local model {embedder.model_id}")
+    return normalize_rows(matrix)
+
+
+def refresh_snapshot(client, snapshot_dir=SNAPSHOT_DIR, local_embedder=None):
+    """
+    Brings the local snapshot up to date with the stocks table.
+
+    Only tickers whose fingerprint changed are fetched and parsed; everything
+    else is copied from the previous version. A new version is written to a
+    temporary directory and published by atomically replacing ``CURRENT``.
+
+    Args:
+        client (bigquery.Client): BigQuery client.
+        snapshot_dir (str): Root directory for snapshot versions.
+        local_embedder (LocalEmbedder, optional): Embedder for the local model.
+            Defaults to the process-wide one if a local backend is installed.
+
+    Returns:
+        str: The active version after the refresh.
+    """
+    local_embedder = local_embedder or get_local_embedder()
+    os.makedirs(snapshot_dir, exist_ok=True)
+    previous = load_snapshot(snapshot_dir)
+
+    fingerprints = fetch_fingerprints(client)
+    tickers = list(fingerprints)
+    old_fingerprints = dict(zip(previous.tickers, previous.fingerprints)) if previous else {}
+    if previous is not None and set(previous.matrices) - {LOCAL_MODEL} != set(SNAPSHOT_MODELS):
+        # The model set changed, so no stored row can be reused.
+        previous, old_fingerprints = None, {}
+    changed = [ticker for ticker in tickers if old_fingerprints.get(ticker) != fingerprints[ticker]]
+    removed = set(old_fingerprints) - set(fingerprints)
+
+    local_stale = local_embedder is not None and (previous is None or previous.local_model != local_embedder.model_id)
+
+    if previous is not None and not changed and not removed and not local_stale:
+        logging.info(f"Embedding snapshot {previous.version} is up to date")
+        return previous.version
+
+    logging.info(f"Refreshing embedding snapshot: {len(changed)} changed, {len(removed)} removed")
+    fresh_rows = fetch_rows(client, changed) if changed else {}
+    old_positions = {ticker: i for i, ticker in enumerate(previous.tickers)} if previous else {}
+    # Tickers that disappeared between the two queries are dropped from this version.
+    tickers = [ticker for ticker in tickers if ticker in fresh_rows or ticker in old_positions]
+
+    def field(ticker, name, values):
+        if ticker in fresh_rows:
+            return fresh_rows[ticker][name]
+        return values[old_positions[ticker]]
+
+    metadata = {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'source_table': STOCKS_TABLE_ID,
+        'models': list(SNAPSHOT_MODELS),
+        'tickers': tickers,
+        'names': [field(ticker, 'name', previous.names if previous else []) for ticker in tickers],
+        'sectors': [field(ticker, 'sector', previous.sectors if previous else []) for ticker in tickers],
+        'fingerprints': [fingerprints[ticker] for ticker in tickers],
+    }
+    summaries = [field(ticker, 'summary', previous.summaries if previous else []) for ticker in tickers]
+    if local_embedder is not None:
+        metadata['models'].append(LOCAL_MODEL)
+        metadata['local_model'] = local_embedder.model_id
+
+    staging_dir = tempfile.mkdtemp(prefix='.staging-', dir=snapshot_dir)
+    version_dir = None
+    try:
+        for model in SNAPSHOT_MODELS:
+            matrix = build_matrix(tickers, fresh_rows, previous, model)
+            np.save(os.path.join(staging_dir, f"{model}.npy"), matrix)
+            save_quantized(staging_dir, model, matrix)
+        if local_embedder is not None:
+            matrix = build_local_matrix(tickers, summaries, set(fresh_rows), previous, local_embedder)
+            np.save(os.path.join(staging_dir, f"{LOCAL_MODEL}.npy"), matrix)
+        # Claimed only once the matrices are built, so concurrent refreshes
+        # finish in version order as far as possible
+        version = _claim_version(snapshot_dir)
+        version_dir = os.path.join(snapshot_dir, version)
+        metadata['version'] = version
+        with open(os.path.join(staging_dir, METADATA_FILE), 'w') as file:
+            json.dump(metadata, file)
+        with open(os.path.join(staging_dir, SUMMARIES_FILE), 'w') as file:
+            json.dump(summaries, file)
+        # Replaces the empty directory claimed above
+        os.replace(staging_dir, version_dir)
+    except Exception:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        if version_dir is not None:
+            shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+
+    _publish(snapshot_dir, version)
+    _prune(snapshot_dir)
+    logging.info(f"Published embedding snapshot {version} with {len(tickers)} tickers")
+    return version
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or refresh the local embedding snapshot.")
+    parser.add_argument('--snapshot-dir', default=SNAPSHOT_DIR)
+    parser.add_argument('--watch', type=int, default=0,
+                        help="Refresh every N seconds instead of once")
+    args = parser.parse_args()
+
+    client = bigquery.Client(project=PROJECT_ID)
+    while True:
+        try:
+            refresh_snapshot(client, args.snapshot_dir)
+        except Exception as e:
+            logging.error(f"Error refreshing embedding snapshot: {e}")
+            if not args.watch:
+                raise
+        if not args.watch:
+            break
+        time.sleep(args.watch)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
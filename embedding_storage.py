@@ -0,0 +1,468 @@
+import json
+import time
+import hashlib
+import logging
+import argparse
+import threading
+import numpy as np
+from embedding_cache import text_key
+
+# -------------------- Configuration --------------------
+
+# JSON embedding columns of the stocks tables (see DESTINATION_SCHEMA in
+# embedsticks.py and biotechstocks.py)
+EMBEDDING_COLUMNS = ('embeddings', 'embeddings_large', 'openai_embeddings', 'embeddings_large_instruct')
+
+# Native ARRAY<FLOAT64> column kept next to each JSON column
+VECTOR_SUFFIX = '_vec'
+
+# Stocks-table column holding the content fingerprint of the summary the
+# embeddings in that row were built from
+FINGERPRINT_COLUMN = 'embeddings_fingerprint'
+
+# Seconds a table's array-column check is reused before its schema is read again,
+# so a long-running process picks up a migration done by another one
+VECTOR_COLUMNS_TTL = 300
+
+# -------------------------------------------------------
+
+
+def content_fingerprint(text):
+    """
+    Fingerprints the text a vector is built from, with the same whitespace
+    normalization as the embedding cache, so cosmetic edits do not count as changes.
+
+    Returns:
+        str: Hex digest, or None for missing or blank text.
+    """
+    if text is None or not str(text).strip():
+        return None
+    return text_key(text).hex()
+
+
+def article_key(content):
+    """
+    Returns the side-store key of an article: the SHA-256 hex digest of its
+    content exactly as stored in the predictions table. Unlike article ids,
+    which were random and collide, it is the same for every row holding the
+    same article, and BigQuery computes it as ARTICLE_KEY_SQL.
+    """
+    return hashlib.sha256(str(content).encode('utf-8')).hexdigest()
+
+
+# article_key() of a predictions row, in BigQuery SQL (content is a repeated field)
+ARTICLE_KEY_SQL = "TO_HEX(SHA256(p.content[SAFE_OFFSET(0)]))"
+
+
+def vector_column(column):
+    """
+    Returns the native array column paired with a JSON embedding column.
+    """
+    return f"{column}{VECTOR_SUFFIX}"
+
+
+def vector_values(embedding):
+    """
+    Flattens an embedding (list, nested list such as a Vertex AI prediction,
+    JSON string or numpy array) into the float list written to an array column.
+
+    Returns:
+        list of float: The values, or an empty list for a missing embedding.
+    """
+    if embedding is None or (isinstance(embedding, str) and not embedding.strip()):
+        return []
+    if isinstance(embedding, str):
+        embedding = json.loads(embedding)
+    return np.asarray(embedding, dtype=np.float64).ravel().tolist()
+
+
+_vector_columns = {}
+_vector_columns_lock = threading.Lock()
+
+
+def has_vector_columns(client, table_id, columns, ttl=VECTOR_COLUMNS_TTL):
+    """
+    Returns True if the table already has the array column for every given JSON column.
+
+    The answer is reused for ``ttl`` seconds per table and column set.
+
+    Args:
+        client (bigquery.Client): BigQuery client.
+        table_id (str): Fully qualified table id.
+        columns (tuple of str): JSON embedding columns.
+        ttl (float): Seconds a previous answer stays valid.
+    """
+    key = (table_id, tuple(columns))
+    now = time.monotonic()
+    with _vector_columns_lock:
+        cached = _vector_columns.get(key)
+    if cached is not None and now - cached[1] < ttl:
+        return cached[0]
+    fields = {field.name for field in client.get_table(table_id).schema}
+    present = all(vector_column(column) in fields for column in columns)
+    with _vector_columns_lock:
+        _vector_columns[key] = (present, now)
+    return present
+
+
+def clear_vector_columns_cache():
+    """
+    Forgets every has_vector_columns() answer, e.g. right after a migration.
+    """
+    with _vector_columns_lock:
+        _vector_columns.clear()
+
+
+def vector_select(columns):
+    """
+    Builds the SELECT list for a bulk read of embedding columns.
+
+    Each array column is read as is. The JSON column is only returned for rows
+    whose array is still empty (written by a writer that has not switched yet),
+    so migrated rows transfer no text.
+    """
+    return ",\n           ".join(
+        f"{vector_column(column)}, IF(ARRAY_LENGTH({vector_column(column)}) = 0, {column}, NULL) AS {column}"
+        for column in columns
+    )
+
+
+def _parse_fallback(value):
+    if not value:
+        return None
+    return np.asarray(json.loads(value), dtype=np.float32).ravel()
+
+
+def _list_matrix(array, fallback=None, name='vector'):
+    """
+    Turns an Arrow list<double> array into a float32 matrix by reshaping its
+    flat value buffer, filling empty rows from ``fallback`` (row -> vector).
+    """
+    n = len(array)
+    offsets = np.asarray(array.offsets)
+    lengths = np.diff(offsets)
+    values = array.values.to_numpy(zero_copy_only=False)[offsets[0]:offsets[-1]]
+    fallback = fallback or {}
+
+    present = lengths[lengths > 0]
+    if len(present):
+        dim = int(np.bincount(present).argmax())
+    elif fallback:
+        dim = next(iter(fallback.values())).shape[0]
+    else:
+        return np.zeros((n, 0), dtype=np.float32)
+
+    matrix = np.zeros((n, dim), dtype=np.float32)
+    valid = lengths == dim
+    if valid.all():
+        matrix[:] = values.reshape(n, dim)
+    elif valid.any():
+        matrix[valid] = values[np.repeat(valid, lengths)].reshape(-1, dim)
+    if (~valid & (lengths > 0)).any():
+        logging.warning(f"{int((~valid & (lengths > 0)).sum())} {name} rows do not have {dim} values")
+    for i, vector in fallback.items():
+        if vector.shape[0] == dim:
+            matrix[i] = vector
+    return matrix
+
+
+def decode_vectors(table, column):
+    """
+    Decodes one embedding column of an Arrow table into a float32 matrix.
+
+    The array column's flat value buffer is reshaped directly, so there is no
+    per-row Python work for migrated rows. Rows with an empty array fall back
+    to parsing their JSON column; rows with neither, or with an unexpected
+    length, are zeros.
+
+    Args:
+        table (pyarrow.Table): Result of a query built with vector_select().
+        column (str): JSON embedding column name.
+
+    Returns:
+        numpy.ndarray: ``(rows, dim)`` float32 matrix.
+    """
+    array = table.column(vector_column(column)).combine_chunks()
+    fallback = {}
+    if column in table.column_names:
+        for i in np.flatnonzero(np.diff(np.asarray(array.offsets)) == 0):
+            vector = _parse_fallback(table.column(column)[int(i)].as_py())
+            if vector is not None:
+                fallback[int(i)] = vector
+    return _list_matrix(array, fallback, vector_column(column))
+
+
+def migration_statements(table_id, columns=EMBEDDING_COLUMNS):
+    """
+    Returns the SQL that adds the array columns and fills them from the JSON columns.
+
+    Nested Vertex AI predictions (``[[...]]``) are flattened. The JSON columns
+    are left in place until every reader has switched.
+    """
+    statements = [
+        f"ALTER TABLE `{table_id}` ADD COLUMN IF NOT EXISTS {vector_column(column)} ARRAY<FLOAT64>"
+        for column in columns
+    ]
+    assignments = ",\n        ".join(
+        f"""{vector_column(column)} = IF(
+            {column} IS NULL OR ARRAY_LENGTH({vector_column(column)}) > 0,
+            {vector_column(column)},
+            ARRAY(
+                SELECT CAST(value AS FLOAT64)
+                FROM UNNEST(IF(STARTS_WITH(LTRIM({column}), '[['),
+                               JSON_VALUE_ARRAY({column}, '$[0]'),
+                               JSON_VALUE_ARRAY({column}))) AS value WITH OFFSET AS position
+                ORDER BY position
+            ))"""
+        for column in columns
+    )
+    statements.append(f"""
+    UPDATE `{table_id}`
+    SET {assignments}
+    WHERE TRUE
+    """)
+    return statements
+
+
+def migrate_table(client, table_id, columns=EMBEDDING_COLUMNS):
+    """
+    Adds and backfills the array columns of one table.
+
+    Args:
+        client (bigquery.Client): BigQuery client.
+        table_id (str): Fully qualified table id.
+        columns (tuple of str): JSON embedding columns present in the table.
+    """
+    for statement in migration_statements(table_id, columns):
+        client.query(statement).result()
+    clear_vector_columns_cache()
+    logging.info(f"Migrated {', '.join(columns)} of {table_id} to array columns")
+
+
+def ensure_fingerprint_column(client, table_id):
+    """
+    Adds FINGERPRINT_COLUMN to a stocks table if it is missing. A NULL
+    fingerprint counts as stale, as in stale_entities(): rows written before the
+    column existed are re-embedded once, mostly from the embedding cache.
+    """
+    client.query(f"ALTER TABLE `{table_id}` ADD COLUMN IF NOT EXISTS {FINGERPRINT_COLUMN} STRING").result()
+
+
+def ensure_store(client, table_id):
+    """
+    Creates the long-format embedding store if it does not exist.
+
+    One row per (entity, model, model_version), with the vector as a native
+    float array, so adding a model adds rows instead of a column.
+    """
+    from google.cloud import bigquery
+    from google.api_core.exceptions import NotFound
+
+    try:
+        client.get_table(table_id)
+    except NotFound:
+        table = bigquery.Table(table_id, schema=[
+            bigquery.SchemaField("entity", "STRING", mode="REQUIRED"),
+            bigquery.SchemaField("model", "STRING", mode="REQUIRED"),
+            bigquery.SchemaField("model_version", "STRING", mode="REQUIRED"),
+            bigquery.SchemaField("vector", "FLOAT64", mode="REPEATED"),
+            bigquery.SchemaField("content_fingerprint", "STRING", mode="NULLABLE"),
+            bigquery.SchemaField("updated_at", "TIMESTAMP", mode="REQUIRED"),
+        ])
+        table.clustering_fields = ["model", "model_version", "entity"]
+        client.create_table(table)
+        logging.info(f"Created embedding store {table_id}")
+        return
+    # Stores created before vectors carried fingerprints
+    client.query(f"ALTER TABLE `{table_id}` ADD COLUMN IF NOT EXISTS content_fingerprint STRING").result()
+
+
+def stale_entities(client, store_table_id, source_query, model):
+    """
+    Finds the entities whose vector for a model version is missing, has no
+    fingerprint, or was built from different text than the entity has now.
+
+    Args:
+        client (bigquery.Client): BigQuery client.
+        store_table_id (str): Long-format store table id.
+        source_query (str): SQL returning one row per entity with columns
+            ``entity`` and ``text``.
+        model (EmbeddingModel): Registered model.
+
+    Returns:
+        list of tuple: ``(entity, text)`` pairs to embed.
+    """
+    from google.cloud import bigquery
+
+    query = f"""
+    WITH source AS ({source_query})
+    SELECT source.entity, source.text, store.content_fingerprint
+    FROM source
+    LEFT JOIN `{store_table_id}` store
+      ON store.entity = source.entity AND store.model = @model AND store.model_version = @model_version
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("model", "STRING", model.name),
+        bigquery.ScalarQueryParameter("model_version", "STRING", model.version),
+    ])
+    # Fingerprints are compared here rather than in SQL so they match content_fingerprint() exactly
+    return [
+        (row.entity, row.text) for row in client.query(query, job_config=job_config)
+        if row.content_fingerprint is None or row.content_fingerprint != content_fingerprint(row.text)
+    ]
+
+
+def store_entity_models(client, store_table_id, entities):
+    """
+    Returns the models that have vectors for any of the given entities, e.g.
+    to re-embed them once their text changed. The vectors stay in place until
+    they are rebuilt: their fingerprints no longer match, so stale_entities()
+    returns them, and readers keep a vector until the new one replaces it.
+
+    Returns:
+        list of str: Model names.
+    """
+    from google.cloud import bigquery
+    from google.api_core.exceptions import NotFound
+
+    if not entities:
+        return []
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter("entities", "STRING", list(entities)),
+    ])
+    try:
+        return [
+            row.model for row in client.query(
+                f"SELECT DISTINCT model FROM `{store_table_id}` WHERE entity IN UNNEST(@entities)",
+                job_config=job_config,
+            ).result()
+        ]
+    except NotFound:
+        return []
+
+
+def write_store_vectors(client, store_table_id, model, vectors):
+    """
+    Upserts vectors for one model version with one load job and one MERGE,
+    so writing the same batch twice leaves one row per entity.
+
+    Args:
+        client (bigquery.Client): BigQuery client.
+        store_table_id (str): Long-format store table id.
+        model (EmbeddingModel): Registered model the vectors belong to.
+        vectors (list of tuple): ``(entity, vector, text)`` triples; the text
+            the vector was built from is stored as its content fingerprint.
+    """
+    from google.cloud import bigquery
+
+    rows = [
+        {"entity": entity, "vector": vector_values(vector), "content_fingerprint": content_fingerprint(text)}
+        for entity, vector, text in vectors
+    ]
+    if not rows:
+        return
+    staging_table_id = f"{store_table_id}_staging_{model.name}"
+    load_config = bigquery.LoadJobConfig(
+        schema=[
+            bigquery.SchemaField("entity", "STRING", mode="REQUIRED"),
+            bigquery.SchemaField("vector", "FLOAT64", mode="REPEATED"),
+            bigquery.SchemaField("content_fingerprint", "STRING", mode="NULLABLE"),
+        ],
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+    )
+    client.load_table_from_json(rows, staging_table_id, job_config=load_config).result()
+    try:
+        merge_query = f"""
+        MERGE `{store_table_id}` T
+        USING `{staging_table_id}` S
+        ON T.entity = S.entity AND T.model = @model AND T.model_version = @model_version
+        WHEN MATCHED THEN UPDATE SET
+            vector = S.vector, content_fingerprint = S.content_fingerprint, updated_at = CURRENT_TIMESTAMP()
+        WHEN NOT MATCHED THEN
+            INSERT (entity, model, model_version, vector, content_fingerprint, updated_at)
+            VALUES (S.entity, @model, @model_version, S.vector, S.content_fingerprint, CURRENT_TIMESTAMP())
+        """
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("model", "STRING", model.name),
+            bigquery.ScalarQueryParameter("model_version", "STRING", model.version),
+        ])
+        client.query(merge_query, job_config=job_config).result()
+    finally:
+        client.delete_table(staging_table_id, not_found_ok=True)
+
+
+def store_rows(entity, vectors, text=None):
+    """
+    Builds long-format store rows for one entity, for streaming inserts of
+    append-only entities such as articles.
+
+    Args:
+        entity (str): Entity key, e.g. an article id.
+        vectors (dict): EmbeddingModel -> vector; None vectors are skipped.
+        text (str, optional): Text the vectors were built from.
+
+    Returns:
+        list of dict: Rows matching the store schema.
+    """
+    from datetime import datetime, timezone
+
+    now = datetime.now(timezone.utc).isoformat()
+    return [
+        {
+            "entity": str(entity),
+            "model": model.name,
+            "model_version": model.version,
+            "vector": vector_values(vector),
+            "content_fingerprint": content_fingerprint(text),
+            "updated_at": now,
+        }
+        for model, vector in vectors.items() if vector is not None
+    ]
+
+
+def read_store_vectors(client, store_table_id, model, entities):
+    """
+    Bulk-reads one model version's vectors for the given entities through Arrow.
+
+    Returns:
+        dict: Entity -> float32 vector, for the entities that have one.
+    """
+    from google.cloud import bigquery
+
+    query = f"""
+    SELECT entity, vector
+    FROM `{store_table_id}`
+    WHERE model = @model AND model_version = @model_version AND entity IN UNNEST(@entities)
+    """
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("model", "STRING", model.name),
+        bigquery.ScalarQueryParameter("model_version", "STRING", model.version),
+        bigquery.ArrayQueryParameter("entities", "STRING", list(entities)),
+    ])
+    table = client.query(query, job_config=job_config).to_arrow(create_bqstorage_client=True)
+    matrix = _list_matrix(table.column('vector').combine_chunks(), name=f"{model.name} store")
+    present = np.any(matrix != 0, axis=1)
+    return {entity: matrix[i] for i, entity in enumerate(table.column('entity').to_pylist()) if present[i]}
+
+
+def main():
+    from google.cloud import bigquery
+
+    parser = argparse.ArgumentParser(description="Add native array embedding columns to a stocks table.")
+    parser.add_argument('table_id', help="Fully qualified table id, e.g. project.stock_datasets.stocks")
+    parser.add_argument('--columns', nargs='+', default=list(EMBEDDING_COLUMNS))
+    parser.add_argument('--dry-run', action='store_true', help="Print the SQL instead of running it")
+    args = parser.parse_args()
+
+    if args.dry_run:
+        for statement in migration_statements(args.table_id, args.columns):
+            print(statement.strip() + ";\n")
+        return
+    client = bigquery.Client(project=args.table_id.split('.')[0])
+    migrate_table(client, args.table_id, args.columns)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
@@ -5,6 +5,17 @@ from google.cloud import bigquery
 from google.cloud import aiplatform
 from google.api_core.exceptions import NotFound
 import time
+import logging
+import argparse
+import concurrent.futures
+from embedding_cache import get_embedding_cache
+from backfill_runner import COMMIT_BATCH_SIZE, BackfillProvider, BackfillRunner
+from embedding_models import EMBEDDING_MODELS, get_model, configured_models, embed_documents
+from embedding_storage import (FINGERPRINT_COLUMN, content_fingerprint, ensure_fingerprint_column, ensure_store,
+                               has_vector_columns, stale_entities, store_entity_models, vector_column,
+                               vector_values, write_store_vectors)
+from biotechstocks import fetch_stock_info
+from rate_limiter import get_limiter
 
 # -------------------- Configuration --------------------
 
@@ -31,6 +42,9 @@ openai.api_key = os.getenv("OPENAI_API_KEY", "...")  # Ensure this API key is co
 # OpenAI Client for Embeddings (Migration)
 client = openai  # Using 'openai_client' to avoid confusion with 'bigquery_client'
 
+# Embedding cache shared with the other pipelines on this host
+embedding_cache = get_embedding_cache()
+
 # Destination Schema
 DESTINATION_SCHEMA = [
     bigquery.SchemaField("name", "STRING", mode="NULLABLE"),
@@ -41,6 +55,11 @@ DESTINATION_SCHEMA = [
     bigquery.SchemaField("embeddings_large", "STRING", mode="NULLABLE"),
     bigquery.SchemaField("openai_embeddings", "STRING", mode="NULLABLE"),
     bigquery.SchemaField("embeddings_large_instruct", "STRING", mode="NULLABLE"),
+    bigquery.SchemaField("embeddings_vec", "FLOAT64", mode="REPEATED"),
+    bigquery.SchemaField("embeddings_large_vec", "FLOAT64", mode="REPEATED"),
+    bigquery.SchemaField("openai_embeddings_vec", "FLOAT64", mode="REPEATED"),
+    bigquery.SchemaField("embeddings_large_instruct_vec", "FLOAT64", mode="REPEATED"),
+    bigquery.SchemaField("embeddings_fingerprint", "STRING", mode="NULLABLE"),
     bigquery.SchemaField("row", "INTEGER", mode="NULLABLE"),
 ]
 
@@ -48,6 +67,23 @@ DESTINATION_SCHEMA = [
 MAX_RETRIES = 3
 RETRY_DELAY = 2  # seconds
 
+# Bulk mode: registered models whose stocks-table columns it fills (all with a
+# column by default), and default batches in flight per provider
+BULK_MODELS = configured_models(
+    'BULK_MODELS', tuple(name for name, model in EMBEDDING_MODELS.items() if model.column)
+)
+EMBEDDING_WORKERS = 4
+
+# Staging table the bulk mode loads embeddings into before merging them
+STAGING_TABLE_ID = f"{FULL_TABLE_ID}_embedding_staging"
+
+# Long-format store, one row per (ticker, model, model_version)
+EMBEDDING_STORE_TABLE_ID = f"{PROJECT_ID}.{DATASET_ID}.entity_embeddings"
+
+# Refresh mode: concurrent Yahoo Finance lookups, and the table fresh summaries are staged in
+YFINANCE_WORKERS = 4
+SUMMARY_STAGING_TABLE_ID = f"{FULL_TABLE_ID}_summary_staging"
+
 # -------------------------------------------------------
 
 def generate_vertex_embeddings(text):
@@ -69,8 +105,11 @@ def generate_vertex_embeddings(text):
     cleaned_text = ' '.join(text[:max_characters].split())
     instances = [{"inputs": cleaned_text}]
     try:
-        response = vertex_endpoint.predict(instances=instances)
-        return response.predictions[0]
+        prediction = embedding_cache.get_or_compute(
+            f"vertex:{VERTEX_ENDPOINT_NAME}", cleaned_text,
+            lambda: get_limiter('vertex').call(vertex_endpoint.predict, instances=instances).predictions[0]
+        )
+        return prediction.tolist()
     except Exception as e:
         print(f"Error generating Vertex AI embeddings: {e}")
         return []
@@ -93,17 +132,320 @@ def generate_openai_embeddings(text):
     max_characters = 8000  # text-embedding-3-large can handle up to 8191 tokens
     cleaned_text = ' '.join(text[:max_characters].split())
     try:
-        response = client.embeddings.create(
-            input=cleaned_text,
-            model="text-embedding-3-large"
+        embedding = embedding_cache.get_or_compute(
+            "openai:text-embedding-3-large", cleaned_text,
+            lambda: get_limiter('openai').call(
+                client.embeddings.create,
+                input=cleaned_text,
+                model="text-embedding-3-large"
+            ).data[0].embedding
         )
-        embedding = response.data[0].embedding
-        return embedding
+        return embedding.tolist()
     except Exception as e:
         print(f"Error generating OpenAI embeddings: {e}")
         return []
 
 
+def _embed_with_retries(provider, embed_batch, texts, max_retries=MAX_RETRIES):
+    """
+    Embeds one batch, retrying the whole batch before giving up on it.
+
+    Returns:
+        list: One embedding (list of floats) per text, or None where it failed.
+    """
+    present = [i for i, text in enumerate(texts) if text]
+    results = [None] * len(texts)
+    if not present:
+        return results
+    for attempt in range(1, max_retries + 1):
+        try:
+            vectors = embed_batch([texts[i] for i in present])
+            for i, vector in zip(present, vectors):
+                results[i] = vector.tolist() if vector is not None else None
+            return results
+        except Exception as e:
+            print(f"Error generating {provider} embeddings for a batch of {len(present)} (Attempt {attempt}): {e}")
+            if attempt < max_retries:
+                time.sleep(RETRY_DELAY)
+    return results
+
+def generate_embeddings_batch(model, texts):
+    """
+    Batched embeddings for one registered model: one provider call per
+    ``model.batch_size`` inputs, through the shared embedding cache.
+
+    Returns:
+        list: One embedding per text, or None where it failed or the text was empty.
+    """
+    results = []
+    for start in range(0, len(texts), model.batch_size):
+        results.extend(_embed_with_retries(
+            model.label,
+            lambda chunk: embed_documents(model, chunk, embedding_cache),
+            texts[start:start + model.batch_size]
+        ))
+    return results
+
+def update_embeddings_bulk(vertex_workers=EMBEDDING_WORKERS, openai_workers=EMBEDDING_WORKERS,
+                           commit_batch_size=COMMIT_BATCH_SIZE, models=BULK_MODELS):
+    """
+    Bulk variant of update_embeddings_one_by_one().
+
+    Runs as a resumable backfill (backfill_runner.py): each provider embeds
+    provider-sized batches on its own worker pool, and every
+    ``commit_batch_size`` finished tickers are staged with a single load job,
+    applied with one MERGE and checked with one aggregate query. Committed
+    tickers are journaled, so a restarted run skips them. Tickers whose
+    embeddings failed keep their NULL columns and are picked up by the next run.
+
+    Besides rows with a missing embedding, rows whose stored
+    FINGERPRINT_COLUMN is NULL or no longer matches their summary are re-embedded.
+
+    Args:
+        vertex_workers (int): Vertex AI batches in flight at once.
+        openai_workers (int): OpenAI batches in flight at once.
+        commit_batch_size (int): Tickers per load + MERGE.
+        models (tuple of str): Registered models whose columns are filled.
+
+    Returns:
+        bool: True if every ticker was embedded and verified, False otherwise.
+    """
+    models = [get_model(name) for name in models]
+    columns = [model.column for model in models]
+    ensure_fingerprint_column(bigquery_client, FULL_TABLE_ID)
+    query = f"""
+    SELECT ticker, ANY_VALUE(long_business_summary) AS long_business_summary,
+           ANY_VALUE({FINGERPRINT_COLUMN}) AS fingerprint,
+           LOGICAL_OR({' OR '.join(f"{column} IS NULL" for column in columns)}) AS missing
+    FROM `{FULL_TABLE_ID}`
+    WHERE ticker IS NOT NULL
+    GROUP BY ticker
+    """
+    # A NULL fingerprint is stale, as in embedding_storage.stale_entities(); the
+    # embedding cache answers unchanged summaries without a provider call
+    rows = [
+        row for row in bigquery_client.query(query).result()
+        if row['missing'] or row['fingerprint'] is None
+        or row['fingerprint'] != content_fingerprint(row['long_business_summary'])
+    ]
+    if not rows:
+        print("No tickers need embeddings.")
+        return True
+    print(f"Generating {', '.join(model.label for model in models)} embeddings for {len(rows)} tickers.")
+
+    write_vectors = has_vector_columns(bigquery_client, FULL_TABLE_ID, tuple(columns))
+    summaries = {row['ticker']: row['long_business_summary'] for row in rows}
+
+    def commit(batch):
+        staged = []
+        for ticker, results in batch:
+            row = {"ticker": ticker, FINGERPRINT_COLUMN: content_fingerprint(summaries[ticker])}
+            for model in models:
+                vector = results[model.name]
+                row[model.column] = json.dumps(vector) if vector is not None else None
+                if write_vectors:
+                    row[vector_column(model.column)] = vector_values(vector)
+            staged.append(row)
+        if not merge_staged_embeddings(staged, columns, write_vectors):
+            raise RuntimeError("merged embeddings did not verify")
+
+    workers = {'vertex': vertex_workers, 'openai': openai_workers}
+    runner = BackfillRunner(
+        "embedsticks",
+        [
+            BackfillProvider(model.name, lambda texts, model=model: generate_embeddings_batch(model, texts),
+                             workers[model.provider], model.batch_size, model=model.cache_key)
+            for model in models
+        ],
+        commit,
+        commit_batch_size=commit_batch_size,
+    )
+    stats = runner.run([(row['ticker'], row['long_business_summary']) for row in rows])
+    if stats['failed']:
+        print(f"{stats['failed']} tickers were not fully embedded and will be retried on the next run.")
+    return not stats['failed']
+
+def merge_staged_embeddings(staged, columns, write_vectors):
+    """
+    Loads staged embedding rows into the staging table, merges them into the
+    stocks table and verifies the result with one aggregate query.
+
+    Args:
+        staged (list of dict): Rows with 'ticker' and the embedding columns to set.
+        columns (list of str): JSON embedding columns the rows carry.
+        write_vectors (bool): Whether the rows carry the native array columns.
+
+    Returns:
+        bool: True if every staged ticker now has the embeddings it was given.
+    """
+    staging_schema = [bigquery.SchemaField("ticker", "STRING", mode="REQUIRED")]
+    staging_schema += [bigquery.SchemaField(column, "STRING", mode="NULLABLE") for column in columns]
+    staging_schema.append(bigquery.SchemaField(FINGERPRINT_COLUMN, "STRING", mode="NULLABLE"))
+    vector_assignments = ""
+    if write_vectors:
+        staging_schema += [
+            bigquery.SchemaField(vector_column(column), "FLOAT64", mode="REPEATED") for column in columns
+        ]
+        vector_assignments = "".join(
+            f""",
+            {vector_column(column)} = IF(S.{column} IS NULL, T.{vector_column(column)}, S.{vector_column(column)})"""
+            for column in columns
+        )
+    column_assignments = ",".join(f"""
+            {column} = IFNULL(S.{column}, T.{column})""" for column in columns)
+
+    load_config = bigquery.LoadJobConfig(
+        schema=staging_schema,
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+    )
+    bigquery_client.load_table_from_json(staged, STAGING_TABLE_ID, job_config=load_config).result()
+    print(f"Staged {len(staged)} tickers in {STAGING_TABLE_ID}.")
+
+    try:
+        merge_query = f"""
+        MERGE `{FULL_TABLE_ID}` T
+        USING `{STAGING_TABLE_ID}` S
+        ON T.ticker = S.ticker
+        WHEN MATCHED THEN UPDATE SET{column_assignments},
+            -- The fingerprint only moves once every vector was rebuilt from the new text
+            {FINGERPRINT_COLUMN} = IF({' AND '.join(f"S.{column} IS NOT NULL" for column in columns)},
+                                      S.{FINGERPRINT_COLUMN}, T.{FINGERPRINT_COLUMN}){vector_assignments}
+        """
+        merge_job = bigquery_client.query(merge_query)
+        merge_job.result()
+        print(f"Merged embeddings into {merge_job.num_dml_affected_rows} rows.")
+
+        verify_query = f"""
+        SELECT COUNT(DISTINCT S.ticker) AS staged,
+               ARRAY_AGG(DISTINCT IF(
+                   {' OR '.join(f"(S.{column} IS NOT NULL AND T.{column} IS NULL)" for column in columns)},
+                   S.ticker, NULL) IGNORE NULLS) AS unverified
+        FROM `{STAGING_TABLE_ID}` S
+        LEFT JOIN `{FULL_TABLE_ID}` T ON T.ticker = S.ticker
+        """
+        result = next(iter(bigquery_client.query(verify_query).result()))
+        if result.unverified:
+            print(f"Verification failed for {len(result.unverified)} of {result.staged} tickers: {', '.join(result.unverified)}")
+            return False
+        print(f"Verification successful for {result.staged} tickers.")
+        return True
+    finally:
+        bigquery_client.delete_table(STAGING_TABLE_ID, not_found_ok=True)
+
+def update_model_embeddings(model_names, workers=EMBEDDING_WORKERS, commit_batch_size=COMMIT_BATCH_SIZE):
+    """
+    Fills the long-format embedding store for registered models (embedding_models.py),
+    embedding only the (ticker, model) pairs that have no vector for the
+    model's current version, or whose vector was built from an older summary.
+    A newly registered model costs only its own vectors.
+
+    Args:
+        model_names (list of str): Registered model names.
+        workers (int): Batches in flight at once per model.
+        commit_batch_size (int): Tickers per staging load and MERGE.
+
+    Returns:
+        bool: True if every missing pair was embedded and written.
+    """
+    ensure_store(bigquery_client, EMBEDDING_STORE_TABLE_ID)
+    source_query = f"""
+    SELECT ticker AS entity, ANY_VALUE(long_business_summary) AS text
+    FROM `{FULL_TABLE_ID}`
+    WHERE ticker IS NOT NULL AND long_business_summary IS NOT NULL
+    GROUP BY ticker
+    """
+    success = True
+    for model in (get_model(name) for name in model_names):
+        missing = stale_entities(bigquery_client, EMBEDDING_STORE_TABLE_ID, source_query, model)
+        print(f"{model.label}: {len(missing)} tickers missing or stale version {model.version} embeddings.")
+        if not missing:
+            continue
+        texts = dict(missing)
+        runner = BackfillRunner(
+            f"store_{model.name}_v{model.version}",
+            [BackfillProvider(model.name, lambda texts, model=model: embed_documents(model, texts, embedding_cache),
+                              workers, model.batch_size, model=model.cache_key)],
+            lambda batch, model=model: write_store_vectors(
+                bigquery_client, EMBEDDING_STORE_TABLE_ID, model,
+                [(ticker, results[model.name], texts[ticker]) for ticker, results in batch]
+            ),
+            commit_batch_size=commit_batch_size,
+        )
+        success = not runner.run(missing)['failed'] and success
+    return success
+
+def refresh_changed_summaries(workers=YFINANCE_WORKERS):
+    """
+    Pulls fresh business summaries from Yahoo Finance and writes back the ones
+    whose content changed, clearing their fingerprint so the next bulk and
+    store runs re-embed exactly those tickers.
+
+    The old vectors stay in place until they are overwritten, so a changed
+    ticker keeps being retrieved (on its previous summary) in between, and
+    for good if a re-embed fails.
+
+    Args:
+        workers (int): Concurrent Yahoo Finance lookups.
+
+    Returns:
+        tuple: ``(tickers, models)``, the tickers whose summary changed and the
+        registered models with store vectors for them.
+    """
+    query = f"""
+    SELECT ticker, ANY_VALUE(long_business_summary) AS long_business_summary
+    FROM `{FULL_TABLE_ID}`
+    WHERE ticker IS NOT NULL
+    GROUP BY ticker
+    """
+    stored = {row['ticker']: row['long_business_summary'] for row in bigquery_client.query(query).result()}
+    print(f"Checking {len(stored)} tickers for changed business summaries.")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        fresh = dict(zip(stored, executor.map(fetch_stock_info, stored)))
+
+    changed = []
+    for ticker, info in fresh.items():
+        summary = info['long_business_summary']
+        # A failed or empty lookup never overwrites a stored summary
+        if content_fingerprint(summary) is None:
+            continue
+        if content_fingerprint(summary) != content_fingerprint(stored[ticker]):
+            changed.append({"ticker": ticker, "long_business_summary": summary, "sector": info['sector']})
+    print(f"{len(changed)} of {len(stored)} business summaries changed.")
+    if not changed:
+        return [], []
+
+    ensure_fingerprint_column(bigquery_client, FULL_TABLE_ID)
+    load_config = bigquery.LoadJobConfig(
+        schema=[
+            bigquery.SchemaField("ticker", "STRING", mode="REQUIRED"),
+            bigquery.SchemaField("long_business_summary", "STRING", mode="NULLABLE"),
+            bigquery.SchemaField("sector", "STRING", mode="NULLABLE"),
+        ],
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+    )
+    bigquery_client.load_table_from_json(changed, SUMMARY_STAGING_TABLE_ID, job_config=load_config).result()
+    try:
+        merge_query = f"""
+        MERGE `{FULL_TABLE_ID}` T
+        USING `{SUMMARY_STAGING_TABLE_ID}` S
+        ON T.ticker = S.ticker
+        WHEN MATCHED THEN UPDATE SET
+            long_business_summary = S.long_business_summary,
+            sector = IFNULL(S.sector, T.sector),
+            {FINGERPRINT_COLUMN} = NULL
+        """
+        bigquery_client.query(merge_query).result()
+    finally:
+        bigquery_client.delete_table(SUMMARY_STAGING_TABLE_ID, not_found_ok=True)
+    print(f"Updated {len(changed)} business summaries.")
+    tickers = [row["ticker"] for row in changed]
+    models = [name for name in store_entity_models(bigquery_client, EMBEDDING_STORE_TABLE_ID, tickers)
+              if name in EMBEDDING_MODELS]
+    return tickers, models
+
 def update_embeddings_one_by_one(max_retries=3):
     """
     Iterates through each row in the stocksbio table and updates embeddings.
@@ -150,21 +492,32 @@ def update_row(ticker, vertex_embeddings, openai_embeddings):
     vertex_embeddings_json = json.dumps(vertex_embeddings)
     openai_embeddings_json = json.dumps(openai_embeddings)
 
+    query_parameters = [
+        bigquery.ScalarQueryParameter("vertex_embeddings", "STRING", vertex_embeddings_json),
+        bigquery.ScalarQueryParameter("openai_embeddings", "STRING", openai_embeddings_json),
+        bigquery.ScalarQueryParameter("ticker", "STRING", ticker),
+    ]
+    vector_assignments = ""
+    # Dual-write the native array columns once the table has been migrated
+    # (embedding_storage.py); the JSON columns stay until every reader has switched.
+    if has_vector_columns(bigquery_client, FULL_TABLE_ID, ('embeddings_large_instruct', 'openai_embeddings')):
+        vector_assignments = """,
+        embeddings_large_instruct_vec = @vertex_vector,
+        openai_embeddings_vec = @openai_vector"""
+        query_parameters += [
+            bigquery.ArrayQueryParameter("vertex_vector", "FLOAT64", vector_values(vertex_embeddings)),
+            bigquery.ArrayQueryParameter("openai_vector", "FLOAT64", vector_values(openai_embeddings)),
+        ]
+
     update_query = f"""
     UPDATE `{FULL_TABLE_ID}`
     SET 
         embeddings_large_instruct = @vertex_embeddings,
-        openai_embeddings = @openai_embeddings
+        openai_embeddings = @openai_embeddings{vector_assignments}
     WHERE ticker = @ticker
     """
 
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("vertex_embeddings", "STRING", vertex_embeddings_json),
-            bigquery.ScalarQueryParameter("openai_embeddings", "STRING", openai_embeddings_json),
-            bigquery.ScalarQueryParameter("ticker", "STRING", ticker),
-        ]
-    )
+    job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
 
     try:
         query_job = bigquery_client.query(update_query, job_config=job_config)
@@ -250,8 +603,37 @@ def main():
  #       print("Cannot proceed with updates as the streaming buffer is still active.")
   #      return
 
+    parser = argparse.ArgumentParser(description="Fill missing stock embeddings.")
+    parser.add_argument('--one-by-one', action='store_true',
+                        help="Update and verify each ticker with its own queries instead of bulk MERGEs")
+    parser.add_argument('--vertex-workers', type=int, default=EMBEDDING_WORKERS,
+                        help="Vertex AI batches in flight at once")
+    parser.add_argument('--openai-workers', type=int, default=EMBEDDING_WORKERS,
+                        help="OpenAI batches in flight at once")
+    parser.add_argument('--commit-batch-size', type=int, default=COMMIT_BATCH_SIZE,
+                        help="Tickers per staging load and MERGE")
+    parser.add_argument('--models', nargs='+', choices=list(EMBEDDING_MODELS),
+                        help="Fill the long-format embedding store for these registered models instead")
+    parser.add_argument('--refresh', action='store_true',
+                        help="Pull fresh business summaries first, so only changed ones are re-embedded")
+    args = parser.parse_args()
+
+    refreshed_models = []
+    if args.refresh:
+        _, refreshed_models = refresh_changed_summaries()
+
     # Start updating embeddings
-    update_embeddings_one_by_one()
+    if args.models:
+        update_model_embeddings(args.models, args.vertex_workers, args.commit_batch_size)
+    elif args.one_by_one:
+        update_embeddings_one_by_one()
+    else:
+        update_embeddings_bulk(args.vertex_workers, args.openai_workers, args.commit_batch_size)
+    # Store vectors of refreshed tickers are rebuilt now rather than on the next store run
+    refreshed_models = [name for name in refreshed_models if name not in (args.models or [])]
+    if refreshed_models:
+        update_model_embeddings(refreshed_models, args.vertex_workers, args.commit_batch_size)
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
     main()
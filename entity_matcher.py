@@ -0,0 +1,263 @@
+import math
+import string
+import logging
+from collections import Counter, defaultdict
+import numpy as np
+from similarity import select_top_k
+
+# -------------------- Configuration --------------------
+
+# Legal-form and filler words dropped from company names before matching
+NAME_SUFFIXES = {
+    'inc', 'incorporated', 'corp', 'corporation', 'co', 'company', 'ltd', 'limited', 'plc',
+    'llc', 'lp', 'sa', 'nv', 'ag', 'se', 'holdings', 'holding', 'group', 'the', 'class',
+    'a', 'b', 'c', 'common', 'stock', 'shares', 'ordinary', 'adr', 'ads',
+}
+
+# Single-word names shorter than this are too ambiguous to match on their own
+MIN_SINGLE_TOKEN_NAME = 4
+
+# Words ignored by the lexical index
+STOPWORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'has', 'have', 'in', 'is',
+    'it', 'its', 'of', 'on', 'or', 'that', 'the', 'their', 'this', 'to', 'was', 'were', 'which',
+    'with', 'company', 'companies', 'inc', 'also', 'other', 'such', 'well', 'its', 'offers',
+    'provides', 'operates', 'segment', 'segments', 'products', 'services', 'was', 'founded',
+    'headquartered', 'incorporated',
+}
+
+# BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Reciprocal rank fusion constant
+RRF_K = 60
+
+# -------------------------------------------------------
+
+# Exchange prefixes that mark the next token as a ticker, as in "(NASDAQ: AAPL)"
+EXCHANGES = {'NASDAQ', 'NYSE', 'NYSEAMERICAN', 'AMEX', 'OTC', 'OTCQX', 'OTCQB', 'CBOE', 'TSX', 'LSE'}
+
+# Punctuation becomes whitespace so tokenizing is translate() + split(), which is
+# several times faster than a regex; '&' (AT&T) and '$' (cashtags) are kept
+_TOKEN_TABLE = str.maketrans({c: ' ' for c in string.punctuation + '\u2018\u2019\u201c\u201d\u2013\u2014'
+                              if c not in '&$'})
+
+
+def _tokens(text):
+    return text.translate(_TOKEN_TABLE).split()
+
+
+def _positions(tokens, token):
+    i = -1
+    while True:
+        try:
+            i = tokens.index(token, i + 1)
+        except ValueError:
+            return
+        yield i
+
+
+def normalize_company_name(name):
+    """
+    Reduces a company name to the lowercase tokens used for matching.
+
+    Legal forms and share-class words are dropped ("Apple Inc." -> ["apple"],
+    "Alphabet Inc. Class A" -> ["alphabet"]).
+
+    Args:
+        name (str): Company name as stored in the stocks table.
+
+    Returns:
+        tuple of str: The normalized tokens, possibly empty.
+    """
+    tokens = [token.lower() for token in _tokens(str(name or '')) if token != '$']
+    while tokens and tokens[-1] in NAME_SUFFIXES:
+        tokens.pop()
+    while tokens and tokens[0] == 'the':
+        tokens.pop(0)
+    return tuple(tokens)
+
+
+class EntityMatcher:
+    """
+    Finds company-name and explicit ticker mentions in article text.
+
+    Names are compiled into a token trie; matching tokenizes the article once
+    and walks the trie only from words that can start a name, with work per
+    start bounded by the longest name.
+    Tickers are only matched in explicit forms (``$AAPL``, ``NASDAQ: AAPL``)
+    to avoid confusing tickers with ordinary capitalised words. A few
+    thousand typical articles per second fit on one core.
+    """
+
+    def __init__(self, tickers, names):
+        """
+        Args:
+            tickers (list of str): Tickers in the universe.
+            names (list of str): Company name for each ticker (may be None).
+        """
+        self.tickers = set(ticker for ticker in tickers if ticker)
+        self._trie = {}
+        patterns = 0
+        for ticker, name in zip(tickers, names):
+            tokens = normalize_company_name(name)
+            if not tokens or (len(tokens) == 1 and len(tokens[0]) < MIN_SINGLE_TOKEN_NAME):
+                continue
+            node = self._trie
+            for token in tokens:
+                node = node.setdefault(token, [{}, []])
+                terminal = node
+                node = node[0]
+            terminal[1].append(ticker)
+            patterns += 1
+        logging.info(f"Built entity matcher with {patterns} company names and {len(self.tickers)} tickers")
+
+    def match(self, text):
+        """
+        Returns the tickers mentioned in the text, most-mentioned first.
+
+        Args:
+            text (str): Article text.
+
+        Returns:
+            list of tuple: ``(ticker, mentions)`` pairs, ordered by mention
+            count and then by first appearance.
+        """
+        text = str(text or '')
+        counts = Counter()
+        first_seen = {}
+
+        def hit(ticker, position):
+            counts[ticker] += 1
+            if first_seen.get(ticker, position) >= position:
+                first_seen[ticker] = position
+
+        cleaned = text.translate(_TOKEN_TABLE)
+        raw_tokens = cleaned.split()
+        tokens = cleaned.lower().split()
+
+        # Explicit ticker forms are rare, so only look for them when they can occur
+        if '$' in cleaned or ':' in text:
+            for token in set(raw_tokens):
+                if token[0] == '$' and token[1:] in self.tickers:
+                    for i in _positions(raw_tokens, token):
+                        hit(token[1:], i)
+                elif token in EXCHANGES:
+                    for i in _positions(raw_tokens, token):
+                        if i + 1 < len(raw_tokens) and raw_tokens[i + 1] in self.tickers:
+                            hit(raw_tokens[i + 1], i + 1)
+
+        # Intersecting the article vocabulary with the trie roots and locating
+        # the few matching words with list.index keeps the per-token work in C
+        for token in self._trie.keys() & set(tokens):
+            root = self._trie[token]
+            for i in _positions(tokens, token):
+                # Single-word names must look like proper nouns ("Apple", not "apple")
+                capitalised = raw_tokens[i][:1].isupper()
+                node, j = root, i
+                while node is not None:
+                    children, matched = node
+                    if matched and (j > i or capitalised):
+                        for ticker in matched:
+                            hit(ticker, i)
+                    j += 1
+                    if j >= len(tokens):
+                        break
+                    node = children.get(tokens[j])
+
+        return sorted(counts.items(), key=lambda item: (-item[1], first_seen[item[0]]))
+
+
+def _lexical_terms(text):
+    return [token for token in str(text or '').translate(_TOKEN_TABLE).lower().split()
+            if token not in STOPWORDS and not token.isdigit() and token[0] != '$']
+
+
+class BM25Index:
+    """
+    Okapi BM25 over the tickers' long business summaries.
+
+    Postings are stored per term as numpy arrays, so scoring an article
+    touches only the documents that share a term with it.
+    """
+
+    def __init__(self, tickers, summaries, k1=BM25_K1, b=BM25_B):
+        """
+        Args:
+            tickers (list of str): Ticker for each summary.
+            summaries (list of str): Long business summary per ticker.
+            k1 (float): Term-frequency saturation.
+            b (float): Length normalization.
+        """
+        self.tickers = list(tickers)
+        postings = defaultdict(lambda: ([], []))
+        lengths = np.zeros(len(self.tickers), dtype=np.float32)
+        for doc, summary in enumerate(summaries):
+            terms = Counter(_lexical_terms(summary))
+            lengths[doc] = sum(terms.values())
+            for term, frequency in terms.items():
+                docs, frequencies = postings[term]
+                docs.append(doc)
+                frequencies.append(frequency)
+
+        average_length = lengths.mean() if len(lengths) and lengths.mean() > 0 else 1.0
+        norm = k1 * (1 - b + b * lengths / average_length)
+        n = len(self.tickers)
+        self._postings = {}
+        for term, (docs, frequencies) in postings.items():
+            docs = np.asarray(docs, dtype=np.int64)
+            frequencies = np.asarray(frequencies, dtype=np.float32)
+            idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+            # Precompute the full per-posting weight; queries only sum them
+            self._postings[term] = (docs, idf * frequencies * (k1 + 1) / (frequencies + norm[docs]))
+        logging.info(f"Built BM25 index over {n} summaries with {len(self._postings)} terms")
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def scores(self, text):
+        """
+        Scores article text against every summary.
+
+        Returns:
+            numpy.ndarray: BM25 score per ticker.
+        """
+        scores = np.zeros(len(self.tickers), dtype=np.float32)
+        for term in set(_lexical_terms(text)):
+            posting = self._postings.get(term)
+            if posting is not None:
+                np.add.at(scores, posting[0], posting[1])
+        return scores
+
+    def top_k(self, text, k):
+        """
+        Returns the k best-matching tickers as ``(ticker, score)`` pairs.
+        """
+        scores = self.scores(text)
+        positions = select_top_k(scores, k)
+        return [(self.tickers[i], float(scores[i])) for i in positions if scores[i] > 0]
+
+
+def fuse_rankings(rankings, k, rrf_k=RRF_K):
+    """
+    Combines ranked ticker lists with reciprocal rank fusion.
+
+    Rank fusion needs no calibration between cosine and BM25 scores, so
+    dense and lexical results can be mixed directly.
+
+    Args:
+        rankings (list of list): Ranked ``(ticker, score)`` lists.
+        k (int): Number of tickers to return.
+        rrf_k (int): Fusion constant; larger values flatten rank differences.
+
+    Returns:
+        list of tuple: ``(ticker, fused_score)`` pairs, best first.
+    """
+    fused = defaultdict(float)
+    order = {}
+    for ranking in rankings:
+        for rank, (ticker, _) in enumerate(ranking):
+            fused[ticker] += 1.0 / (rrf_k + rank + 1)
+            order.setdefault(ticker, len(order))
+    return sorted(fused.items(), key=lambda item: (-item[1], order[item[0]]))[:k]
@@ -28,7 +28,7 @@ logging.basicConfig(level=logging.DEBUG)
 
 def query_database():
     query = f"""
-        SELECT *
+        SELECT id, date, content, sources, effect, stock_prediction
         FROM `{full_table_id}`
         LIMIT 10
     """
@@ -2,6 +2,7 @@ import os
 import logging
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
+from rate_limiter import get_limiter
 
 # Set your SendGrid API key
 sendgrid_api_key = '...'
@@ -48,7 +49,8 @@ def send_supply_chain_manager_email(link, recipient_emails):
                 html_content=stock_info_html
             )
             sg = SendGridAPIClient(sendgrid_api_key)
-            response = sg.send(message)
+            response = get_limiter('sendgrid').call(sg.send, message)
+            get_limiter('sendgrid').update(response.headers)
             logging.info(f"Email sent to {recipient_email}: Status code {response.status_code}")
         except Exception as e:
             logging.error(f"Failed to send email to {recipient_email}: {e}")
@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import logging
+import threading
+
+# -------------------- Configuration --------------------
+
+# One cache file shared by every pipeline on the host, wherever it is started from
+LLM_CACHE_PATH = os.getenv(
+    'LLM_CACHE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'llm_responses.sqlite'),
+)
+
+# Compressed response bytes kept on disk; least recently used entries are evicted beyond this
+LLM_CACHE_MAX_BYTES = int(os.getenv('LLM_CACHE_MAX_BYTES', 512 * 1024 ** 2))
+
+# Entries older than this are ignored and evicted, in seconds
+LLM_CACHE_TTL = float(os.getenv('LLM_CACHE_TTL', 30 * 24 * 3600))
+
+# 'on': answer from the cache and store new responses. 'off': bypass it.
+# 'replay': answer only from the cache; a miss fails instead of calling the API,
+# so a run (recovery, backtest) costs no LLM spend, and the pipelines write their
+# rows to LLM_REPLAY_OUTPUT instead of BigQuery. 'replay_latest': replay, but a
+# prompt that differs from the cached one (it embeds live data such as prices)
+# gets the latest response stored for the same template and scope (the
+# article); rows built from such answers are tagged 'latest' rather than 'exact'.
+LLM_CACHE_MODE = os.getenv('LLM_CACHE_MODE', 'on')
+
+# JSONL file replay runs append their rows to, each with its destination table and replay tag
+LLM_REPLAY_OUTPUT = os.getenv(
+    'LLM_REPLAY_OUTPUT',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'replay_rows.jsonl'),
+)
+
+# Eviction trims the cache to this fraction of the limit so it does not run on every insert
+EVICTION_TARGET = 0.9
+
+# Inserts between size checks
+EVICTION_CHECK_INTERVAL = 100
+
+# -------------------------------------------------------
+
+CACHE_MODES = ('on', 'off', 'replay', 'replay_latest')
+
+
+class LLMCacheMiss(LookupError):
+    """
+    Raised in replay mode when a call has no cached response.
+    """
+
+
+def load_template(path):
+    """
+    Reads a prompt template and returns it with its version, the file name
+    plus a hash of its contents, so editing a prompt starts a fresh set of
+    cache entries without touching the old ones.
+
+    Returns:
+        tuple: ``(text, version)``, e.g. ``(..., 'stockprice@3f2a9c1e0b7d')``.
+    """
+    with open(path, 'r') as file:
+        text = file.read()
+    name = os.path.splitext(os.path.basename(path))[0]
+    return text, f"{name}@{hashlib.sha256(text.encode('utf-8')).hexdigest()[:12]}"
+
+
+def response_key(request, template=None):
+    """
+    Returns the cache key for one call.
+
+    Args:
+        request (dict): ``messages.create`` arguments. The model, the rendered
+            messages (hashed exactly as sent) and every other argument (the
+            sampling parameters: max_tokens, temperature, ...) are key fields.
+        template (str, optional): Prompt template version from load_template().
+
+    Returns:
+        bytes: SHA-256 digest of the key fields.
+    """
+    messages = json.dumps(request.get('messages'), sort_keys=True, default=str)
+    fields = {
+        'model': request.get('model'),
+        'template': template,
+        'prompt': hashlib.sha256(messages.encode('utf-8')).hexdigest(),
+        'params': {name: value for name, value in request.items() if name not in ('model', 'messages')},
+    }
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode('utf-8')).digest()
+
+
+class LLMResponseCache:
+    """
+    Persistent LLM response cache keyed by (model, prompt template version,
+    rendered prompt hash, sampling parameters).
+
+    Response texts are zlib-compressed in SQLite (WAL mode, so several
+    processes can share the file). Entries expire after ``ttl`` seconds and
+    are evicted least-recently-used once the stored bytes exceed ``max_bytes``.
+    """
+
+    def __init__(self, path=LLM_CACHE_PATH, max_bytes=LLM_CACHE_MAX_BYTES, ttl=LLM_CACHE_TTL, mode=LLM_CACHE_MODE):
+        """
+        Args:
+            path (str): SQLite file, created if missing.
+            max_bytes (int): Compressed bytes kept before LRU eviction.
+            ttl (float): Seconds an entry stays valid.
+            mode (str): 'on', 'off', 'replay' or 'replay_latest' (see LLM_CACHE_MODE).
+        """
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown LLM cache mode {mode!r}; expected one of {', '.join(CACHE_MODES)}")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+        self._inserts = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if mode == 'off':
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key BLOB PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    template TEXT,
+                    scope TEXT,
+                    response BLOB NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                ) WITHOUT ROWID
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_scope ON responses (template, scope, created_at)")
+
+    @property
+    def replay(self):
+        return self.mode in ('replay', 'replay_latest')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, request, template=None, scope=None):
+        """
+        Looks up the response to a ``messages.create`` request.
+
+        Returns:
+            str: The cached response text, or None.
+
+        Raises:
+            LLMCacheMiss: In replay mode, when there is no valid entry.
+        """
+        return self.lookup(request, template, scope)[0]
+
+    def lookup(self, request, template=None, scope=None):
+        """
+        get(), also telling how the response was found.
+
+        Args:
+            request (dict): ``messages.create`` arguments.
+            template (str, optional): Prompt template version.
+            scope (str, optional): What the call was about (e.g. an article hash);
+                used by 'replay_latest' mode when the exact prompt is not cached.
+
+        Returns:
+            tuple: ``(text, source)``; source is 'exact', 'latest' (a
+            'replay_latest' fallback) or None on a miss.
+
+        Raises:
+            LLMCacheMiss: In replay mode, when there is no valid entry.
+        """
+        if self.mode == 'off':
+            return None, None
+        key = response_key(request, template)
+        connection = self._connection()
+        source = 'exact'
+        row = connection.execute(
+            "SELECT response FROM responses WHERE key = ? AND created_at >= ?",
+            (key, time.time() - self.ttl),
+        ).fetchone()
+        if row is None and self.mode == 'replay_latest' and scope is not None:
+            row = connection.execute(
+                "SELECT response, key FROM responses WHERE model = ? AND template IS ? AND scope = ? AND created_at >= ? "
+                "ORDER BY created_at DESC LIMIT 1",
+                (request.get('model'), template, scope, time.time() - self.ttl),
+            ).fetchone()
+            if row is not None:
+                logging.info(f"Replaying the latest {template} response for scope {scope}; its prompt differed")
+                key, source = row[1], 'latest'
+        if row is not None:
+            with connection:
+                connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        with self._lock:
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.fallbacks += source == 'latest'
+        if row is None:
+            if self.replay:
+                raise LLMCacheMiss(f"No cached {request.get('model')} response for template {template} (replay mode)")
+            return None, None
+        return zlib.decompress(row[0]).decode('utf-8'), source
+
+    def put(self, request, response, template=None, scope=None):
+        """
+        Stores the response text of a request. Nothing is written in 'off' or the replay modes.
+        """
+        if self.mode != 'on' or response is None:
+            return
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO responses (key, model, template, scope, response, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (response_key(request, template), request.get('model'), template, scope,
+                 zlib.compress(response.encode('utf-8')), now, now),
+            )
+        with self._lock:
+            self._inserts += 1
+            check = self._inserts >= EVICTION_CHECK_INTERVAL
+            if check:
+                self._inserts = 0
+        if check:
+            self.evict()
+
+    def evict(self):
+        """
+        Deletes expired entries, then least recently used ones until the cache
+        fits its size limit.
+        """
+        connection = self._connection()
+        with connection:
+            expired = connection.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.ttl,)).rowcount
+        total = connection.execute("SELECT IFNULL(SUM(LENGTH(response)), 0) FROM responses").fetchone()[0]
+        removed = freed = 0
+        if total > self.max_bytes:
+            excess = total - int(self.max_bytes * EVICTION_TARGET)
+            with connection:
+                victims = []
+                for key, size in connection.execute("SELECT key, LENGTH(response) FROM responses ORDER BY last_used"):
+                    if freed >= excess:
+                        break
+                    victims.append((key,))
+                    freed += size
+                connection.executemany("DELETE FROM responses WHERE key = ?", victims)
+                removed = len(victims)
+        if expired or removed:
+            logging.info(f"Evicted {expired} expired and {removed} cached LLM responses ({freed / 1024 ** 2:.1f} MB)")
+
+    def stats(self):
+        """
+        Returns the mode and the hit, miss and replay fallback counters for this process.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'mode': self.mode,
+                'hits': self.hits,
+                'misses': self.misses,
+                'fallbacks': self.fallbacks,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def get_llm_cache():
+    """
+    Returns the process-wide LLMResponseCache.
+    """
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = LLMResponseCache()
+        return _default_cache
+
+
+def replay_tag(sources):
+    """
+    Tags a row built from replayed answers: 'latest' if any of its answers
+    (LLMResponseCache.lookup sources) was a 'replay_latest' fallback, else 'exact'.
+    """
+    return 'latest' if 'latest' in sources else 'exact'
+
+
+def write_replay_rows(table_id, rows, path=LLM_REPLAY_OUTPUT):
+    """
+    Appends the rows a replay run would have inserted into ``table_id`` to the
+    replay output file, so a replay never writes to BigQuery.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with _default_lock:
+        with open(path, 'a') as file:
+            for row in rows:
+                file.write(json.dumps({'table': table_id, 'row': row}, default=str) + '\n')
+    logging.info(f"Replay mode: wrote {len(rows)} {table_id} rows to {path} instead of BigQuery")
@@ -0,0 +1,237 @@
+import os
+import time
+import asyncio
+import logging
+import anthropic
+from anthropic import AsyncAnthropicVertex
+from tenacity import AsyncRetrying, stop_after_attempt, wait_exponential, wait_random, retry_if_exception_type
+from deadline import Deadline, stop_at_deadline, wait_within
+from rate_limiter import get_limiter
+from llm_cache import get_llm_cache
+
+# -------------------- Configuration --------------------
+
+ANTHROPIC_REGION = "europe-west1"
+
+# Longest single Anthropic request, in seconds; the HTTP client abandons the connection after it
+ANTHROPIC_TIMEOUT = 60
+
+# Attempts per call, and the exponential backoff bounds between them, in seconds
+ANTHROPIC_MAX_ATTEMPTS = 5
+ANTHROPIC_MIN_WAIT = 4
+ANTHROPIC_MAX_WAIT = 60
+
+# Budget for a call made without a caller deadline, in seconds
+DEFAULT_DEADLINE = 240
+
+# Anthropic requests in flight at once per client. Raise it until the
+# provider quota (rate limit errors) is reached.
+LLM_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', '8'))
+
+# -------------------------------------------------------
+
+
+class StreamTimeout(Exception):
+    """
+    A streamed response did not finish within the request timeout.
+    """
+
+
+# Errors worth another attempt; connection errors include timeouts and TLS failures
+RETRYABLE_ERRORS = (anthropic.RateLimitError, anthropic.APITimeoutError, anthropic.APIConnectionError, StreamTimeout)
+
+
+def retry_policy(deadline, max_attempts=ANTHROPIC_MAX_ATTEMPTS, min_wait=ANTHROPIC_MIN_WAIT, max_wait=ANTHROPIC_MAX_WAIT):
+    """
+    Returns the tenacity arguments shared by every Anthropic call: exponential
+    backoff with jitter, at most ``max_attempts`` attempts, none past ``deadline``.
+    """
+    return {
+        'stop': stop_after_attempt(max_attempts) | stop_at_deadline(deadline),
+        'wait': wait_within(deadline, wait_exponential(multiplier=1, min=min_wait, max=max_wait) + wait_random(0, 1)),
+        'retry': retry_if_exception_type(RETRYABLE_ERRORS),
+        'reraise': True,
+    }
+
+
+class AsyncLLMClient:
+    """
+    asyncio client for the Anthropic stages of the pipelines.
+
+    Any number of articles can await calls at once; a semaphore keeps at most
+    ``concurrency`` requests in flight, so throughput follows the provider
+    quota rather than the latency of one call. Every call runs under
+    ``retry_policy`` and within its caller's Deadline; time spent queued for
+    the semaphore counts against that deadline. Requests also draw from the
+    shared 'anthropic' rate limiter, which follows the quota headers and 429s.
+    complete() answers from the LLM response cache when it can; in replay
+    mode it never calls the API.
+
+    Create and use it inside one event loop (``async with AsyncLLMClient(...)``).
+    """
+
+    def __init__(self, project_id, region=ANTHROPIC_REGION, concurrency=LLM_CONCURRENCY, timeout=ANTHROPIC_TIMEOUT,
+                 cache=None):
+        """
+        Args:
+            project_id (str): Google Cloud project serving the Anthropic models.
+            region (str): Vertex AI region.
+            concurrency (int): Requests in flight at once.
+            timeout (float): Longest single request, in seconds.
+            cache (LLMResponseCache, optional): Defaults to the process-wide cache.
+        """
+        self.client = AsyncAnthropicVertex(region=region, project_id=project_id, timeout=timeout, max_retries=0)
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._limiter = get_limiter('anthropic')
+        self.cache = cache or get_llm_cache()
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.client.close()
+
+    async def _attempt(self, deadline, send):
+        # ``send`` takes the request timeout and returns (response, response headers)
+        # A rate-limit wait longer than the budget left fails now instead of sleeping past it
+        await self._limiter.acquire_async(timeout=deadline.timeout(what="Anthropic rate limit wait"))
+        async with self._semaphore:
+            # Checked after queueing, so a request never outlives the deadline
+            timeout = deadline.timeout(self.timeout, "Anthropic API call")
+            self.calls += 1
+            start_time = time.monotonic()
+            try:
+                response, headers = await send(timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"Streamed API call took longer than {timeout:.0f} seconds. Retrying...")
+                self.retries += 1
+                raise StreamTimeout(f"Streamed API call took longer than {timeout:.0f} seconds") from None
+            except RETRYABLE_ERRORS as e:
+                logging.warning(f"API call failed. Retrying... Error: {e}")
+                self._limiter.observe_error(e)
+                self.retries += 1
+                raise
+            except Exception as e:
+                logging.error(f"Unexpected error in API call: {e}")
+                raise
+        self._limiter.success(headers)
+        logging.info(f"API call completed in {time.monotonic() - start_time:.2f} seconds")
+        logging.debug(f"API Response: {response}")
+        return response
+
+    async def _call(self, deadline, send):
+        deadline = deadline or Deadline(DEFAULT_DEADLINE)
+        try:
+            async for attempt in AsyncRetrying(**retry_policy(deadline)):
+                with attempt:
+                    return await self._attempt(deadline, send)
+        except Exception:
+            self.failures += 1
+            raise
+
+    async def create(self, deadline=None, **kwargs):
+        """
+        Sends one Messages API request with retries.
+
+        Args:
+            deadline (Deadline, optional): Budget shared with the caller's
+                other work; DEFAULT_DEADLINE when omitted.
+            **kwargs: ``messages.create`` arguments.
+
+        Raises:
+            DeadlineExceeded: If the budget ran out before an attempt could start.
+            Exception: The last API error once retries or the budget are exhausted.
+        """
+        async def send(timeout):
+            raw = await self.client.messages.with_raw_response.create(timeout=timeout, **kwargs)
+            return raw.parse(), raw.headers
+
+        return await self._call(deadline, send)
+
+    async def _read_stream(self, kwargs, timeout, on_text):
+        text = ''
+        async with self.client.messages.stream(timeout=timeout, **kwargs) as stream:
+            async for chunk in stream.text_stream:
+                text += chunk
+                if on_text is not None:
+                    on_text(text)
+            return text, stream.response.headers
+
+    async def stream(self, deadline=None, on_text=None, **kwargs):
+        """
+        Streams one Messages API request with retries, under the same policy as create().
+
+        Args:
+            deadline (Deadline, optional): Budget shared with the caller's
+                other work; DEFAULT_DEADLINE when omitted.
+            on_text (callable, optional): Called with the text received so far
+                each time more arrives. A retried attempt starts again from the
+                beginning, so it must tolerate seeing the same text twice.
+            **kwargs: ``messages.create`` arguments.
+
+        Returns:
+            str: The complete response text.
+        """
+        def send(timeout):
+            # The HTTP timeout applies per read; the attempt as a whole gets one too
+            return asyncio.wait_for(self._read_stream(kwargs, timeout, on_text), timeout)
+
+        return await self._call(deadline, send)
+
+    async def complete(self, prompt, model, max_tokens, deadline=None, template=None, scope=None, on_text=None,
+                       sources=None):
+        """
+        Sends a single-turn prompt and returns the text of the answer, from the
+        LLM response cache when it holds one.
+
+        Args:
+            template (str, optional): Prompt template version (llm_cache.load_template),
+                part of the cache key.
+            scope (str, optional): Cache scope, e.g. the article hash (see LLMResponseCache.get).
+            on_text (callable, optional): Streams the answer, calling this with the
+                text so far as it arrives (see stream()); a cached answer is
+                passed once, whole.
+            sources (list, optional): Collects where the answer came from:
+                'api', or the cache source from LLMResponseCache.lookup.
+
+        Raises:
+            LLMCacheMiss: In replay mode, when the answer is not cached.
+        """
+        request = {
+            'max_tokens': max_tokens,
+            'messages': [{"role": "user", "content": prompt}],
+            'model': model,
+        }
+        text, source = self.cache.lookup(request, template, scope)
+        if sources is not None:
+            sources.append(source or 'api')
+        if text is not None:
+            logging.info(f"Answered {template or model} call from the LLM response cache")
+            if on_text is not None:
+                on_text(text)
+            return text
+        if on_text is not None:
+            text = await self.stream(deadline=deadline, on_text=on_text, **request)
+        else:
+            response = await self.create(deadline=deadline, **request)
+            text = response.content[0].text
+        self.cache.put(request, text, template, scope)
+        return text
+
+    def stats(self):
+        """
+        Returns request, retry and failed-call counters.
+        """
+        return {
+            'calls': self.calls,
+            'retries': self.retries,
+            'failures': self.failures,
+        }
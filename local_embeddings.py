@@ -0,0 +1,209 @@
+import os
+import logging
+import concurrent.futures
+import multiprocessing
+import numpy as np
+from similarity import normalize_rows
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+try:
+    import onnxruntime
+    from tokenizers import Tokenizer
+except ImportError:
+    onnxruntime = None
+    Tokenizer = None
+
+# -------------------- Configuration --------------------
+
+# 'sentence_transformers' loads a Hugging Face model name or path;
+# 'onnx' loads model.onnx and tokenizer.json from LOCAL_MODEL_PATH
+LOCAL_BACKEND = os.getenv('LOCAL_EMBEDDING_BACKEND', 'sentence_transformers')
+LOCAL_MODEL_PATH = os.getenv('LOCAL_EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+
+# Worker processes, each holding its own copy of the model
+LOCAL_WORKERS = int(os.getenv('LOCAL_EMBEDDING_WORKERS', max(1, min(4, (os.cpu_count() or 2) // 2))))
+
+# Texts per model call inside a worker
+LOCAL_BATCH_SIZE = 32
+
+# Same truncation as the remote Vertex AI inputs
+LOCAL_MAX_CHARACTERS = 1450
+
+# Longest tokenized input for the ONNX backend
+ONNX_MAX_TOKENS = 256
+
+# -------------------------------------------------------
+
+
+def local_backend_available(backend=LOCAL_BACKEND):
+    """
+    Returns True if the packages for the local embedding backend are installed.
+    """
+    if backend == 'sentence_transformers':
+        return SentenceTransformer is not None
+    if backend == 'onnx':
+        return onnxruntime is not None
+    return False
+
+
+def prepare_text(text, max_characters=LOCAL_MAX_CHARACTERS):
+    """
+    Truncates and collapses whitespace the same way as the remote embedding inputs.
+    """
+    text = str(text or '').strip()
+    if text.lower() == 'nan':
+        return ''
+    return ' '.join(text[:max_characters].split())
+
+
+class _OnnxModel:
+    """
+    Mean-pooled sentence embeddings from an exported ONNX transformer.
+    """
+
+    def __init__(self, path, max_tokens=ONNX_MAX_TOKENS):
+        options = onnxruntime.SessionOptions()
+        # Parallelism comes from the worker pool, not from intra-op threads
+        options.intra_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(os.path.join(path, 'model.onnx'), options,
+                                                    providers=['CPUExecutionProvider'])
+        self.input_names = {node.name for node in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(path, 'tokenizer.json'))
+        self.tokenizer.enable_truncation(max_tokens)
+        self.tokenizer.enable_padding()
+
+    def encode(self, texts, batch_size=LOCAL_BATCH_SIZE):
+        outputs = []
+        for start in range(0, len(texts), batch_size):
+            encodings = self.tokenizer.encode_batch(texts[start:start + batch_size])
+            feed = {
+                'input_ids': np.array([e.ids for e in encodings], dtype=np.int64),
+                'attention_mask': np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            }
+            if 'token_type_ids' in self.input_names:
+                feed['token_type_ids'] = np.array([e.type_ids for e in encodings], dtype=np.int64)
+            hidden = self.session.run(None, feed)[0]
+            mask = feed['attention_mask'][:, :, None].astype(np.float32)
+            outputs.append((hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9))
+        return np.concatenate(outputs).astype(np.float32)
+
+
+_worker_model = None
+
+
+def _load_model(backend, model_path):
+    global _worker_model
+    if backend == 'onnx':
+        _worker_model = _OnnxModel(model_path)
+    else:
+        import torch
+        torch.set_num_threads(1)
+        _worker_model = SentenceTransformer(model_path, device='cpu')
+
+
+def _encode(texts):
+    if isinstance(_worker_model, _OnnxModel):
+        return _worker_model.encode(texts)
+    return np.asarray(_worker_model.encode(texts, batch_size=LOCAL_BATCH_SIZE, convert_to_numpy=True,
+                                           show_progress_bar=False), dtype=np.float32)
+
+
+def _dimension():
+    return _encode(['dimension']).shape[1]
+
+
+class LocalEmbedder:
+    """
+    Embeds text with a small CPU model in a pool of worker processes.
+
+    Each worker loads the model once and runs single-threaded, so throughput
+    scales with the number of workers and no network call is involved.
+    Vectors are unit-length float32, ready for SimilarityIndex.
+    """
+
+    def __init__(self, backend=LOCAL_BACKEND, model_path=LOCAL_MODEL_PATH, workers=LOCAL_WORKERS):
+        """
+        Args:
+            backend (str): 'sentence_transformers' or 'onnx'.
+            model_path (str): Model name or directory.
+            workers (int): Number of worker processes.
+
+        Raises:
+            ImportError: If the backend's packages are not installed.
+        """
+        if not local_backend_available(backend):
+            raise ImportError(f"Local embedding backend '{backend}' is not installed")
+        self.backend = backend
+        self.model_path = model_path
+        self.workers = workers
+        self._dimension = None
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_load_model,
+            initargs=(backend, model_path),
+        )
+        logging.info(f"Started {workers} local embedding workers for {model_path} ({backend})")
+
+    @property
+    def model_id(self):
+        """Identifier stored with snapshot matrices built by this embedder."""
+        return f"{self.backend}:{self.model_path}"
+
+    @property
+    def dimension(self):
+        """Width of the vectors, asked of a worker the first time it is needed."""
+        if self._dimension is None:
+            self._dimension = self._executor.submit(_dimension).result()
+        return self._dimension
+
+    def embed(self, texts):
+        """
+        Embeds a list of texts.
+
+        Empty texts get zero vectors, which score 0 against everything; so
+        does every row when all texts are empty, at the model's full width.
+
+        Args:
+            texts (list of str): Input texts.
+
+        Returns:
+            numpy.ndarray: ``(len(texts), dim)`` unit-length float32 rows.
+        """
+        prepared = [prepare_text(text) for text in texts]
+        present = [i for i, text in enumerate(prepared) if text]
+        if not present:
+            return np.zeros((len(texts), self.dimension), dtype=np.float32)
+
+        # Spread the texts evenly so every worker gets a share of a small batch
+        chunk = max(1, min(LOCAL_BATCH_SIZE * 4, -(-len(present) // self.workers)))
+        futures = [
+            self._executor.submit(_encode, [prepared[i] for i in present[start:start + chunk]])
+            for start in range(0, len(present), chunk)
+        ]
+        vectors = np.concatenate([future.result() for future in futures])
+        self._dimension = vectors.shape[1]
+
+        result = np.zeros((len(texts), vectors.shape[1]), dtype=np.float32)
+        result[present] = vectors
+        return normalize_rows(result)
+
+    def close(self):
+        self._executor.shutdown()
+
+
+_default_embedder = None
+
+
+def get_local_embedder():
+    """
+    Returns the process-wide LocalEmbedder, or None if the backend is not installed.
+    """
+    global _default_embedder
+    if _default_embedder is None and local_backend_available():
+        _default_embedder = LocalEmbedder()
+    return _default_embedder
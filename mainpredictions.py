@@ -1,17 +1,15 @@
 import os
 import json
 import time
-import random
+import uuid
 import logging
-import anthropic
+import asyncio
 import openai
 import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import pytz
 from google.cloud import bigquery, aiplatform
-from scipy.spatial.distance import cosine
-from anthropic import AnthropicVertex
 from google.api_core import retry
 from google.api_core import exceptions as google_exceptions
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
@@ -21,6 +19,19 @@ import re
 import concurrent.futures
 from requests.exceptions import SSLError
 from urllib3.exceptions import SSLError as URLLib3SSLError
+from embedding_snapshot import LOCAL_MODEL, SnapshotWatcher, refresh_snapshot
+from similarity import two_stage_rerank_batch, independent_top_k_batch
+from entity_matcher import fuse_rankings
+from local_embeddings import get_local_embedder
+from micro_batcher import MicroBatcher
+from embedding_cache import get_embedding_cache, text_key
+from embedding_client import HedgedProvider
+from embedding_models import EMBEDDING_MODELS, get_model, configured_models
+from embedding_storage import article_key, ensure_store, store_rows
+from deadline import Deadline, DeadlineExceeded
+from llm_client import AsyncLLMClient
+from llm_cache import get_llm_cache, load_template, replay_tag, write_replay_rows
+from rate_limiter import get_limiter
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -31,19 +42,104 @@ project_id = '...'
 dataset_id = '...'
 table_id = '...'
 full_table_id = f"{project_id}.{dataset_id}.{table_id}"
-client_bq = bigquery.Client(project=project_id)
-aiplatform.init(project=project_id, location='us-east1')
 
-# Initialize Anthropic client
-client_anthropic = AnthropicVertex(region="europe-west1", project_id=project_id)
+# End-to-end budget for one article (both LLM calls, their retries and the
+# price lookups), in seconds; it starts when the article starts, not when queued
+ARTICLE_DEADLINE = 240
 
-# Endpoint for Vertex AI Model for generating embeddings
-vertex_endpoint_name = "..."
-vertex_endpoint = aiplatform.Endpoint(endpoint_name=vertex_endpoint_name)
+# Articles predicted at once. Their Anthropic requests share one client, which
+# keeps at most LLM_CONCURRENCY (llm_client.py) in flight.
+ARTICLE_CONCURRENCY = 16
+
+ANTHROPIC_MODEL = "claude-3-5-sonnet@20240620"
+
+# Stream the stage-1 (ticker selection) response and start each ticker's price
+# lookup as soon as its {{TICKER n: SYM}} token arrives, overlapping the lookups
+# with generation. False waits for the whole response first.
+STAGE1_STREAMING = True
 
 openai.api_key = "..."  # Use a secure method to store this
-vertex_large_instruct_endpoint_name = "..."
-vertex_large_instruct_endpoint = aiplatform.Endpoint(endpoint_name=vertex_large_instruct_endpoint_name)
+
+# Snapshot models used for retrieval, in the order they appear in the prompt. Any
+# model registered in embedding_models.py (and present in the snapshot) can be
+# listed in the RETRIEVAL_MODELS environment variable; the first one is the
+# default first stage.
+RETRIEVAL_MODELS = configured_models('RETRIEVAL_MODELS', ('vertex', 'openai', 'vertex_large_instruct'))
+
+# Prompt label for each model's ticker list
+MODEL_LABELS = {name: model.label for name, model in EMBEDDING_MODELS.items()}
+MODEL_LABELS[LOCAL_MODEL] = 'Local'
+
+# Model that searches the whole universe in 'vertex_prefilter' mode, set with the
+# FIRST_STAGE_MODEL environment variable. 'local' uses the CPU model from
+# local_embeddings, so the remote models only rerank its shortlist and an article is
+# still ranked when some of them fail. Falls back to the first of RETRIEVAL_MODELS
+# when no local backend is installed or the snapshot has no local matrix.
+FIRST_STAGE_MODEL = os.getenv('FIRST_STAGE_MODEL', RETRIEVAL_MODELS[0])
+if FIRST_STAGE_MODEL not in (LOCAL_MODEL, *RETRIEVAL_MODELS):
+    raise ValueError(f"FIRST_STAGE_MODEL must be {LOCAL_MODEL!r} or one of RETRIEVAL_MODELS, got {FIRST_STAGE_MODEL!r}")
+
+# 'vertex_prefilter': Vertex AI top 100 reranked by the other models.
+# 'reduced': every model searches the whole universe on reduced vectors, rescored at full dimension.
+FIRST_STAGE_MODE = 'vertex_prefilter'
+
+# First-stage index over the whole universe: 'auto' (exact, IVF once large), 'int8' or 'binary'
+FIRST_STAGE_INDEX = 'auto'
+
+# Articles naming at least this many distinct tickers skip the embedding stage;
+# the prompt gets the named companies plus lexical (BM25) matches instead
+ENTITY_FAST_PATH_MIN_HITS = 3
+
+# Tickers offered to the LLM on the fast path (mentions first, then BM25 matches)
+FAST_PATH_CANDIDATES = 9
+
+# Articles embedded together: the batcher hands out up to EMBEDDING_BATCH_SIZE
+# articles at once, waiting at most EMBEDDING_BATCH_WAIT seconds for a batch to fill
+EMBEDDING_BATCH_SIZE = 64
+EMBEDDING_BATCH_WAIT = 0.2
+
+# Overall deadline for one article's (or one batch's) embeddings across all providers, in seconds
+EMBEDDING_DEADLINE = 30
+EMBEDDING_BATCH_DEADLINE = 120
+
+# Failover targets per model, tried when the primary is failing and used for
+# hedged requests when it is slow: (location, endpoint name) pairs for Vertex AI
+# models, extra API bases for OpenAI models
+FAILOVER_TARGETS = {
+    'vertex': [],
+    'vertex_large_instruct': [],
+    'openai': [],
+}
+
+# Fuse the Vertex AI ranking with BM25 over business summaries (reciprocal rank
+# fusion). Off by default: it changes which top-3 tickers reach the prompt, so
+# measure its overlap with the dense ranking before turning it on.
+HYBRID_LEXICAL = False
+
+# Predictions table, and the side store holding each article's embeddings
+# (one row per article and model) so prediction rows stay small
+PREDICTIONS_TABLE_ID = f"{project_id}.backwards_testing.main"
+ARTICLE_EMBEDDINGS_TABLE_ID = f"{project_id}.backwards_testing.article_embeddings"
+
+def _hedged_provider(model):
+    failover = FAILOVER_TARGETS.get(model.name, [])
+    if model.provider == 'vertex':
+        targets = [aiplatform.Endpoint(endpoint_name=model.model_id)] + [
+            aiplatform.Endpoint(endpoint_name=name, location=location) for location, name in failover
+        ]
+    else:
+        targets = [{}] + [{'api_base': api_base} for api_base in failover]
+    # Attempts draw from the provider's rate limiter inside the hedged call, so
+    # its latency (and hedge delay) leaves out the time queued for a token
+    return HedgedProvider(model.label, targets, limiter=get_limiter(model.provider))
+
+# Clients, hedged providers (one per retrieval model), the embedding cache and
+# the embedding batcher. They are created by setup() from main(), not at import:
+# local embedding workers are spawned processes that re-import this module.
+client_bq = None
+query_providers = {}
+embedding_cache = None
+embedding_batcher = None
 
 def fetch_recent_articles(hours=24):
     recent_datetime = datetime.now() - timedelta(hours=hours)
@@ -76,96 +172,194 @@ def fetch_existing_titles():
     logging.info(f"Fetched {len(existing_titles)} existing titles")
     return existing_titles
 
+# Shared pool for provider calls, so the three providers run side by side
+# without starting threads per article
+embedding_executor = concurrent.futures.ThreadPoolExecutor(max_workers=6, thread_name_prefix='embeddings')
+
+def _call_providers(calls, deadline):
+    """
+    Runs one call per provider concurrently and waits for all of them up to one deadline.
+
+    Args:
+        calls (list of tuple): ``(provider, func)`` pairs.
+        deadline (float): Seconds to wait for the slowest provider.
+
+    Returns:
+        list: Each provider's result, or None if it failed or missed the deadline.
+    """
+    futures = [(provider, embedding_executor.submit(func)) for provider, func in calls]
+    concurrent.futures.wait([future for _, future in futures], timeout=deadline)
+    results = []
+    for provider, future in futures:
+        if not future.done():
+            # The request times out on its own; the article does not wait for it
+            future.cancel()
+            logging.error(f"{provider} embeddings missed the {deadline}s deadline")
+            results.append(None)
+        elif future.exception() is not None:
+            logging.error(f"Error generating {provider} embeddings: {future.exception()}")
+            results.append(None)
+        else:
+            results.append(future.result())
+    return results
+
 def generate_embeddings(text):
     text = str(text).strip()
     if text == '' or text == 'nan':
         logging.warning("Empty or NaN text encountered, returning empty embedding.")
-        return None, None, None
+        return (None,) * len(RETRIEVAL_MODELS)
 
     max_characters = 1450
     cleaned_text = ' '.join(text[:max_characters].split())
-    instances = [{"inputs": cleaned_text}]
 
-    try:
-        vertex_response = vertex_endpoint.predict(instances=instances)
-        vertex_embeddings = json.dumps(vertex_response.predictions[0][0])  # Flatten the nested array
-        logging.info(f"Vertex embeddings generated successfully, first 50 chars: {vertex_embeddings[:50]}")
-    except Exception as e:
-        logging.error(f"Error generating Vertex AI embeddings: {e}")
-        vertex_embeddings = ""
+    results = _call_providers([
+        (MODEL_LABELS[name], lambda name=name: _embed_batch(get_model(name), [cleaned_text])[0])
+        for name in RETRIEVAL_MODELS
+    ], EMBEDDING_DEADLINE)
 
-    try:
-        openai_response = openai.Embedding.create(
-            input=cleaned_text,
-            model="text-embedding-3-large"
-        )
-        openai_embeddings = json.dumps(openai_response['data'][0]['embedding'])
-        logging.info(f"OpenAI embeddings generated successfully, first 50 chars: {openai_embeddings[:50]}")
-    except Exception as e:
-        logging.error(f"Error generating OpenAI embeddings: {e}")
-        openai_embeddings = ""
+    for name, embeddings in zip(RETRIEVAL_MODELS, results):
+        if embeddings:
+            logging.info(f"{MODEL_LABELS[name]} embeddings generated successfully, first 50 chars: {embeddings[:50]}")
 
-    try:
-        logging.info("Generating Vertex AI Large Instruct embeddings...")
-        vertex_large_instruct_response = vertex_large_instruct_endpoint.predict(instances=instances)
-        vertex_large_instruct_embeddings = json.dumps(vertex_large_instruct_response.predictions[0][0])  # Flatten the nested array
-        logging.info(f"Vertex AI Large Instruct embeddings generated successfully, first 50 chars: {vertex_large_instruct_embeddings[:50]}")
-    except Exception as e:
-        logging.error(f"Error generating Vertex AI Large Instruct embeddings: {e}")
-        vertex_large_instruct_embeddings = ""
+    if not all(results):
+        logging.warning("One or more embedding generations failed.")
 
-    if not vertex_embeddings or not openai_embeddings or not vertex_large_instruct_embeddings:
-        logging.warning("One or more embedding generations failed. Skipping this article.")
-        return None, None, None
+    # One JSON string per RETRIEVAL_MODELS entry; failed providers are returned as
+    # None so callers can decide whether to go on without them
+    return tuple(results)
 
-    return vertex_embeddings, openai_embeddings, vertex_large_instruct_embeddings
+def _embed_vertex_batch(model, texts):
+    def predict(missing):
+        instances = [{"inputs": text} for text in missing]
+        response = query_providers[model.name].call(
+            lambda endpoint: endpoint.predict(instances=instances, timeout=EMBEDDING_DEADLINE),
+            timeout=EMBEDDING_DEADLINE
+        )
+        return response.predictions
+
+    # Only texts not already in the shared cache reach the endpoint
+    predictions = embedding_cache.get_or_compute_many(model.cache_key, texts, predict)
+    return [json.dumps(prediction[0].tolist()) if prediction is not None else None for prediction in predictions]  # Flatten the nested arrays
+
+def _embed_openai_batch(model, texts):
+    def create(missing):
+        response = query_providers[model.name].call(
+            lambda target: openai.Embedding.create(
+                input=missing,
+                model=model.model_id,
+                request_timeout=EMBEDDING_DEADLINE,
+                **target
+            ),
+            timeout=EMBEDDING_DEADLINE
+        )
+        return [item['embedding'] for item in sorted(response['data'], key=lambda item: item['index'])]
 
-def fetch_vertex_embeddings():
-    query = f"""
-    SELECT ticker, embeddings
-    FROM test1-427219.stock_datasets.stocks
-    """
+    embeddings = embedding_cache.get_or_compute_many(model.cache_key, texts, create)
+    return [json.dumps(embedding.tolist()) if embedding is not None else None for embedding in embeddings]
 
-    query_job = client_bq.query(query)
-    results = [(row.ticker, np.array(json.loads(row.embeddings))) for row in query_job]
-    logging.info(f"Fetched {len(results)} Vertex embeddings")
+def _embed_batch(model, texts):
+    if model.provider == 'vertex':
+        return _embed_vertex_batch(model, texts)
+    return _embed_openai_batch(model, texts)
+
+def _embed_in_chunks(provider, embed_batch, texts, chunk_size):
+    results = []
+    for start in range(0, len(texts), chunk_size):
+        chunk = texts[start:start + chunk_size]
+        try:
+            vectors = embed_batch(chunk)
+            if len(vectors) != len(chunk):
+                raise ValueError(f"got {len(vectors)} embeddings for {len(chunk)} inputs")
+        except Exception as e:
+            logging.error(f"Error generating {provider} embeddings for a batch of {len(chunk)}: {e}")
+            if len(chunk) == 1:
+                vectors = [None]
+            else:
+                # Retry one by one so a single bad input does not sink the whole batch
+                vectors = _embed_in_chunks(provider, embed_batch, chunk, 1)
+        results.extend(vectors)
     return results
 
-def fetch_additional_embeddings(tickers):
-    query = f"""
-    SELECT ticker, openai_embeddings, embeddings_large_instruct
-    FROM test1-427219.stock_datasets.stocks
-    WHERE ticker IN UNNEST(@tickers)
+def generate_embeddings_batch(texts):
     """
+    Batched generate_embeddings(): sends lists of inputs to each provider.
 
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ArrayQueryParameter("tickers", "STRING", tickers)
-        ]
-    )
+    Returns:
+        list of tuple: One tuple of JSON strings per text, in RETRIEVAL_MODELS
+        order, with None for any provider that failed.
+    """
+    max_characters = 1450
+    cleaned = []
+    for text in texts:
+        text = str(text).strip()
+        cleaned.append('' if text == 'nan' else ' '.join(text[:max_characters].split()))
+    present = [i for i, text in enumerate(cleaned) if text]
+    if len(present) < len(texts):
+        logging.warning(f"{len(texts) - len(present)} empty or NaN texts in embedding batch, returning empty embeddings.")
+    inputs = [cleaned[i] for i in present]
+
+    # Providers run concurrently; each one still sends its chunks (of the model's
+    # registered batch size) in order
+    provider_results = _call_providers([
+        (MODEL_LABELS[model.name], lambda model=model:
+            _embed_in_chunks(MODEL_LABELS[model.name], lambda chunk: _embed_batch(model, chunk), inputs, model.batch_size))
+        for model in (get_model(name) for name in RETRIEVAL_MODELS)
+    ], EMBEDDING_BATCH_DEADLINE)
+
+    results = [[None] * len(RETRIEVAL_MODELS) for _ in texts]
+    for slot, vectors in enumerate(provider_results):
+        for i, vector in zip(present, vectors or []):
+            results[i][slot] = vector
+    logging.info(f"Generated embeddings for a batch of {len(inputs)} texts")
+    return [tuple(result) for result in results]
+
+TICKER_PATTERN = re.compile(r'\{\{TICKER \d+: ([A-Z]{1,5})\}\}')
+
+# Longest {{TICKER n: SYM}} token the streaming scan waits to see completed
+TICKER_TOKEN_MAX = 32
+
+# Characters compared to tell a growing stream from a retried one that started over
+TICKER_SCAN_ANCHOR = 32
+
+class TickerStreamScanner:
+    """
+    Finds {{TICKER n: SYM}} tokens in a streamed response as it grows.
 
-    query_job = client_bq.query(query, job_config=job_config)
-    results = [(row.ticker, np.array(json.loads(row.openai_embeddings)), np.array(json.loads(row.embeddings_large_instruct))) for row in query_job]
-    logging.info(f"Fetched embeddings for {len(results)} tickers")
-    return results
+    Each call gets the whole text so far; only what follows the last complete
+    token (or an unfinished one) is scanned, and ``anchor`` holds the text just
+    before that offset to notice a retried stream starting over.
+    """
 
-def cosine_similarity(v1, v2):
-    v1 = v1.flatten()
-    v2 = v2.flatten()
-    if np.linalg.norm(v1) == 0 or np.linalg.norm(v2) == 0:
-        return 0
-    return 1 - cosine(v1, v2)
+    def __init__(self):
+        self.offset = 0
+        self.anchor = ''
+
+    def scan(self, text):
+        """
+        Returns the tickers of the tokens completed since the previous call, in order.
+        """
+        offset = self.offset
+        if len(text) < offset or text[offset - len(self.anchor):offset] != self.anchor:
+            offset = 0
+        tickers = []
+        for match in TICKER_PATTERN.finditer(text, offset):
+            tickers.append(match.group(1))
+            offset = match.end()
+        # A token may be cut off at the end of the text; the next call starts at its opening braces
+        unfinished = text.find('{', max(offset, len(text) - TICKER_TOKEN_MAX))
+        self.offset = unfinished if unfinished != -1 else len(text)
+        self.anchor = text[max(0, self.offset - TICKER_SCAN_ANCHOR):self.offset]
+        return tickers
 
 def extract_tickers(text):
-    pattern = r'\{\{TICKER \d+: ([A-Z]{1,5})\}\}'
-    tickers = re.findall(pattern, text)
+    tickers = TICKER_PATTERN.findall(text)
     logging.info(f"Extracted tickers: {tickers}")
     return tickers
 
 def analyze_ticker(ticker):
     try:
         stock = yf.Ticker(ticker)
-        info = stock.info
+        info = get_limiter('yahoo_finance').call(lambda: stock.info)
 
         # Get current price or calculate the average of the day's high and low
         current_price = info.get('currentPrice')
@@ -195,6 +389,13 @@ def parse_predictions(text):
     logging.info(f"Extracted predictions: {predictions}")
     return predictions
 
+def new_article_id():
+    """
+    Returns a random article id that fits the INTEGER id column. Drawn from a
+    UUID rather than a small range, so ids of different articles do not collide.
+    """
+    return uuid.uuid4().int >> 65
+
 @retry(
     stop=stop_after_attempt(5),
     wait=wait_exponential(multiplier=1, min=4, max=60),
@@ -207,8 +408,15 @@ def parse_predictions(text):
         URLLib3SSLError
     ))
 )
-def insert_article_predictions(article_id, predictions, article_data, effect):
-    client = bigquery.Client(project=project_id)
+def insert_article_predictions(article_id, predictions, article_data, effect, replay=None):
+    """
+    Streams an article's prediction row into PREDICTIONS_TABLE_ID. A row built
+    in replay mode carries its ``replay`` tag (llm_cache.replay_tag) and goes to
+    the replay output instead.
+
+    Returns:
+        bool: True if the row was written.
+    """
 
     # Get current time in PST
     pst_timezone = pytz.timezone('US/Pacific')
@@ -238,12 +446,6 @@ def insert_article_predictions(article_id, predictions, article_data, effect):
     article_data = {
         "content": article_data.get("content", ""),
         "category": article_data.get("category", ""),
-        "embeddings": {
-            "model1": json.dumps(article_data['embeddings'].get('model1', "")),
-            "model2": json.dumps(article_data['embeddings'].get('model2', "")),
-            "model3": json.dumps(article_data['embeddings'].get('model3', "")),
-            "model4": json.dumps(article_data['embeddings'].get('model4', ""))  # If you have a fourth model, add its embeddings here
-        },
         "link": article_data.get("link", ""),
         "publication": article_data.get("publication", ""),
         "title": article_data.get("title", "")
@@ -262,235 +464,397 @@ def insert_article_predictions(article_id, predictions, article_data, effect):
             "title": article_data['title']
         }],
         "category": article_data['category'],
-        "embeddings": article_data['embeddings'],
         "stock_prediction": new_stock_predictions
     }
 
-    errors = client.insert_rows_json(f"{project_id}.backwards_testing.main", [new_row])
+    if replay is not None:
+        new_row["replay"] = replay
+        write_replay_rows(PREDICTIONS_TABLE_ID, [new_row])
+        return True
+
+    # The insert id lets BigQuery drop the duplicate if a retry resends the row
+    client = bigquery.Client(project=project_id)
+    errors = client.insert_rows_json(PREDICTIONS_TABLE_ID, [new_row], row_ids=[str(article_id)])
     if errors:
         logging.error(f"Errors occurred while inserting rows: {errors}")
-    else:
-        logging.info(f"New row inserted successfully with ID: {new_row['id']} at {formatted_date}")
-
-class AnthropicTimeoutError(Exception):
-    pass
-
-def anthropic_call_with_timeout(func, timeout, *args, **kwargs):
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future = executor.submit(func, *args, **kwargs)
-        try:
-            return future.result(timeout=timeout)
-        except concurrent.futures.TimeoutError:
-            raise AnthropicTimeoutError(f"Anthropic API call timed out after {timeout} seconds")
+        return False
+    logging.info(f"New row inserted successfully with ID: {new_row['id']} at {formatted_date}")
+    return True
 
 @retry(
     stop=stop_after_attempt(5),
     wait=wait_exponential(multiplier=1, min=4, max=60),
-    retry=retry_if_exception_type((anthropic.RateLimitError, requests.exceptions.RequestException, AnthropicTimeoutError, SSLError, URLLib3SSLError))
+    retry=retry_if_exception_type((
+        google_exceptions.ServerError,
+        google_exceptions.TooManyRequests,
+        google_exceptions.ServiceUnavailable,
+        requests.exceptions.RequestException,
+        SSLError,
+        URLLib3SSLError
+    ))
 )
-def retry_anthropic_call(func, *args, **kwargs):
-    try:
-        start_time = time.time()
-        response = anthropic_call_with_timeout(func, timeout=60, *args, **kwargs)
-        end_time = time.time()
-        logging.info(f"API call completed in {end_time - start_time:.2f} seconds")
-        logging.info(f"API Response: {response}")
-        return response
-    except (AnthropicTimeoutError, SSLError, URLLib3SSLError) as e:
-        logging.warning(f"API call failed due to timeout or SSL error. Retrying... Error: {e}")
-        time.sleep(random.uniform(1, 5))  # Add a random delay before retry
-        raise
-    except (anthropic.RateLimitError, requests.exceptions.RequestException) as e:
-        logging.warning(f"API call failed. Retrying... Error: {e}")
-        time.sleep(random.uniform(1, 5))  # Add a random delay before retry
-        raise
-    except Exception as e:
-        logging.error(f"Unexpected error in API call: {e}")
-        raise
+def insert_article_embeddings(content, embeddings):
+    """
+    Streams an article's embeddings into the side store, keyed by article_key(content).
+    Retried on its own, so a failure here never re-inserts the prediction row.
+    """
+    client = bigquery.Client(project=project_id)
+    entity = article_key(content)
+    embedding_rows = store_rows(entity, {
+        get_model(model): vector for model, vector in embeddings.items() if model in EMBEDDING_MODELS
+    }, content)
+    if not embedding_rows:
+        return
+    row_ids = [f"{row['entity']}:{row['model']}:{row['model_version']}" for row in embedding_rows]
+    errors = client.insert_rows_json(ARTICLE_EMBEDDINGS_TABLE_ID, embedding_rows, row_ids=row_ids)
+    if errors:
+        logging.error(f"Errors occurred while inserting article embeddings: {errors}")
 
-def main():
-    companies = fetch_vertex_embeddings()
-    backoff_time = 5  # Start with a 5-second backoff
+def embed_article(article_id, generated, required=RETRIEVAL_MODELS, allow_empty=False):
+    # allow_empty: the article can be ranked without any remote vector (the local
+    # first stage embeds it afterwards), so it goes ahead when every endpoint failed
+    generated = dict(zip(RETRIEVAL_MODELS, generated))
 
-    while True:
+    embeddings = {}
+    for model, value in generated.items():
+        if value is None:
+            continue
         try:
-            # Fetch articles from the last 24 hours
-            articles = fetch_recent_articles(hours=24)
-            existing_titles = fetch_existing_titles()
+            embeddings[model] = np.array(json.loads(value))
+        except json.JSONDecodeError as e:
+            logging.error(f"Error decoding JSON for {model} embeddings: {e}")
+        except Exception as e:
+            logging.error(f"Unexpected error processing {model} embeddings: {e}")
 
-            if not articles:
-                logging.info("No recent articles found. Sleeping before next iteration...")
-                time.sleep(backoff_time)
+    missing = [model for model in required if model not in embeddings]
+    if missing or not (embeddings or allow_empty):
+        logging.warning(f"Invalid embeddings ({', '.join(missing)}) for article ID {article_id}. Skipping...")
+        return None
+
+    logging.info(f"Generated embeddings for article ID {article_id}: {', '.join(embeddings) or 'none'}")
+    for model, vector in embeddings.items():
+        logging.debug(f"{MODEL_LABELS[model]} embeddings shape: {vector.shape}")
+    return embeddings
+
+def collect_pending_articles(articles, existing_titles, indexes, matcher, required=RETRIEVAL_MODELS, allow_empty=False):
+    # Articles needing embeddings are queued on the batcher first and resolved
+    # afterwards, so the whole backlog goes out in a few batched requests
+    queued = []
+    for article in articles:
+        logging.info(f"Article fetched: {article['title']} - {article['date']}")
+
+        article_title = article['title']
+
+        if article_title in existing_titles:
+            logging.info(f"Article with title '{article_title}' already processed. Skipping...")
+            continue
+
+        article_id = new_article_id()
+        logging.info(f"Embedding article ID: {article_id}")
+        try:
+            if not article['content'] or pd.isna(article['content']):
+                logging.warning(f"Empty or NaN content for article ID {article_id}. Skipping...")
+                continue
+
+            mentions = [ticker for ticker, _ in matcher.match(f"{article_title}\n{article['content']}")]
+            if len(mentions) >= ENTITY_FAST_PATH_MIN_HITS:
+                logging.info(f"Article ID {article_id} names {len(mentions)} tickers directly; skipping embeddings")
+                queued.append((article, article_id, None, mentions))
                 continue
 
-            for article in articles:
-                logging.info(f"Article fetched: {article['title']} - {article['date']}")
+            queued.append((article, article_id, embedding_batcher.submit(article['content']), mentions))
+        except Exception as e:
+            logging.error(f"Error embedding article ID {article_id}: {e}")
 
-                article_title = article['title']
+    pending = []
+    for article, article_id, future, mentions in queued:
+        if future is None:
+            pending.append((article, article_id, None, mentions))
+            continue
+        try:
+            embeddings = embed_article(article_id, future.result(), required, allow_empty)
+            if embeddings is None:
+                continue
 
-                if article_title in existing_titles:
-                    logging.info(f"Article with title '{article_title}' already processed. Skipping...")
+            # One malformed vector would otherwise fail the whole batch
+            mismatched = [model for model in embeddings if embeddings[model].size != indexes[model].dimension]
+            if mismatched:
+                logging.warning(f"Unexpected embedding dimensions for {', '.join(mismatched)} in article ID {article_id}")
+                for model in mismatched:
+                    del embeddings[model]
+                if not (embeddings or allow_empty) or any(model in mismatched for model in required):
+                    logging.warning(f"Skipping article ID {article_id}")
                     continue
 
-                article_id = random.randint(1, 10000)
-                logging.info(f"Processing article ID: {article_id}")
-                try:
-                    if not article['content'] or pd.isna(article['content']):
-                        logging.warning(f"Empty or NaN content for article ID {article_id}. Skipping...")
-                        continue
-
-                    article_content = article['content']
-                    vertex_embeddings, openai_embeddings, vertex_large_instruct_embeddings = generate_embeddings(article_content)
-
-                    if vertex_embeddings is None or openai_embeddings is None or vertex_large_instruct_embeddings is None:
-                        logging.warning(f"Invalid embeddings for article ID {article_id}. Skipping...")
-                        continue
-
-                    try:
-                        vertex_embeddings = np.array(json.loads(vertex_embeddings))
-                        openai_embeddings = np.array(json.loads(openai_embeddings))
-                        vertex_large_instruct_embeddings = np.array(json.loads(vertex_large_instruct_embeddings))
-                    except json.JSONDecodeError as e:
-                        logging.error(f"Error decoding JSON for embeddings: {e}")
-                        continue
-                    except Exception as e:
-                        logging.error(f"Unexpected error processing embeddings: {e}")
-                        continue
-
-                    logging.info(f"Generated embeddings for article ID {article_id}")
-                    logging.debug(f"Vertex embeddings shape: {vertex_embeddings.shape}")
-                    logging.debug(f"OpenAI embeddings shape: {openai_embeddings.shape}")
-                    logging.debug(f"Vertex large instruct embeddings shape: {vertex_large_instruct_embeddings.shape}")
-
-                    # Vertex AI Embeddings Comparison
-                    company_similarities_vertex = [
-                        (ticker, cosine_similarity(vertex_embeddings, embeddings))
-                        for ticker, embeddings in companies
-                    ]
-
-                    # After calculating similarities for Vertex AI
-                    top_100_vertex = sorted(company_similarities_vertex, key=lambda x: x[1], reverse=True)[:100]
-                    top_100_tickers = [ticker for ticker, _ in top_100_vertex]
-
-                    logging.info("Top 100 tickers used for additional embeddings:")
-                    logging.info(", ".join(top_100_tickers))
-
-                    # Fetch additional embeddings
-                    additional_embeddings = fetch_additional_embeddings(top_100_tickers)
-
-                    # Calculate similarities for OpenAI and Vertex AI Large Instruct
-                    company_similarities_openai = [
-                        (ticker, cosine_similarity(openai_embeddings, openai_emb))
-                        for ticker, openai_emb, _ in additional_embeddings
-                    ]
-
-                    company_similarities_vertex_large_instruct = [
-                        (ticker, cosine_similarity(vertex_large_instruct_embeddings, vertex_large_instruct_emb))
-                        for ticker, _, vertex_large_instruct_emb in additional_embeddings
-                    ]
-
-                    # Sort and get top 3 for each model
-                    top_companies_vertex = sorted(top_100_vertex, key=lambda x: x[1], reverse=True)[:3]
-                    top_companies_openai = sorted(company_similarities_openai, key=lambda x: x[1], reverse=True)[:3]
-                    top_companies_vertex_large_instruct = sorted(company_similarities_vertex_large_instruct, key=lambda x: x[1], reverse=True)[:3]
-
-                    # Print out the similar stocks
-                    logging.info("\nTop companies for Vertex AI Embeddings:")
-                    for ticker, similarity in top_companies_vertex:
-                        logging.info(f"{ticker}: {similarity}")
-
-                    logging.info("\nTop companies for OpenAI Embeddings:")
-                    for ticker, similarity in top_companies_openai:
-                        logging.info(f"{ticker}: {similarity}")
-
-                    logging.info("\nTop companies for Vertex AI Large Instruct Embeddings:")
-                    for ticker, similarity in top_companies_vertex_large_instruct:
-                        logging.info(f"{ticker}: {similarity}")
-
-                    prompt_path_stockprice = 'prompts/stockprice.txt'
-                    with open(prompt_path_stockprice, 'r') as file:
-                        static_prompt_stockprice = file.read()
-
-                    ticker_descriptions_vertex = [f"{{{{TICKER {i+1}: {ticker}}}}}" for i, (ticker, _) in enumerate(top_companies_vertex)]
-                    ticker_descriptions_openai = [f"{{{{TICKER {i+1}: {ticker}}}}}" for i, (ticker, _) in enumerate(top_companies_openai)]
-                    ticker_descriptions_vertex_large_instruct = [f"{{{{TICKER {i+1}: {ticker}}}}}" for i, (ticker, _) in enumerate(top_companies_vertex_large_instruct)]
-
-                    full_prompt_stockprice = f"{static_prompt_stockprice} Query: {article_content}. Vertex AI: " + ", ".join(ticker_descriptions_vertex) + ". OpenAI: " + ", ".join(ticker_descriptions_openai) + ". Vertex AI Large Instruct: " + ", ".join(ticker_descriptions_vertex_large_instruct) + "."
-
-                    logging.info(f"Constructed full prompt: {full_prompt_stockprice}")
-
-                    response_stockprice = retry_anthropic_call(
-                        client_anthropic.messages.create,
-                        max_tokens=3500,
-                        messages=[{"role": "user", "content": full_prompt_stockprice}],
-                        model="claude-3-5-sonnet@20240620"
-                    )
-                    response_text_stockprice = response_stockprice.content[0].text
+            pending.append((article, article_id, embeddings, mentions))
+        except Exception as e:
+            logging.error(f"Error embedding article ID {article_id}: {e}")
+    return pending
+
+async def predict_article(llm, article, article_id, embeddings, top_100_vertex, top_companies, mentions=(), deadline=None):
+    # One budget covers both LLM calls and the price lookups in between
+    deadline = deadline or Deadline(ARTICLE_DEADLINE)
+    article_content = article['content']
+    if top_100_vertex:
+        top_100_tickers = [ticker for ticker, _ in top_100_vertex]
+
+        logging.info("Top 100 tickers used for additional embeddings:")
+        logging.info(", ".join(top_100_tickers))
+
+    if mentions:
+        logging.info(f"Tickers mentioned in article: {', '.join(mentions)}")
+
+    # Cached LLM responses are scoped to the article, so replay finds them again
+    scope = text_key(article_content).hex()
 
-                    logging.info(f"API Response: {response_text_stockprice}")
+    prompt_path_stockprice = 'prompts/stockprice.txt'
+    static_prompt_stockprice, template_stockprice = load_template(prompt_path_stockprice)
 
-                    effect_pattern = r'\{\{effect: "(\w+)"\}\}'
-                    effect_match = re.search(effect_pattern, response_text_stockprice)
-                    effect = effect_match.group(1) if effect_match else "none"
+    ticker_descriptions_mentions = [f"{{{{TICKER {i+1}: {ticker}}}}}" for i, ticker in enumerate(mentions)]
 
-                    tickers = extract_tickers(response_text_stockprice)
+    if embeddings is None:
+        # Fast path: the article names its companies, related ones come from BM25
+        logging.info("\nTop companies for business summary matches:")
+        for ticker, score in top_companies['lexical']:
+            logging.info(f"{ticker}: {score}")
 
-                    if not tickers:
-                        logging.warning(f"No valid tickers found for article ID: {article_id}")
-                        continue
+        ticker_descriptions_lexical = [f"{{{{TICKER {i+1}: {ticker}}}}}" for i, (ticker, _) in enumerate(top_companies['lexical'])]
+        full_prompt_stockprice = f"{static_prompt_stockprice} Query: {article_content}. Mentioned: " + ", ".join(ticker_descriptions_mentions) + ". Related: " + ", ".join(ticker_descriptions_lexical) + "."
+    else:
+        # Remote models that failed for this article are replaced by the local ranking
+        prompt_models = [model for model in RETRIEVAL_MODELS if model in top_companies]
+        if len(prompt_models) < len(RETRIEVAL_MODELS) and 'local' in top_companies:
+            prompt_models.append('local')
+
+        # Print out the similar stocks
+        sections = []
+        for model in prompt_models:
+            logging.info(f"\nTop companies for {MODEL_LABELS[model]} Embeddings:")
+            for ticker, similarity in top_companies[model]:
+                logging.info(f"{ticker}: {similarity}")
+
+            ticker_descriptions = [f"{{{{TICKER {i+1}: {ticker}}}}}" for i, (ticker, _) in enumerate(top_companies[model])]
+            sections.append(f"{MODEL_LABELS[model]}: " + ", ".join(ticker_descriptions))
+
+        full_prompt_stockprice = f"{static_prompt_stockprice} Query: {article_content}. " + ". ".join(sections) + "."
+        if mentions:
+            full_prompt_stockprice += " Mentioned: " + ", ".join(ticker_descriptions_mentions) + "."
+
+    logging.info(f"Constructed full prompt: {full_prompt_stockprice}")
+
+    # Price lookups by ticker, started while stage 1 is still generating. Tickers only
+    # seen in a failed, retried attempt are looked up needlessly but never used.
+    price_lookups = {}
+    scanner = TickerStreamScanner()
+
+    def dispatch_tickers(text):
+        for ticker in scanner.scan(text):
+            if ticker not in price_lookups:
+                # analyze_ticker waits for the shared Yahoo Finance rate limiter
+                price_lookups[ticker] = asyncio.ensure_future(asyncio.to_thread(analyze_ticker, ticker))
+
+    # Where each answer came from, to tag rows built in replay mode
+    sources = []
+    response_text_stockprice = await llm.complete(full_prompt_stockprice, ANTHROPIC_MODEL, 3500, deadline=deadline,
+                                                  template=template_stockprice, scope=scope,
+                                                  on_text=dispatch_tickers if STAGE1_STREAMING else None,
+                                                  sources=sources)
+
+    logging.debug(f"API Response: {response_text_stockprice}")
+
+    effect_pattern = r'\{\{effect: "(\w+)"\}\}'
+    effect_match = re.search(effect_pattern, response_text_stockprice)
+    effect = effect_match.group(1) if effect_match else "none"
+
+    tickers = extract_tickers(response_text_stockprice)
+
+    if not tickers:
+        logging.warning(f"No valid tickers found for article ID: {article_id}")
+        return
+
+    dispatch_tickers(response_text_stockprice)
+    lookups = [price_lookups[ticker] for ticker in tickers]
+    _, pending = await asyncio.wait(lookups, timeout=deadline.remaining())
+    if pending:
+        raise DeadlineExceeded(f"Price lookups for article ID {article_id} exceeded the {deadline.seconds}s deadline")
+    ticker_analysis_results = [lookup.result() for lookup in lookups]
+
+    prices_info = ", ".join([f"{result['symbol']}: ${result['current_price']}" for result in ticker_analysis_results])
+
+    prompt_path_stock_analysis = 'prompts/stock_analysis.txt'
+    static_prompt_stock_analysis, template_stock_analysis = load_template(prompt_path_stock_analysis)
+
+    full_prompt_stock_analysis = f"{static_prompt_stock_analysis} Query: {article_content}. Prices: {prices_info}."
+
+    response_text_stock_analysis = await llm.complete(full_prompt_stock_analysis, ANTHROPIC_MODEL, 3500, deadline=deadline,
+                                                      template=template_stock_analysis, scope=scope,
+                                                      sources=sources)
+
+    logging.debug(f"API Response (Stock Analysis): {response_text_stock_analysis}")
+
+    predictions = parse_predictions(response_text_stock_analysis)
+
+    if predictions:
+        article_data = {
+            "title": article['title'],
+            "date": article['date'],
+            "author": article['author'],
+            "content": article_content,
+            "link": article['link'],
+            "publication": article['publication']
+        }
+        # A replay run writes nothing to BigQuery
+        replay = replay_tag(sources) if llm.cache.replay else None
+        inserted = await asyncio.to_thread(insert_article_predictions, article_id, predictions, article_data, effect,
+                                           replay)
+        if inserted and embeddings and replay is None:
+            await asyncio.to_thread(insert_article_embeddings, article_content, embeddings)
+    else:
+        logging.warning(f"No predictions to insert for article ID: {article_id}")
+
+async def predict_articles(jobs, concurrency=ARTICLE_CONCURRENCY):
+    """
+    Runs predict_article for many articles at once over one LLM client.
+
+    Args:
+        jobs (list of tuple): ``(article, article_id, embeddings, top_100_vertex,
+            top_companies, mentions)`` per article.
+        concurrency (int): Articles in progress at once.
+
+    Returns:
+        dict: The LLM client's counters for this run.
+    """
+    slots = asyncio.Semaphore(concurrency)
 
-                    ticker_analysis_results = []
-                    for ticker in tickers:
-                        ticker_analysis = analyze_ticker(ticker)
-                        ticker_analysis_results.append(ticker_analysis)
-                        time.sleep(1)  # Add a delay between requests to avoid rate limits
+    async def run(llm, article, article_id, *ranking):
+        async with slots:
+            logging.info(f"Processing article ID: {article_id}")
+            try:
+                await predict_article(llm, article, article_id, *ranking, deadline=Deadline(ARTICLE_DEADLINE))
+            except Exception as e:
+                logging.error(f"Error processing article ID {article_id}: {e}")
+
+    async with AsyncLLMClient(project_id) as llm:
+        await asyncio.gather(*(run(llm, *job) for job in jobs))
+        return llm.stats()
+
+def setup():
+    """
+    Creates the BigQuery client, the hedged query providers, the embedding
+    cache and the embedding batcher.
+    """
+    global client_bq, query_providers, embedding_cache, embedding_batcher
+    client_bq = bigquery.Client(project=project_id)
+    aiplatform.init(project=project_id, location='us-east1')
+    query_providers = {name: _hedged_provider(get_model(name)) for name in RETRIEVAL_MODELS}
+    embedding_cache = get_embedding_cache()
+    embedding_batcher = MicroBatcher(generate_embeddings_batch, max_batch_size=EMBEDDING_BATCH_SIZE,
+                                     max_wait=EMBEDDING_BATCH_WAIT, name='embedding batcher')
+
+def main():
+    setup()
+    snapshot_watcher = SnapshotWatcher()
+    if snapshot_watcher.get() is None:
+        refresh_snapshot(client_bq)
+    ensure_store(client_bq, ARTICLE_EMBEDDINGS_TABLE_ID)
+    backoff_time = 5  # Start with a 5-second backoff
 
-                    prices_info = ", ".join([f"{result['symbol']}: ${result['current_price']}" for result in ticker_analysis_results])
+    while True:
+        try:
+            # Pick up a newer embedding snapshot if one was published
+            snapshot = snapshot_watcher.get()
+            first_stage = FIRST_STAGE_MODEL if FIRST_STAGE_MODE == 'vertex_prefilter' else RETRIEVAL_MODELS[0]
+            local_embedder = get_local_embedder() if first_stage == LOCAL_MODEL else None
+            if first_stage == LOCAL_MODEL and (local_embedder is None or snapshot.local_model != local_embedder.model_id):
+                logging.warning(f"Local embedding model unavailable or not in the snapshot; using {MODEL_LABELS[RETRIEVAL_MODELS[0]]} for the first stage")
+                first_stage = RETRIEVAL_MODELS[0]
+            # Only the first-stage model is needed to rank an article; rerank models that
+            # failed are left out and the article goes ahead with the ones that answered
+            required = () if first_stage == LOCAL_MODEL or FIRST_STAGE_MODE == 'reduced' else (first_stage,)
+
+            indexes = {model: snapshot.index(model) for model in RETRIEVAL_MODELS}
+            # The first stage scans the whole universe, so it can use IVF or a quantized copy
+            if FIRST_STAGE_INDEX == 'auto':
+                indexes[first_stage] = snapshot.search_index(first_stage)
+            else:
+                indexes[first_stage] = snapshot.quantized_index(first_stage, FIRST_STAGE_INDEX)
 
-                    prompt_path_stock_analysis = 'prompts/stock_analysis.txt'
-                    with open(prompt_path_stock_analysis, 'r') as file:
-                        static_prompt_stock_analysis = file.read()
+            # Fetch articles from the last 24 hours
+            articles = fetch_recent_articles(hours=24)
+            existing_titles = fetch_existing_titles()
 
-                    full_prompt_stock_analysis = f"{static_prompt_stock_analysis} Query: {article_content}. Prices: {prices_info}."
-                    print()
+            if not articles:
+                logging.info("No recent articles found. Sleeping before next iteration...")
+                time.sleep(backoff_time)
+                continue
 
-                    response_stock_analysis = retry_anthropic_call(
-                        client_anthropic.messages.create,
-                        max_tokens=3500,
-                        messages=[{"role": "user", "content": full_prompt_stock_analysis}],
-                        model="claude-3-5-sonnet@20240620"
+            # With the local first stage an article is ranked even when every remote endpoint failed
+            pending = collect_pending_articles(articles, existing_titles, indexes, snapshot.entity_matcher(), required,
+                                               allow_empty=first_stage == LOCAL_MODEL)
+            lexical_index = snapshot.lexical_index()
+            embedded = [entry for entry in pending if entry[2] is not None]
+
+            if embedded and first_stage == LOCAL_MODEL:
+                local_vectors = local_embedder.embed([article['content'] for article, _, _, _ in embedded])
+                for (_, _, embeddings, _), vector in zip(embedded, local_vectors):
+                    embeddings[LOCAL_MODEL] = vector
+
+            if embedded:
+                models = [first_stage] + [model for model in RETRIEVAL_MODELS if model != first_stage]
+                queries = {model: [embeddings.get(model) for _, _, embeddings, _ in embedded] for model in models}
+                if FIRST_STAGE_MODE == 'reduced':
+                    # Every model searches the whole universe on reduced vectors
+                    reduced_indexes = {model: snapshot.reduced_index(model) for model in RETRIEVAL_MODELS}
+                    rankings = [([], top_companies) for top_companies in independent_top_k_batch(reduced_indexes, queries, k=3)]
+                else:
+                    # Score the whole backlog at once: first-stage top 100, reranked in-process
+                    # with the remaining models
+                    rankings = two_stage_rerank_batch(
+                        indexes,
+                        queries,
+                        first_stage=first_stage,
+                        shortlist=100,
+                        k=3
                     )
-                    response_text_stock_analysis = response_stock_analysis.content[0].text
-
-                    logging.info(f"API Response (Stock Analysis): {response_text_stock_analysis}")
-
-                    predictions = parse_predictions(response_text_stock_analysis)
-
-                    if predictions:
-                        article_data = {
-                            "title": article['title'],
-                            "date": article['date'],
-                            "author": article['author'],
-                            "content": article_content,
-                            "link": article['link'],
-                            "publication": article['publication'],
-                            "embeddings": {
-                                "model1": vertex_embeddings.tolist(),
-                                "model2": openai_embeddings.tolist(),
-                                "model3": vertex_large_instruct_embeddings.tolist(),
-                                "model4": ""  # If you have a fourth model, add its embeddings here
-                            }
-                        }
-                        insert_article_predictions(article_id, predictions, article_data, effect)
-                    else:
-                        logging.warning(f"No predictions to insert for article ID: {article_id}")
+                logging.info(f"Ranked {len(embedded)} pending articles against {len(snapshot)} tickers")
+                if HYBRID_LEXICAL:
+                    for (article, _, _, _), (top_100_vertex, top_companies) in zip(embedded, rankings):
+                        target = 'vertex' if 'vertex' in top_companies else first_stage
+                        if target not in top_companies:
+                            continue
+                        dense = top_100_vertex if target == first_stage and top_100_vertex else top_companies[target]
+                        lexical = lexical_index.top_k(article['content'], len(dense))
+                        top_companies[target] = fuse_rankings([dense, lexical], k=3)
+            else:
+                rankings = []
+            rankings = iter(rankings)
 
+            jobs = []
+            for article, article_id, embeddings, mentions in pending:
+                try:
+                    if embeddings is None:
+                        mentions = mentions[:FAST_PATH_CANDIDATES]
+                        mentioned = set(mentions)
+                        related = lexical_index.top_k(article['content'], FAST_PATH_CANDIDATES + len(mentions))
+                        related = [(ticker, score) for ticker, score in related if ticker not in mentioned]
+                        top_100_vertex = []
+                        top_companies = {'lexical': related[:max(0, FAST_PATH_CANDIDATES - len(mentions))]}
+                    else:
+                        top_100_vertex, top_companies = next(rankings)
+                    jobs.append((article, article_id, embeddings, top_100_vertex, top_companies, mentions))
                 except Exception as e:
                     logging.error(f"Error processing article ID {article_id}: {e}")
-                    logging.debug(f"Vertex embeddings shape: {vertex_embeddings.shape}")
-                    logging.debug(f"OpenAI embeddings shape: {openai_embeddings.shape}")
-                    logging.debug(f"Vertex large instruct embeddings shape: {vertex_large_instruct_embeddings.shape}")
 
+            # Articles go through both LLM stages concurrently
+            if jobs:
+                logging.info(f"Anthropic requests: {asyncio.run(predict_articles(jobs))}")
+                logging.info(f"LLM response cache: {get_llm_cache().stats()}")
+
+            logging.info(f"Embedding cache: {embedding_cache.stats()}")
+            for provider in query_providers.values():
+                logging.info(f"{provider.name} requests: {provider.stats()}")
+            for provider in ('anthropic', 'yahoo_finance'):
+                logging.info(f"{provider} rate limiter: {get_limiter(provider).stats()}")
             logging.info("Sleeping for 30 minutes before next iteration...")
             time.sleep(300)  # Sleep for 5 minutes
 
@@ -0,0 +1,107 @@
+import time
+import queue
+import logging
+import threading
+import concurrent.futures
+
+# -------------------- Configuration --------------------
+
+# Largest number of items handed to one batch call
+DEFAULT_MAX_BATCH_SIZE = 32
+
+# Longest time the first item of a batch waits for more items, in seconds
+DEFAULT_MAX_WAIT = 0.05
+
+# -------------------------------------------------------
+
+_CLOSE = object()
+
+
+class MicroBatcher:
+    """
+    Collects individually submitted items into size- and time-bounded batches.
+
+    Callers submit one item at a time and get a Future back; a background
+    thread passes up to ``max_batch_size`` items to ``process_batch`` at once,
+    waiting at most ``max_wait`` seconds after the first item for the batch to
+    fill. Results are fanned back to each caller's Future in order.
+    """
+
+    def __init__(self, process_batch, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait=DEFAULT_MAX_WAIT, name='batcher'):
+        """
+        Args:
+            process_batch (callable): Takes a list of items and returns a list
+                of results of the same length and order.
+            max_batch_size (int): Largest batch passed to ``process_batch``.
+            max_wait (float): Seconds to wait for a batch to fill.
+            name (str): Name of the worker thread, used in logs.
+        """
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.name = name
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        """
+        Queues one item for the next batch.
+
+        Returns:
+            concurrent.futures.Future: Resolves to the item's result.
+        """
+        future = concurrent.futures.Future()
+        self._queue.put((item, future))
+        return future
+
+    def map(self, items):
+        """
+        Submits every item and waits for all results, in order.
+        """
+        futures = [self.submit(item) for item in items]
+        return [future.result() for future in futures]
+
+    def close(self):
+        """
+        Processes everything already submitted, then stops the worker thread.
+        """
+        self._queue.put(_CLOSE)
+        self._thread.join()
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is _CLOSE:
+            return None, True
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                entry = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is _CLOSE:
+                return batch, True
+            batch.append(entry)
+        return batch, False
+
+    def _run(self):
+        closing = False
+        while not closing:
+            batch, closing = self._collect()
+            if not batch:
+                continue
+            items = [item for item, _ in batch]
+            try:
+                results = self.process_batch(items)
+                if len(results) != len(items):
+                    raise ValueError(f"{self.name} returned {len(results)} results for {len(items)} items")
+            except Exception as e:
+                logging.error(f"Error processing {self.name} batch of {len(items)}: {e}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            logging.debug(f"{self.name} processed a batch of {len(items)}")
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,96 @@
+import os
+import logging
+import argparse
+from google.cloud import bigquery
+from embedding_models import EMBEDDING_MODELS
+from embedding_storage import ARTICLE_KEY_SQL, ensure_store
+
+# -------------------- Configuration --------------------
+
+os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = '...'
+PROJECT_ID = '...'
+PREDICTIONS_TABLE_ID = f"{PROJECT_ID}.backwards_testing.main"
+ARTICLE_EMBEDDINGS_TABLE_ID = f"{PROJECT_ID}.backwards_testing.article_embeddings"
+
+# embeddings.modelN field of the predictions rows -> registered model it held
+LEGACY_FIELDS = {
+    'model1': 'vertex',
+    'model2': 'openai',
+    'model3': 'vertex_large_instruct',
+}
+
+# -------------------------------------------------------
+
+
+def copy_statement(field, model):
+    """
+    SQL copying one legacy embeddings field into the side store, skipping
+    empty values and articles the store already has for that model.
+
+    Rows are keyed by article_key (a hash of the content), not by id: legacy
+    ids were random and collide, while rows sharing a content hash are the
+    same article, so keeping any one of them is correct.
+    """
+    return f"""
+    INSERT INTO `{ARTICLE_EMBEDDINGS_TABLE_ID}` (entity, model, model_version, vector, content_fingerprint, updated_at)
+    SELECT {ARTICLE_KEY_SQL}, @model, @model_version,
+           ARRAY(
+               SELECT CAST(value AS FLOAT64)
+               FROM UNNEST(JSON_VALUE_ARRAY(p.embeddings.{field})) AS value WITH OFFSET AS position
+               ORDER BY position
+           ),
+           NULL, CURRENT_TIMESTAMP()
+    FROM `{PREDICTIONS_TABLE_ID}` p
+    LEFT JOIN `{ARTICLE_EMBEDDINGS_TABLE_ID}` s
+      ON s.entity = {ARTICLE_KEY_SQL} AND s.model = @model AND s.model_version = @model_version
+    WHERE p.content[SAFE_OFFSET(0)] IS NOT NULL AND s.entity IS NULL
+      AND ARRAY_LENGTH(JSON_VALUE_ARRAY(p.embeddings.{field})) > 0
+    QUALIFY ROW_NUMBER() OVER (PARTITION BY {ARTICLE_KEY_SQL}) = 1
+    """
+
+
+def migrate(client, drop_column=False):
+    """
+    Moves article embeddings out of the prediction rows.
+
+    Copies every non-empty embeddings.modelN value into the side store, then
+    nulls the embeddings record (or drops the column) so reads of the
+    predictions table stop scanning vector text. Safe to re-run: copies skip
+    articles already in the store. Rows still in the streaming buffer cannot
+    be updated, so run it when no pipeline has inserted for ~30 minutes.
+
+    Args:
+        client (bigquery.Client): BigQuery client.
+        drop_column (bool): Drop the embeddings column instead of nulling it.
+    """
+    ensure_store(client, ARTICLE_EMBEDDINGS_TABLE_ID)
+    for field, model_name in LEGACY_FIELDS.items():
+        model = EMBEDDING_MODELS[model_name]
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("model", "STRING", model.name),
+            bigquery.ScalarQueryParameter("model_version", "STRING", model.version),
+        ])
+        job = client.query(copy_statement(field, model_name), job_config=job_config)
+        job.result()
+        logging.info(f"Copied {job.num_dml_affected_rows} embeddings.{field} values as {model.name}")
+
+    if drop_column:
+        client.query(f"ALTER TABLE `{PREDICTIONS_TABLE_ID}` DROP COLUMN IF EXISTS embeddings").result()
+        logging.info(f"Dropped the embeddings column of {PREDICTIONS_TABLE_ID}")
+    else:
+        job = client.query(f"UPDATE `{PREDICTIONS_TABLE_ID}` SET embeddings = NULL WHERE embeddings IS NOT NULL")
+        job.result()
+        logging.info(f"Cleared embeddings on {job.num_dml_affected_rows} prediction rows")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move article embeddings from prediction rows to the side store.")
+    parser.add_argument('--drop-column', action='store_true',
+                        help="Drop the embeddings column instead of setting it to NULL (not reversible)")
+    args = parser.parse_args()
+    migrate(bigquery.Client(project=PROJECT_ID), args.drop_column)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
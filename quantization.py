@@ -0,0 +1,279 @@
+import os
+import json
+import logging
+import argparse
+import numpy as np
+from similarity import SimilarityIndex, normalize_queries, normalize_vector, select_top_k
+
+# -------------------- Configuration --------------------
+
+# Shortlist rescored in float32 is max(k * factor, MIN_RESCORE_SHORTLIST); sign bits
+# are much coarser than int8 so binary mode rescores a deeper shortlist
+RESCORE_FACTOR = {'int8': 10, 'binary': 40}
+MIN_RESCORE_SHORTLIST = 200
+
+# Rows dequantized per matrix product during first-stage scoring
+SCORE_CHUNK_ROWS = 16384
+
+QUANTIZATION_MODES = ('int8', 'binary')
+
+# -------------------------------------------------------
+
+
+def quantize_int8(matrix):
+    """
+    Quantizes unit-length rows to int8 with one symmetric scale per row.
+
+    Args:
+        matrix (numpy.ndarray): 2-D float array.
+
+    Returns:
+        tuple: ``(codes, scales)`` where ``codes`` is int8 and ``scales`` is
+        float32 such that ``codes * scales[:, None]`` approximates the rows.
+    """
+    codes = np.empty(matrix.shape, dtype=np.int8)
+    scales = np.empty(matrix.shape[0], dtype=np.float32)
+    for start in range(0, matrix.shape[0], SCORE_CHUNK_ROWS):
+        chunk = np.asarray(matrix[start:start + SCORE_CHUNK_ROWS], dtype=np.float32)
+        chunk_scales = np.abs(chunk).max(axis=1) / 127.0
+        chunk_scales[chunk_scales == 0] = 1.0
+        codes[start:start + SCORE_CHUNK_ROWS] = np.clip(np.rint(chunk / chunk_scales[:, None]), -127, 127)
+        scales[start:start + SCORE_CHUNK_ROWS] = chunk_scales
+    return codes, scales
+
+
+def quantize_binary(matrix):
+    """
+    Packs the sign of every dimension into bits (1 bit per dimension).
+
+    Args:
+        matrix (numpy.ndarray): 2-D float array.
+
+    Returns:
+        numpy.ndarray: uint8 array of shape ``(rows, ceil(dim / 8))``.
+    """
+    return np.packbits(np.asarray(matrix) > 0, axis=1)
+
+
+if hasattr(np, 'bitwise_count'):
+    _popcount = np.bitwise_count
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def _popcount(values):
+        return _POPCOUNT_TABLE[values]
+
+
+class QuantizedIndex:
+    """
+    Two-pass cosine search: a compact int8 or binary copy of the universe
+    scores every ticker, then the float32 rows of a shortlist are rescored
+    exactly.
+
+    Only the quantized codes need to stay resident; the float32 matrix is
+    normally a memory-mapped snapshot file of which only shortlist rows are
+    ever touched. Positions and the candidate/batch interface match
+    SimilarityIndex, so it drops into two_stage_rerank().
+    """
+
+    def __init__(self, tickers, rescore_matrix, mode='int8', codes=None, scales=None, bits=None,
+                 rescore_factor=None, min_shortlist=MIN_RESCORE_SHORTLIST):
+        """
+        Args:
+            tickers (list of str): Ticker for each row.
+            rescore_matrix (numpy.ndarray): Unit-length float32 rows used for rescoring.
+            mode (str): 'int8' or 'binary'.
+            codes, scales (numpy.ndarray, optional): Precomputed int8 codes and row scales.
+            bits (numpy.ndarray, optional): Precomputed packed sign bits.
+            rescore_factor (int, optional): Shortlist size as a multiple of k.
+                Defaults to RESCORE_FACTOR for the mode.
+            min_shortlist (int): Smallest shortlist rescored in float32.
+        """
+        if mode not in QUANTIZATION_MODES:
+            raise ValueError(f"Unknown quantization mode '{mode}', expected one of {QUANTIZATION_MODES}")
+        self.exact = SimilarityIndex(tickers, rescore_matrix, normalized=True)
+        self.tickers = self.exact.tickers
+        self.mode = mode
+        self.rescore_factor = rescore_factor or RESCORE_FACTOR[mode]
+        self.min_shortlist = min_shortlist
+        if mode == 'int8':
+            if codes is None or scales is None:
+                codes, scales = quantize_int8(rescore_matrix)
+            self.codes, self.scales = codes, scales
+        else:
+            self.bits = bits if bits is not None else quantize_binary(rescore_matrix)
+
+    def __len__(self):
+        return len(self.tickers)
+
+    @property
+    def dimension(self):
+        return self.exact.dimension
+
+    @property
+    def nbytes(self):
+        """Bytes held by the quantized copy (what has to stay resident)."""
+        if self.mode == 'int8':
+            return self.codes.nbytes + self.scales.nbytes
+        return self.bits.nbytes
+
+    def approximate_scores(self, queries):
+        """
+        Scores a batch of unit-length queries against the quantized universe.
+
+        Returns:
+            numpy.ndarray: ``(queries, universe)`` approximate similarities.
+            Binary mode returns the number of agreeing sign bits, which ranks
+            the same way as the Hamming similarity.
+        """
+        n = len(self.tickers)
+        scores = np.empty((queries.shape[0], n), dtype=np.float32)
+        if self.mode == 'int8':
+            for start in range(0, n, SCORE_CHUNK_ROWS):
+                chunk = self.codes[start:start + SCORE_CHUNK_ROWS].astype(np.float32)
+                chunk *= self.scales[start:start + SCORE_CHUNK_ROWS, None]
+                scores[:, start:start + SCORE_CHUNK_ROWS] = queries @ chunk.T
+        else:
+            query_bits = quantize_binary(queries)
+            nbits = self.bits.shape[1] * 8
+            for i, packed in enumerate(query_bits):
+                for start in range(0, n, SCORE_CHUNK_ROWS):
+                    differing = _popcount(np.bitwise_xor(self.bits[start:start + SCORE_CHUNK_ROWS], packed)).sum(axis=1)
+                    scores[i, start:start + SCORE_CHUNK_ROWS] = nbits - differing
+        return scores
+
+    def shortlist_size(self, k):
+        return min(len(self.tickers), max(k * self.rescore_factor, self.min_shortlist))
+
+    def top_k_positions_batch(self, queries, k, candidates=None):
+        if candidates is not None:
+            # Candidate subsets are small; score them exactly
+            return self.exact.top_k_positions_batch(queries, k, candidates)
+        queries = normalize_queries(queries)
+        if queries.shape[1] != self.dimension:
+            raise ValueError(f"Queries have {queries.shape[1]} dimensions, index has {self.dimension}")
+        approximate = self.approximate_scores(queries)
+        shortlist = self.shortlist_size(k)
+        results = []
+        for query, scores in zip(queries, approximate):
+            rows = np.sort(select_top_k(scores, shortlist))
+            results.append(self.exact.top_k_positions(query, k, candidates=rows))
+        return results
+
+    def top_k_positions(self, query, k, candidates=None):
+        if candidates is not None:
+            return self.exact.top_k_positions(query, k, candidates)
+        return self.top_k_positions_batch([normalize_vector(query)], k)[0]
+
+    def top_k(self, query, k, candidates=None):
+        positions, scores = self.top_k_positions(query, k, candidates)
+        return [(self.tickers[i], float(score)) for i, score in zip(positions, scores)]
+
+    def top_k_batch(self, queries, k, candidates=None):
+        return [
+            [(self.tickers[i], float(score)) for i, score in zip(positions, scores)]
+            for positions, scores in self.top_k_positions_batch(queries, k, candidates)
+        ]
+
+
+def save_quantized(path, model, matrix):
+    """
+    Writes int8 codes, row scales and packed sign bits for one model next to its matrix.
+
+    Args:
+        path (str): Snapshot version directory.
+        model (str): Model name used as the file prefix.
+        matrix (numpy.ndarray): Unit-length float32 rows.
+    """
+    codes, scales = quantize_int8(matrix)
+    np.save(os.path.join(path, f"{model}.int8.npy"), codes)
+    np.save(os.path.join(path, f"{model}.scales.npy"), scales)
+    np.save(os.path.join(path, f"{model}.bits.npy"), quantize_binary(matrix))
+
+
+def load_quantized(path, model, tickers, rescore_matrix, mode='int8'):
+    """
+    Loads the quantized copy written by save_quantized(), quantizing on the fly
+    for snapshots that predate it.
+
+    Returns:
+        QuantizedIndex: The index.
+    """
+    if mode == 'int8':
+        codes_path = os.path.join(path, f"{model}.int8.npy")
+        if os.path.exists(codes_path):
+            return QuantizedIndex(tickers, rescore_matrix, mode, codes=np.load(codes_path, mmap_mode='r'),
+                                  scales=np.load(os.path.join(path, f"{model}.scales.npy")))
+    else:
+        bits_path = os.path.join(path, f"{model}.bits.npy")
+        if os.path.exists(bits_path):
+            return QuantizedIndex(tickers, rescore_matrix, mode, bits=np.load(bits_path, mmap_mode='r'))
+    return QuantizedIndex(tickers, rescore_matrix, mode)
+
+
+def overlap_report(snapshot, models, k_values=(3, 100), queries=200, noise=0.02, seed=0):
+    """
+    Compares quantized top-k results with exact float32 results on a snapshot.
+
+    Queries are universe rows with a little Gaussian noise added, so they sit
+    among the tickers like real article embeddings do.
+
+    Returns:
+        list of dict: One entry per (model, mode, k) with mean top-k overlap,
+        the fraction of queries with an identical top-k, and memory sizes.
+    """
+    rng = np.random.default_rng(seed)
+    report = []
+    for model in models:
+        matrix = snapshot.matrices[model]
+        sample = np.sort(rng.choice(matrix.shape[0], min(queries, matrix.shape[0]), replace=False))
+        sample_queries = normalize_queries(matrix[sample] + rng.normal(scale=noise, size=(len(sample), matrix.shape[1])))
+        exact = snapshot.index(model)
+        for mode in QUANTIZATION_MODES:
+            index = snapshot.quantized_index(model, mode)
+            for k in k_values:
+                truth = exact.top_k_positions_batch(sample_queries, k)
+                found = index.top_k_positions_batch(sample_queries, k)
+                overlaps = [len(set(t.tolist()) & set(f.tolist())) / max(1, len(t)) for (t, _), (f, _) in zip(truth, found)]
+                identical = [np.array_equal(t, f) for (t, _), (f, _) in zip(truth, found)]
+                entry = {
+                    'model': model,
+                    'mode': mode,
+                    'k': k,
+                    'mean_overlap': float(np.mean(overlaps)),
+                    'identical_fraction': float(np.mean(identical)),
+                    'float32_bytes': int(matrix.shape[0] * matrix.shape[1] * 4),
+                    'quantized_bytes': int(index.nbytes),
+                }
+                logging.info(f"{model} {mode} top-{k}: overlap {entry['mean_overlap']:.4f}, "
+                             f"identical {entry['identical_fraction']:.4f}")
+                report.append(entry)
+    return report
+
+
+def main():
+    from embedding_snapshot import SNAPSHOT_DIR, SNAPSHOT_MODELS, load_snapshot
+
+    parser = argparse.ArgumentParser(description="Report quantized top-k overlap against float32 search.")
+    parser.add_argument('--snapshot-dir', default=SNAPSHOT_DIR)
+    parser.add_argument('--models', nargs='+', default=list(SNAPSHOT_MODELS))
+    parser.add_argument('--k', type=int, nargs='+', default=[3, 100])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--output', default=None, help="Write the report as JSON to this path")
+    args = parser.parse_args()
+
+    snapshot = load_snapshot(args.snapshot_dir)
+    if snapshot is None:
+        raise SystemExit(f"No embedding snapshot found in {args.snapshot_dir}")
+    report = overlap_report(snapshot, args.models, k_values=args.k, queries=args.queries)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    main()
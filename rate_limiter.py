@@ -0,0 +1,387 @@
+import os
+import re
+import time
+import asyncio
+import sqlite3
+import logging
+import threading
+import contextlib
+from datetime import datetime
+from deadline import DeadlineExceeded
+
+# -------------------- Configuration --------------------
+
+# Per provider: (starting requests per second, burst size, ceiling requests per
+# second). The rate climbs towards the ceiling while calls succeed and follows
+# the provider's rate-limit headers where it sends them. A starting rate can be
+# overridden with RATE_LIMIT_<PROVIDER>, e.g. RATE_LIMIT_YAHOO_FINANCE=0.5.
+PROVIDER_LIMITS = {
+    'anthropic': (1.0, 4, 10.0),
+    'vertex': (10.0, 20, 50.0),
+    'openai': (20.0, 40, 80.0),
+    'yahoo_finance': (1.0, 2, 5.0),
+    'fred': (2.0, 5, 2.0),            # FRED allows 120 requests per minute
+    'sendgrid': (5.0, 10, 10.0),
+    'twilio': (1.0, 1, 1.0),          # One SMS per second per long-code number
+}
+
+# Rate used for providers not listed above
+DEFAULT_LIMIT = (1.0, 1, 5.0)
+
+# A 429 multiplies the rate by this factor; each success adds this fraction of
+# the starting rate back (additive increase, multiplicative decrease)
+DECREASE_FACTOR = 0.5
+INCREASE_STEP = 0.05
+
+# The rate never drops below this fraction of the starting rate
+MIN_RATE_FRACTION = 0.05
+
+# SQLite file holding the buckets, so every process on the host (the pipelines,
+# their worker processes, the Flask app) draws from one bucket per provider and
+# the limits above are per host. An empty value keeps the buckets in memory,
+# per process; each process then gets the full rate.
+RATE_LIMIT_STATE_PATH = os.getenv(
+    'RATE_LIMIT_STATE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache', 'rate_limits.sqlite'),
+)
+
+# -------------------------------------------------------
+
+# Status codes and messages that mean "slow down"
+RATE_LIMIT_STATUS = 429
+RATE_LIMIT_MESSAGES = ('too many requests', 'rate limit')
+
+# Remaining-requests and reset headers, most specific first
+REMAINING_HEADERS = ('anthropic-ratelimit-requests-remaining', 'x-ratelimit-remaining-requests', 'x-ratelimit-remaining')
+RESET_HEADERS = ('anthropic-ratelimit-requests-reset', 'x-ratelimit-reset-requests', 'x-ratelimit-reset')
+
+_DURATION = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def _seconds_until(value):
+    """
+    Parses a reset or Retry-After header value into seconds from now: plain
+    seconds, an epoch timestamp, a duration such as '6m0s', or a date.
+    """
+    value = str(value).strip()
+    try:
+        number = float(value)
+        # Large values are epoch timestamps (SendGrid), small ones are delays
+        return number - time.time() if number > 1e9 else number
+    except ValueError:
+        pass
+    parts = _DURATION.findall(value)
+    if parts and ''.join(number + unit for number, unit in parts) == value:
+        return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+    try:
+        return datetime.fromisoformat(value).timestamp() - time.time()
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_to_datetime
+        return parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return None
+
+
+def is_rate_limit_error(error):
+    """
+    Tells whether an exception from any provider client means the request
+    was rate limited (HTTP 429 or the client's equivalent).
+    """
+    response = getattr(error, 'response', None)
+    for source in (error, response):
+        for attribute in ('status_code', 'status', 'code'):
+            if getattr(source, attribute, None) == RATE_LIMIT_STATUS:
+                return True
+    if type(error).__name__ in ('RateLimitError', 'YFRateLimitError', 'TooManyRequests'):
+        return True
+    message = str(error).lower()
+    return any(text in message for text in RATE_LIMIT_MESSAGES)
+
+
+def error_headers(error):
+    """
+    Returns the response headers carried by a provider exception, if any.
+    """
+    for source in (error, getattr(error, 'response', None)):
+        headers = getattr(source, 'headers', None)
+        if headers:
+            return headers
+    return None
+
+
+class RateLimiter:
+    """
+    Adaptive token bucket for one provider, shared by every thread and event
+    loop in the process and, with a ``state_path``, by every process on the host.
+
+    ``acquire`` reserves a token and waits until it is due, so callers are
+    served in arrival order without holding the lock while they wait. The
+    refill rate moves with what the provider says: successes raise it towards
+    ``max_rate``, a 429 halves it and pauses the bucket for the Retry-After
+    time, and rate-limit headers set it to the remaining quota over the time
+    to its reset.
+
+    A shared bucket lives in one SQLite row (WAL mode, like the response
+    caches); each change is a read-modify-write in an IMMEDIATE transaction,
+    so processes never hand out the same token. The counters in stats() stay
+    per process.
+    """
+
+    def __init__(self, name, rate, burst, max_rate=None, state_path=None):
+        """
+        Args:
+            name (str): Provider name used in logs.
+            rate (float): Starting requests per second.
+            burst (int): Requests allowed back to back after an idle period.
+            max_rate (float, optional): Highest rate the limiter adapts up to.
+            state_path (str, optional): SQLite file shared with other processes;
+                the bucket is process-local without one.
+        """
+        self.name = name
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.max_rate = max(max_rate or rate, rate)
+        self.min_rate = rate * MIN_RATE_FRACTION
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        self.state_path = state_path
+        self._db = None
+        self.acquired = 0
+        self.throttled = 0
+        self.timeouts = 0
+        self.waited = 0.0
+        if state_path:
+            os.makedirs(os.path.dirname(os.path.abspath(state_path)), exist_ok=True)
+            # Autocommit mode, so _state() controls the transactions
+            self._db = sqlite3.connect(state_path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    provider TEXT PRIMARY KEY,
+                    rate REAL NOT NULL,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    blocked_until REAL NOT NULL
+                )
+            """)
+            # The first process to start creates the bucket; later ones join it
+            self._db.execute(
+                "INSERT OR IGNORE INTO buckets (provider, rate, tokens, updated, blocked_until) VALUES (?, ?, ?, ?, ?)",
+                (name, self.rate, self._tokens, self._updated, self._blocked_until),
+            )
+
+    @contextlib.contextmanager
+    def _state(self):
+        # Holds the bucket for a read-modify-write: the thread lock and, for a
+        # shared bucket, a write transaction on its row. An exception leaves the
+        # shared row as it was.
+        with self._lock:
+            if self._db is None:
+                yield
+                return
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rate, self._tokens, self._updated, self._blocked_until = self._db.execute(
+                    "SELECT rate, tokens, updated, blocked_until FROM buckets WHERE provider = ?", (self.name,)
+                ).fetchone()
+                self.rate = min(self.max_rate, max(self.min_rate, rate))
+                yield
+                self._db.execute(
+                    "UPDATE buckets SET rate = ?, tokens = ?, updated = ?, blocked_until = ? WHERE provider = ?",
+                    (self.rate, self._tokens, self._updated, self._blocked_until, self.name),
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _reserve(self, tokens, timeout=None):
+        # Takes the tokens now (possibly going negative) and returns how long the
+        # caller must wait before using them. A wait longer than ``timeout``
+        # hands the tokens back and raises instead. Wall-clock time, so shared
+        # buckets agree across processes.
+        with self._state():
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            wait = max(-self._tokens / self.rate, self._blocked_until - now, 0.0)
+            if timeout is not None and wait > timeout:
+                self._tokens += tokens
+            else:
+                self.acquired += 1
+                self.waited += wait
+        if timeout is not None and wait > timeout:
+            with self._lock:
+                self.timeouts += 1
+            raise DeadlineExceeded(f"{self.name} rate limit wait of {wait:.1f}s exceeds the {timeout:.1f}s left")
+        return wait
+
+    def acquire(self, tokens=1, timeout=None):
+        """
+        Blocks until ``tokens`` requests may be sent.
+
+        Args:
+            tokens (int): Requests to reserve.
+            timeout (float, optional): Longest acceptable wait, in seconds,
+                typically ``deadline.remaining()``.
+
+        Returns:
+            float: Seconds waited.
+
+        Raises:
+            DeadlineExceeded: If the wait would exceed ``timeout``; no token is taken.
+        """
+        wait = self._reserve(tokens, timeout)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def acquire_async(self, tokens=1, timeout=None):
+        """
+        acquire() for coroutines: waits without blocking the event loop.
+        """
+        wait = self._reserve(tokens, timeout)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def success(self, headers=None):
+        """
+        Records a successful call, with its response headers when available.
+        """
+        with self._state():
+            self.rate = min(self.max_rate, self.rate + INCREASE_STEP * self.base_rate)
+        if headers:
+            self.update(headers)
+
+    def throttle(self, retry_after=None):
+        """
+        Records a 429: halves the rate and pauses the bucket for ``retry_after``
+        seconds (one token interval when the provider did not say).
+        """
+        with self._state():
+            self.rate = max(self.min_rate, self.rate * DECREASE_FACTOR)
+            pause = retry_after if retry_after is not None and retry_after > 0 else 1 / self.rate
+            self._blocked_until = max(self._blocked_until, time.time() + pause)
+            self._tokens = min(self._tokens, 0.0)
+            self.throttled += 1
+        logging.warning(f"{self.name} rate limited; pausing {pause:.1f}s, rate now {self.rate:.2f}/s")
+
+    def update(self, headers):
+        """
+        Follows the provider's rate-limit headers: the rate becomes the remaining
+        quota spread over the time to its reset, and an exhausted quota pauses
+        the bucket until the reset.
+        """
+        headers = {key.lower(): value for key, value in headers.items()}
+        remaining = next((headers[key] for key in REMAINING_HEADERS if key in headers), None)
+        reset = next((headers[key] for key in RESET_HEADERS if key in headers), None)
+        if remaining is None or reset is None:
+            return
+        try:
+            remaining = float(remaining)
+        except ValueError:
+            return
+        seconds = _seconds_until(reset)
+        if seconds is None or seconds <= 0:
+            return
+        with self._state():
+            if remaining <= 0:
+                self._blocked_until = max(self._blocked_until, time.time() + seconds)
+                self._tokens = min(self._tokens, 0.0)
+            else:
+                self.rate = min(self.max_rate, max(self.min_rate, remaining / seconds))
+
+    def observe_error(self, error):
+        """
+        Throttles when ``error`` is a rate-limit error, honouring its Retry-After.
+
+        Returns:
+            bool: Whether the error was a rate limit.
+        """
+        if not is_rate_limit_error(error):
+            return False
+        headers = error_headers(error)
+        retry_after = None
+        if headers:
+            headers = {key.lower(): value for key, value in headers.items()}
+            if 'retry-after' in headers:
+                retry_after = _seconds_until(headers['retry-after'])
+        self.throttle(retry_after)
+        if headers:
+            self.update(headers)
+        return True
+
+    @contextlib.contextmanager
+    def limit(self, tokens=1):
+        """
+        Acquires before the block runs, then records its outcome: a success
+        raises the rate, a rate-limit error throttles. Errors are re-raised.
+        """
+        self.acquire(tokens)
+        try:
+            yield self
+        except Exception as e:
+            self.observe_error(e)
+            raise
+        self.success()
+
+    def call(self, func, *args, **kwargs):
+        """
+        Runs ``func(*args, **kwargs)`` under limit() and returns its result.
+        """
+        with self.limit():
+            return func(*args, **kwargs)
+
+    @contextlib.asynccontextmanager
+    async def limit_async(self, tokens=1):
+        """
+        limit() for coroutines.
+        """
+        await self.acquire_async(tokens)
+        try:
+            yield self
+        except Exception as e:
+            self.observe_error(e)
+            raise
+        self.success()
+
+    def stats(self):
+        """
+        Returns the current rate and the acquire, throttle, timeout and wait counters.
+        """
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'acquired': self.acquired,
+                'throttled': self.throttled,
+                'timeouts': self.timeouts,
+                'waited': self.waited,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(provider):
+    """
+    Returns the process-wide limiter for ``provider`` (see PROVIDER_LIMITS),
+    sharing its bucket with the other processes on the host through
+    RATE_LIMIT_STATE_PATH when that is set.
+    """
+    with _limiters_lock:
+        if provider not in _limiters:
+            rate, burst, max_rate = PROVIDER_LIMITS.get(provider, DEFAULT_LIMIT)
+            override = os.getenv(f"RATE_LIMIT_{provider.upper()}")
+            if override:
+                rate = float(override)
+            _limiters[provider] = RateLimiter(provider, rate, burst, max_rate, state_path=RATE_LIMIT_STATE_PATH or None)
+        return _limiters[provider]
@@ -6,6 +6,7 @@ from google.cloud import bigquery
 import logging
 from datetime import datetime, timedelta
 import pytz
+from rate_limiter import get_limiter
 
 # Set your Google Cloud credentials
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = '...'
@@ -33,7 +34,8 @@ recommended_stocks = set()
 def send_sms(body, recipient_numbers):
     for number in recipient_numbers:
         try:
-            message = twilio_client.messages.create(
+            message = get_limiter('twilio').call(
+                twilio_client.messages.create,
                 body=body,
                 from_=twilio_phone_number,
                 to=number
@@ -52,7 +54,7 @@ def query_database():
     logging.info(f"Querying for articles since: {time_threshold_str} PST")
 
     query = f"""
-        SELECT *
+        SELECT id, date, sources, stock_prediction
         FROM `{full_table_id}`
         WHERE DATETIME(PARSE_DATETIME('%m-%d-%Y %I:%M %p', date)) >= PARSE_DATETIME('%m-%d-%Y %I:%M %p', '{time_threshold_str}')
         AND EXISTS (
@@ -0,0 +1,209 @@
+import os
+import json
+import shutil
+import logging
+import tempfile
+import numpy as np
+from similarity import normalize_rows, normalize_queries, select_top_k
+
+# -------------------- Configuration --------------------
+
+# First-stage reduction per snapshot model: ('prefix', dims) keeps the leading
+# dimensions of Matryoshka-trained vectors (text-embedding-3-large);
+# ('pca', dims) projects onto principal components fitted on the universe.
+REDUCED_DIMENSIONS = {
+    'openai': ('prefix', 256),
+    'vertex': ('pca', 128),
+    'vertex_large_instruct': ('pca', 128),
+}
+
+# Reduction for snapshot models not listed above (e.g. added through SNAPSHOT_MODELS)
+DEFAULT_REDUCTION = ('pca', 128)
+
+# Shortlist rescored at full dimension is max(k * RESCORE_FACTOR, MIN_RESCORE_SHORTLIST)
+RESCORE_FACTOR = 20
+MIN_RESCORE_SHORTLIST = 200
+
+# Rows used to fit the PCA projection
+PCA_SAMPLE_SIZE = 50000
+
+# -------------------------------------------------------
+
+
+def fit_pca(matrix, dims, sample_size=PCA_SAMPLE_SIZE, seed=0):
+    """
+    Fits a PCA projection on the universe rows.
+
+    Args:
+        matrix (numpy.ndarray): Unit-length float32 rows.
+        dims (int): Number of components to keep.
+        sample_size (int): Rows sampled to fit the projection.
+        seed (int): Sampling seed.
+
+    Returns:
+        tuple: ``(mean, components)`` with ``components`` of shape ``(dims, dim)``.
+    """
+    rng = np.random.default_rng(seed)
+    n = matrix.shape[0]
+    sample = matrix if n <= sample_size else matrix[np.sort(rng.choice(n, sample_size, replace=False))]
+    sample = np.asarray(sample, dtype=np.float64)
+    mean = sample.mean(axis=0)
+    covariance = np.cov(sample - mean, rowvar=False)
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    components = eigenvectors[:, np.argsort(eigenvalues)[::-1][:dims]].T
+    explained = eigenvalues[np.argsort(eigenvalues)[::-1][:dims]].sum() / max(eigenvalues.sum(), 1e-12)
+    logging.info(f"Fitted PCA to {dims} dimensions, {explained:.1%} of variance retained")
+    return mean.astype(np.float32), np.ascontiguousarray(components, dtype=np.float32)
+
+
+def reduction_for(model):
+    """
+    Returns the ``(method, dims)`` reduction for a snapshot model, falling
+    back to DEFAULT_REDUCTION for models without an entry.
+    """
+    return REDUCED_DIMENSIONS.get(model, DEFAULT_REDUCTION)
+
+
+class ReducedIndex:
+    """
+    First-stage search on truncated or PCA-projected vectors with exact
+    rescoring of a shortlist at full dimension.
+
+    Scoring the reduced matrix costs a fraction of a full-dimension scan, so
+    every model can search the whole universe instead of only the Vertex
+    top 100. Positions and the candidate/batch interface match
+    SimilarityIndex.
+    """
+
+    def __init__(self, exact, reduced_matrix, method, dims, mean=None, components=None,
+                 rescore_factor=RESCORE_FACTOR, min_shortlist=MIN_RESCORE_SHORTLIST):
+        """
+        Args:
+            exact (SimilarityIndex): Full-dimension index used for rescoring.
+            reduced_matrix (numpy.ndarray): Unit-length reduced rows.
+            method (str): 'prefix' or 'pca'.
+            dims (int): Reduced dimension.
+            mean, components (numpy.ndarray, optional): PCA projection.
+            rescore_factor (int): Shortlist size as a multiple of k.
+            min_shortlist (int): Smallest shortlist rescored at full dimension.
+        """
+        self.exact = exact
+        self.tickers = exact.tickers
+        self.reduced_matrix = reduced_matrix
+        self.method = method
+        self.dims = dims
+        self.mean = mean
+        self.components = components
+        self.rescore_factor = rescore_factor
+        self.min_shortlist = min_shortlist
+
+    @classmethod
+    def build(cls, exact, method, dims):
+        """
+        Builds the reduced matrix for an exact index.
+
+        Args:
+            exact (SimilarityIndex): Full-dimension index.
+            method (str): 'prefix' or 'pca'.
+            dims (int): Reduced dimension.
+
+        Returns:
+            ReducedIndex: The index.
+        """
+        if method == 'prefix':
+            index = cls(exact, None, method, min(dims, exact.dimension))
+        elif method == 'pca':
+            mean, components = fit_pca(exact.matrix, min(dims, exact.dimension))
+            index = cls(exact, None, method, components.shape[0], mean=mean, components=components)
+        else:
+            raise ValueError(f"Unknown reduction method '{method}'")
+        index.reduced_matrix = index.project(exact.matrix)
+        return index
+
+    def project(self, vectors):
+        """
+        Maps full-dimension vectors to unit-length reduced vectors.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim == 1:
+            vectors = vectors.reshape(1, -1)
+        if self.method == 'prefix':
+            return normalize_rows(vectors[:, :self.dims])
+        return normalize_rows((vectors - self.mean) @ self.components.T)
+
+    def save(self, path, model):
+        """
+        Writes the reduced matrix and projection next to a snapshot's matrices.
+
+        Files are written to a staging directory and moved into place with
+        os.replace, the config last, so a process loading concurrently sees
+        either no reduced index or a complete one.
+        """
+        staging_dir = tempfile.mkdtemp(prefix='.staging-', dir=path)
+        try:
+            arrays = {f"{model}.reduced.npy": self.reduced_matrix}
+            if self.method == 'pca':
+                arrays[f"{model}.pca_mean.npy"] = self.mean
+                arrays[f"{model}.pca_components.npy"] = self.components
+            for name, array in arrays.items():
+                np.save(os.path.join(staging_dir, name), array)
+            config = f"{model}.reduced.json"
+            with open(os.path.join(staging_dir, config), 'w') as file:
+                json.dump({'method': self.method, 'dims': self.dims}, file)
+            for name in [*arrays, config]:
+                os.replace(os.path.join(staging_dir, name), os.path.join(path, name))
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, model, exact):
+        """
+        Loads a reduced index written by save(), or returns None if there is none.
+        """
+        config_path = os.path.join(path, f"{model}.reduced.json")
+        if not os.path.exists(config_path):
+            return None
+        with open(config_path, 'r') as file:
+            config = json.load(file)
+        mean = components = None
+        if config['method'] == 'pca':
+            mean = np.load(os.path.join(path, f"{model}.pca_mean.npy"))
+            components = np.load(os.path.join(path, f"{model}.pca_components.npy"))
+        reduced_matrix = np.load(os.path.join(path, f"{model}.reduced.npy"), mmap_mode='r')
+        return cls(exact, reduced_matrix, config['method'], config['dims'], mean=mean, components=components)
+
+    def __len__(self):
+        return len(self.tickers)
+
+    @property
+    def dimension(self):
+        return self.exact.dimension
+
+    def shortlist_size(self, k):
+        return min(len(self.tickers), max(k * self.rescore_factor, self.min_shortlist))
+
+    def top_k_positions_batch(self, queries, k, candidates=None):
+        queries = normalize_queries(queries)
+        if candidates is not None:
+            return self.exact.top_k_positions_batch(queries, k, candidates)
+        if queries.shape[1] != self.dimension:
+            raise ValueError(f"Queries have {queries.shape[1]} dimensions, index has {self.dimension}")
+        reduced_scores = self.project(queries) @ self.reduced_matrix.T
+        shortlist = self.shortlist_size(k)
+        shortlists = [np.sort(select_top_k(scores, shortlist)) for scores in reduced_scores]
+        return self.exact.top_k_positions_batch(queries, k, candidates=shortlists)
+
+    def top_k_positions(self, query, k, candidates=None):
+        if candidates is not None:
+            return self.exact.top_k_positions(query, k, candidates)
+        return self.top_k_positions_batch([query], k)[0]
+
+    def top_k(self, query, k, candidates=None):
+        positions, scores = self.top_k_positions(query, k, candidates)
+        return [(self.tickers[i], float(score)) for i, score in zip(positions, scores)]
+
+    def top_k_batch(self, queries, k, candidates=None):
+        return [
+            [(self.tickers[i], float(score)) for i, score in zip(positions, scores)]
+            for positions, scores in self.top_k_positions_batch(queries, k, candidates)
+        ]
@@ -7,16 +7,20 @@ import anthropic
 import numpy as np
 from datetime import datetime, timedelta
 from google.cloud import bigquery, aiplatform
-from scipy.spatial.distance import cosine
 from anthropic import AnthropicVertex
 from google.api_core import retry
 from google.api_core import exceptions as google_exceptions
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from tenacity import retry, Retrying, stop_after_attempt, wait_exponential, retry_if_exception_type
 import requests
 import yfinance as yf
 import re
-import concurrent.futures
 import pytz
+from embedding_snapshot import SnapshotWatcher, refresh_snapshot
+from embedding_cache import get_embedding_cache, text_key
+from deadline import Deadline
+from llm_client import retry_policy
+from llm_cache import get_llm_cache, load_template, replay_tag, write_replay_rows
+from rate_limiter import get_limiter
 
 
 # Setup logging
@@ -31,13 +35,20 @@ full_table_id = f"{project_id}.{dataset_id}.{table_id}"
 client_bq = bigquery.Client(project=project_id)
 aiplatform.init(project=project_id, location='us-east1')
 
-# Initialize Anthropic client
-client_anthropic = AnthropicVertex(region="europe-west1", project_id=project_id)
+# Longest single Anthropic request, and the end-to-end budget for one article, in seconds
+ANTHROPIC_TIMEOUT = 60
+ARTICLE_DEADLINE = 240
+
+# Initialize Anthropic client; the HTTP client enforces the request timeout
+client_anthropic = AnthropicVertex(region="europe-west1", project_id=project_id,
+                                   timeout=ANTHROPIC_TIMEOUT, max_retries=0)
 
 # Endpoint for Vertex AI Model for generating embeddings
 endpoint_name = "...."
 endpoint = aiplatform.Endpoint(endpoint_name=endpoint_name)
 
+embedding_cache = get_embedding_cache()
+
 def fetch_recent_articles(days=2):
     recent_date = (datetime.utcnow() - timedelta(days=days)).strftime('%Y-%m-%d')
     query = f"""
@@ -71,29 +82,15 @@ def generate_embeddings(text):
     cleaned_text = ' '.join(text[:max_characters].split())
     instances = [{"inputs": cleaned_text}]
     try:
-        response = endpoint.predict(instances=instances)
-        return json.dumps(response.predictions[0])
+        prediction = embedding_cache.get_or_compute(
+            f"vertex:{endpoint_name}", cleaned_text,
+            lambda: get_limiter('vertex').call(endpoint.predict, instances=instances).predictions[0]
+        )
+        return json.dumps(prediction.tolist())
     except Exception as e:
         logging.error(f"Error generating embeddings: {e}")
         return ""
 
-def cosine_similarity(v1, v2):
-    v1 = v1.flatten()
-    v2 = v2.flatten()
-    if np.linalg.norm(v1) == 0 or np.linalg.norm(v2) == 0:
-        return 0
-    return 1 - cosine(v1, v2)
-
-def fetch_company_data():
-    query = """
-    SELECT ticker, long_business_summary, embeddings, name, sector
-    FROM `...`
-    """
-    query_job = client_bq.query(query)
-    data = [(row.ticker, row.long_business_summary, np.array(json.loads(row.embeddings)).flatten(),
-             row.name, row.sector) for row in query_job]
-    return data
-
 def extract_tickers(text):
     pattern = r'\{\{TICKER \d+: ([A-Z]{1,5})\}\}'
     tickers = re.findall(pattern, text)
@@ -101,7 +98,7 @@ def extract_tickers(text):
 
 def analyze_ticker(ticker):
     stock = yf.Ticker(ticker)
-    info = stock.info
+    info = get_limiter('yahoo_finance').call(lambda: stock.info)
     analysis = {
         'symbol': ticker,
         'current_price': info.get('currentPrice', 'No data available')
@@ -119,8 +116,7 @@ def parse_predictions(text):
     wait=wait_exponential(multiplier=1, min=4, max=10),
     retry=retry_if_exception_type((google_exceptions.ServerError, google_exceptions.TooManyRequests, google_exceptions.ServiceUnavailable, requests.exceptions.RequestException))
 )
-def insert_article_predictions(article_id, predictions, article_data):
-    client = bigquery.Client(project=project_id)
+def insert_article_predictions(article_id, predictions, article_data, replay=None):
     new_stock_predictions = [
         {
             "model": "model",
@@ -171,53 +167,82 @@ def insert_article_predictions(article_id, predictions, article_data):
         "stock_prediction": new_stock_predictions
     }
 
-    errors = client.insert_rows_json(f"{project_id}.backwards_testing.calls_together", [new_row])
+    table_id = f"{project_id}.backwards_testing.calls_together"
+    if replay is not None:
+        # Replay runs write nothing to BigQuery; the row keeps its replay tag
+        new_row["replay"] = replay
+        write_replay_rows(table_id, [new_row])
+        return
+
+    client = bigquery.Client(project=project_id)
+    errors = client.insert_rows_json(table_id, [new_row])
     if errors:
         logging.error(f"Errors occurred while inserting rows: {errors}")
     else:
         logging.info(f"New row inserted successfully with ID: {new_row['id']}")
 
-class AnthropicTimeoutError(Exception):
-    pass
-
-def anthropic_call_with_timeout(func, timeout, *args, **kwargs):
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future = executor.submit(func, *args, **kwargs)
-        try:
-            return future.result(timeout=timeout)
-        except concurrent.futures.TimeoutError:
-            raise AnthropicTimeoutError(f"Anthropic API call timed out after {timeout} seconds")
-
-@retry(
-    stop=stop_after_attempt(5),
-    wait=wait_exponential(multiplier=1, min=4, max=10),
-    retry=retry_if_exception_type((anthropic.RateLimitError, requests.exceptions.RequestException, AnthropicTimeoutError))
-)
-def retry_anthropic_call(func, *args, **kwargs):
+def _anthropic_attempt(func, deadline, *args, **kwargs):
+    limiter = get_limiter('anthropic')
+    # A rate-limit wait longer than the budget left fails now instead of sleeping past it
+    limiter.acquire(timeout=deadline.timeout(what="Anthropic rate limit wait"))
     try:
         start_time = time.time()
-        response = anthropic_call_with_timeout(func, timeout=60, *args, **kwargs)  # 60 seconds timeout
+        # Each attempt gets what is left of the budget, at most ANTHROPIC_TIMEOUT
+        raw = func(*args, timeout=deadline.timeout(ANTHROPIC_TIMEOUT, "Anthropic API call"), **kwargs)
+        limiter.success(raw.headers)
+        response = raw.parse()
         end_time = time.time()
         logging.info(f"API call completed in {end_time - start_time:.2f} seconds")
-        logging.info(f"API Response: {response}")
+        logging.debug(f"API Response: {response}")
         return response
-    except AnthropicTimeoutError as e:
+    except anthropic.APITimeoutError as e:
         logging.warning(f"API call timed out. Retrying... Error: {e}")
-        time.sleep(random.uniform(1, 3))  # Add a small random delay
-        raise  # Re-raise the exception to be caught by the retry decorator
-    except (anthropic.RateLimitError, requests.exceptions.RequestException) as e:
+        raise  # Re-raise the exception to be caught by the retry loop
+    except (anthropic.RateLimitError, anthropic.APIConnectionError) as e:
         logging.warning(f"API call failed. Retrying... Error: {e}")
-        time.sleep(random.uniform(1, 3))  # Add a small random delay
-        raise  # Re-raise the exception to be caught by the retry decorator
+        limiter.observe_error(e)
+        raise  # Re-raise the exception to be caught by the retry loop
     except Exception as e:
         logging.error(f"Unexpected error in API call: {e}")
         raise
 
+def retry_anthropic_call(func, *args, deadline=None, template=None, scope=None, sources=None, **kwargs):
+    """
+    Calls the Anthropic API with retries, all within ``deadline`` (a fresh
+    ARTICLE_DEADLINE when omitted), unless the LLM response cache already
+    holds the answer. ``sources`` collects where the answer came from, as in
+    AsyncLLMClient.complete().
+
+    Returns:
+        str: Text of the response.
+
+    Raises:
+        DeadlineExceeded: If the budget ran out before an attempt could start.
+        LLMCacheMiss: In replay mode, when the answer is not cached.
+    """
+    cache = get_llm_cache()
+    text, source = cache.lookup(kwargs, template, scope)
+    if sources is not None:
+        sources.append(source or 'api')
+    if text is not None:
+        logging.info(f"Answered {template or kwargs.get('model')} call from the LLM response cache")
+        return text
+    deadline = deadline or Deadline(ARTICLE_DEADLINE)
+    retrying = Retrying(**retry_policy(deadline, max_wait=10))
+    text = retrying(_anthropic_attempt, func, deadline, *args, **kwargs).content[0].text
+    cache.put(kwargs, text, template, scope)
+    return text
+
 def main():
-    companies = fetch_company_data()
+    snapshot_watcher = SnapshotWatcher()
+    if snapshot_watcher.get() is None:
+        refresh_snapshot(client_bq)
 
     while True:
         try:
+            # Pick up a newer embedding snapshot if one was published
+            companies = snapshot_watcher.get().index('vertex')
+
             articles = fetch_recent_articles()
             existing_titles = fetch_existing_titles()
 
@@ -229,28 +254,35 @@ def main():
                 article_id = random.randint(1, 10000)
                 logging.info(f"Processing article ID: {article_id}")
                 try:
+                    # One budget covers both LLM calls and the price lookups in between
+                    deadline = Deadline(ARTICLE_DEADLINE)
                     article_content = article['content']
                     query_embedding = generate_embeddings(article_content)
                     query_embedding = json.dumps(np.array(json.loads(query_embedding)).tolist())
 
-                    company_similarities = [(ticker, summary, name, sector, cosine_similarity(np.array(json.loads(query_embedding)), embeddings))
-                                            for ticker, summary, embeddings, name, sector in companies]
-                    top_companies = sorted(company_similarities, key=lambda x: x[4], reverse=True)[:7]
+                    top_companies = companies.top_k(np.array(json.loads(query_embedding)), 7)
+
+                    # Cached LLM responses are scoped to the article, so replay finds them again
+                    scope = text_key(article_content).hex()
 
                     prompt_path_stockprice = 'prompts/stockprice.txt'
-                    with open(prompt_path_stockprice, 'r') as file:
-                        static_prompt_stockprice = file.read()
+                    static_prompt_stockprice, template_stockprice = load_template(prompt_path_stockprice)
 
-                    ticker_descriptions = [f"{{{{TICKER {i+1}: {ticker}}}}}" for i, (ticker, _, _, _, _) in enumerate(top_companies)]
+                    ticker_descriptions = [f"{{{{TICKER {i+1}: {ticker}}}}}" for i, (ticker, _) in enumerate(top_companies)]
                     full_prompt_stockprice = f"{static_prompt_stockprice} Query: {article_content}. " + ", ".join(ticker_descriptions) + "."
 
-                    response_stockprice = retry_anthropic_call(
-                        client_anthropic.messages.create,
+                    # Where each answer came from, to tag rows built in replay mode
+                    sources = []
+                    response_text_stockprice = retry_anthropic_call(
+                        client_anthropic.messages.with_raw_response.create,
                         max_tokens=3500,
                         messages=[{"role": "user", "content": full_prompt_stockprice}],
-                        model="claude-3-5-sonnet@20240620"
+                        model="claude-3-5-sonnet@20240620",
+                        deadline=deadline,
+                        template=template_stockprice,
+                        scope=scope,
+                        sources=sources
                     )
-                    response_text_stockprice = response_stockprice.content[0].text
 
                     tickers = extract_tickers(response_text_stockprice)
 
@@ -260,25 +292,28 @@ def main():
 
                     ticker_analysis_results = []
                     for ticker in tickers:
+                        deadline.check(f"Price lookups for article ID {article_id}")
+                        # analyze_ticker waits for the shared Yahoo Finance rate limiter
                         ticker_analysis = analyze_ticker(ticker)
                         ticker_analysis_results.append(ticker_analysis)
-                        time.sleep(12)  # Add a delay between requests to avoid rate limits
 
                     prices_info = ", ".join([f"{result['symbol']}: ${result['current_price']}" for result in ticker_analysis_results])
 
                     prompt_path_stock_analysis = 'prompts/stock_analysis.txt'
-                    with open(prompt_path_stock_analysis, 'r') as file:
-                        static_prompt_stock_analysis = file.read()
+                    static_prompt_stock_analysis, template_stock_analysis = load_template(prompt_path_stock_analysis)
 
                     full_prompt_stock_analysis = f"{static_prompt_stock_analysis} Query: {article_content}. Prices: {prices_info}."
 
-                    response_stock_analysis = retry_anthropic_call(
-                        client_anthropic.messages.create,
+                    response_text_stock_analysis = retry_anthropic_call(
+                        client_anthropic.messages.with_raw_response.create,
                         max_tokens=3500,
                         messages=[{"role": "user", "content": full_prompt_stock_analysis}],
-                        model="claude-3-5-sonnet@20240620"
+                        model="claude-3-5-sonnet@20240620",
+                        deadline=deadline,
+                        template=template_stock_analysis,
+                        scope=scope,
+                        sources=sources
                     )
-                    response_text_stock_analysis = response_stock_analysis.content[0].text
 
                     predictions = parse_predictions(response_text_stock_analysis)
 
@@ -292,16 +327,14 @@ def main():
                             "publication": article['publication'],
                             "embeddings": query_embedding
                         }
-                        insert_article_predictions(article_id, predictions, article_data)
+                        replay = replay_tag(sources) if get_llm_cache().replay else None
+                        insert_article_predictions(article_id, predictions, article_data, replay)
                     else:
                         logging.warning(f"No predictions to insert for article ID: {article_id}")
 
                 except Exception as e:
                     logging.error(f"Error processing article ID {article_id}: {e}")
 
-                # Add a delay between processing articles to avoid hitting the rate limit
-                time.sleep(12)
-
             logging.info("Sleeping for 30 minutes before next iteration...")
             time.sleep(1800)  # Sleep for 30 minutes
 
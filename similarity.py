@@ -0,0 +1,340 @@
+import logging
+import numpy as np
+
+
+def normalize_rows(matrix):
+    """
+    Returns a contiguous float32 copy of the matrix with every row scaled to unit length.
+
+    Rows with a zero norm are left as zeros so they score 0 against any query,
+    which matches the behaviour of the old per-ticker cosine_similarity().
+
+    Args:
+        matrix (array-like): 2-D array of embeddings, one row per entity.
+
+    Returns:
+        numpy.ndarray: C-contiguous float32 array of the same shape.
+    """
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(matrix / norms, dtype=np.float32)
+
+
+def normalize_vector(vector):
+    """
+    Flattens a query embedding and scales it to unit length as float32.
+
+    Args:
+        vector (array-like): The query embedding (any shape, it is flattened).
+
+    Returns:
+        numpy.ndarray: 1-D float32 array. A zero vector is returned unchanged.
+    """
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        return vector
+    return vector / norm
+
+
+def normalize_queries(queries):
+    """
+    Stacks query embeddings into a float32 matrix of unit-length rows.
+
+    Args:
+        queries (array-like): Sequence of query embeddings or a 2-D array.
+
+    Returns:
+        numpy.ndarray: 2-D float32 array with one row per query.
+    """
+    if isinstance(queries, np.ndarray) and queries.ndim == 2:
+        return normalize_rows(queries)
+    return normalize_rows(np.stack([np.asarray(query, dtype=np.float32).ravel() for query in queries]))
+
+
+def select_top_k(scores, k, tiebreak=None):
+    """
+    Returns the positions of the k highest scores, best first.
+
+    Uses a partial selection instead of a full sort. Ties are broken by
+    position so the result is identical to a stable descending sort.
+
+    Args:
+        scores (numpy.ndarray): 1-D array of scores.
+        k (int): Number of positions to return.
+        tiebreak (numpy.ndarray, optional): Per-score keys used to break ties
+            instead of the position in ``scores``.
+
+    Returns:
+        numpy.ndarray: Integer positions into ``scores``.
+    """
+    n = scores.shape[0]
+    k = min(k, n)
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < n:
+        # Widen the partition to include every score tied with the k-th one,
+        # otherwise argpartition may drop an earlier-positioned tie.
+        kth = np.partition(scores, n - k)[n - k]
+        positions = np.flatnonzero(scores >= kth)
+    else:
+        positions = np.arange(n)
+    keys = positions if tiebreak is None else tiebreak[positions]
+    order = np.lexsort((keys, -scores[positions]))
+    return positions[order[:k]]
+
+
+class SimilarityIndex:
+    """
+    Exact cosine-similarity search over a fixed universe of ticker embeddings.
+
+    The universe is held as one contiguous float32 matrix of unit-length rows,
+    so scoring an article is a single matrix-vector product followed by a
+    partial top-k selection.
+    """
+
+    def __init__(self, tickers, matrix, normalized=False):
+        """
+        Args:
+            tickers (list of str): Ticker for each row of ``matrix``.
+            matrix (array-like): 2-D array of embeddings, one row per ticker.
+            normalized (bool): Set when ``matrix`` already holds unit-length
+                float32 rows (e.g. a memory-mapped snapshot) to avoid a copy.
+        """
+        self.tickers = list(tickers)
+        if normalized:
+            self.matrix = matrix
+        else:
+            self.matrix = normalize_rows(matrix)
+        if self.matrix.shape[0] != len(self.tickers):
+            raise ValueError(
+                f"Got {len(self.tickers)} tickers for {self.matrix.shape[0]} embedding rows"
+            )
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """
+        Builds an index from ``(ticker, embedding)`` pairs such as the output of
+        fetch_vertex_embeddings().
+
+        Args:
+            pairs (list of tuple): ``(ticker, embedding)`` pairs.
+
+        Returns:
+            SimilarityIndex: The index.
+        """
+        tickers = [ticker for ticker, _ in pairs]
+        if not pairs:
+            return cls(tickers, np.empty((0, 0), dtype=np.float32), normalized=True)
+        matrix = np.stack([np.asarray(embedding, dtype=np.float32).ravel() for _, embedding in pairs])
+        return cls(tickers, matrix)
+
+    def __len__(self):
+        return len(self.tickers)
+
+    @property
+    def dimension(self):
+        return self.matrix.shape[1]
+
+    def scores(self, query, candidates=None):
+        """
+        Scores a query embedding against the universe or a subset of it.
+
+        Args:
+            query (array-like): The article embedding.
+            candidates (array-like, optional): Row positions to score. Defaults
+                to every ticker in the universe.
+
+        Returns:
+            numpy.ndarray: Cosine similarity for each scored row.
+        """
+        query = normalize_vector(query)
+        if query.shape[0] != self.dimension:
+            raise ValueError(f"Query has {query.shape[0]} dimensions, index has {self.dimension}")
+        if candidates is None:
+            return self.matrix @ query
+        return self.matrix[np.asarray(candidates, dtype=np.int64)] @ query
+
+    def top_k_positions(self, query, k, candidates=None):
+        """
+        Returns the row positions and scores of the k best matches, best first.
+
+        Args:
+            query (array-like): The article embedding.
+            k (int): Number of rows to return.
+            candidates (array-like, optional): Restrict the search to these row positions.
+
+        Returns:
+            tuple: ``(positions, scores)`` as numpy arrays.
+        """
+        scores = self.scores(query, candidates)
+        selected = select_top_k(scores, k)
+        if candidates is None:
+            positions = selected
+        else:
+            positions = np.asarray(candidates, dtype=np.int64)[selected]
+        return positions, scores[selected]
+
+    def top_k(self, query, k, candidates=None):
+        """
+        Returns the k tickers most similar to the query, best first.
+
+        Args:
+            query (array-like): The article embedding.
+            k (int): Number of tickers to return.
+            candidates (array-like, optional): Restrict the search to these row positions.
+
+        Returns:
+            list of tuple: ``(ticker, similarity)`` pairs sorted by similarity.
+        """
+        positions, scores = self.top_k_positions(query, k, candidates)
+        logging.debug(f"Selected top {len(positions)} of {len(self.tickers)} tickers")
+        return [(self.tickers[i], float(score)) for i, score in zip(positions, scores)]
+
+    def top_k_positions_batch(self, queries, k, candidates=None):
+        """
+        Batched top_k_positions(): scores many queries with one matrix-matrix product.
+
+        Args:
+            queries (array-like): One embedding per article.
+            k (int): Number of rows to return per query.
+            candidates (list of array-like, optional): Per-query row positions to
+                restrict the search to. The union of all candidate sets is
+                scored in a single product.
+
+        Returns:
+            list of tuple: One ``(positions, scores)`` pair per query, identical
+            in order to calling top_k_positions() on each query.
+        """
+        queries = normalize_queries(queries)
+        if queries.shape[1] != self.dimension:
+            raise ValueError(f"Queries have {queries.shape[1]} dimensions, index has {self.dimension}")
+
+        if candidates is None:
+            scores = queries @ self.matrix.T
+            results = []
+            for row in scores:
+                selected = select_top_k(row, k)
+                results.append((selected, row[selected]))
+            return results
+
+        candidates = [np.asarray(rows, dtype=np.int64) for rows in candidates]
+        union = np.unique(np.concatenate(candidates)) if candidates else np.empty(0, dtype=np.int64)
+        scores = queries @ self.matrix[union].T
+        results = []
+        for row, rows in zip(scores, candidates):
+            # Keep each query's own candidate order so ties resolve like the single-query path.
+            row_scores = row[np.searchsorted(union, rows)]
+            selected = select_top_k(row_scores, k)
+            results.append((rows[selected], row_scores[selected]))
+        return results
+
+    def top_k_batch(self, queries, k, candidates=None):
+        """
+        Batched top_k(): returns one ``(ticker, similarity)`` list per query.
+        """
+        return [
+            [(self.tickers[i], float(score)) for i, score in zip(positions, scores)]
+            for positions, scores in self.top_k_positions_batch(queries, k, candidates)
+        ]
+
+
+def two_stage_rerank(indexes, queries, first_stage, shortlist=100, k=3):
+    """
+    Shortlists tickers with one model and reranks the shortlist with the others.
+
+    All indexes must share the same ticker order (as the indexes of one
+    EmbeddingSnapshot do), so the whole rerank runs in-process.
+
+    Args:
+        indexes (dict): Model name -> SimilarityIndex.
+        queries (dict): Model name -> article embedding for that model.
+        first_stage (str): Model used to build the shortlist.
+        shortlist (int): Number of tickers kept after the first stage.
+        k (int): Number of tickers returned per model.
+
+    Returns:
+        tuple: ``(shortlist_results, top_k_by_model)`` where ``shortlist_results``
+        is the first-stage ``(ticker, similarity)`` list and ``top_k_by_model``
+        maps each model to its own top k ``(ticker, similarity)`` list.
+    """
+    first_index = indexes[first_stage]
+    positions, scores = first_index.top_k_positions(queries[first_stage], shortlist)
+    shortlist_results = [(first_index.tickers[i], float(score)) for i, score in zip(positions, scores)]
+
+    top_k_by_model = {first_stage: shortlist_results[:k]}
+    for model, query in queries.items():
+        if model == first_stage:
+            continue
+        top_k_by_model[model] = indexes[model].top_k(query, k, candidates=positions)
+    return shortlist_results, top_k_by_model
+
+
+def two_stage_rerank_batch(indexes, queries, first_stage, shortlist=100, k=3):
+    """
+    Batched two_stage_rerank() for a backlog of articles.
+
+    Each model is scored with one matrix-matrix product for the whole batch:
+    the first stage against the full universe, the other models against the
+    union of the per-article shortlists.
+
+    Args:
+        indexes (dict): Model name -> SimilarityIndex.
+        queries (dict): Model name -> sequence of article embeddings, aligned
+            across models (row i is the same article for every model). A
+            rerank model's entry may be None for articles it could not embed.
+        first_stage (str): Model used to build the shortlists.
+        shortlist (int): Number of tickers kept after the first stage.
+        k (int): Number of tickers returned per model.
+
+    Returns:
+        list of tuple: One ``(shortlist_results, top_k_by_model)`` pair per
+        article, matching two_stage_rerank() for that article. Models with a
+        None embedding are missing from that article's mapping.
+    """
+    first_index = indexes[first_stage]
+    first_results = first_index.top_k_positions_batch(queries[first_stage], shortlist)
+    shortlists = [positions for positions, _ in first_results]
+
+    results = []
+    for positions, scores in first_results:
+        shortlist_results = [(first_index.tickers[i], float(score)) for i, score in zip(positions, scores)]
+        results.append((shortlist_results, {first_stage: shortlist_results[:k]}))
+
+    for model, model_queries in queries.items():
+        if model == first_stage:
+            continue
+        rows = [i for i, query in enumerate(model_queries) if query is not None]
+        if not rows:
+            continue
+        tops = indexes[model].top_k_batch([model_queries[i] for i in rows], k, candidates=[shortlists[i] for i in rows])
+        for i, top in zip(rows, tops):
+            results[i][1][model] = top
+    return results
+
+
+def independent_top_k_batch(indexes, queries, k=3):
+    """
+    Searches the whole universe with every model independently.
+
+    Args:
+        indexes (dict): Model name -> index over the full universe.
+        queries (dict): Model name -> sequence of article embeddings, aligned
+            across models. Entries may be None for articles a model could not embed.
+        k (int): Number of tickers returned per model.
+
+    Returns:
+        list of dict: One ``model -> (ticker, similarity) list`` mapping per
+        article, without the models that had no embedding for it.
+    """
+    results = [{} for _ in next(iter(queries.values()), [])]
+    for model, model_queries in queries.items():
+        rows = [i for i, query in enumerate(model_queries) if query is not None]
+        if not rows:
+            continue
+        for i, top in zip(rows, indexes[model].top_k_batch([model_queries[i] for i in rows], k)):
+            results[i][model] = top
+    return results
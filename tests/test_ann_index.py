@@ -0,0 +1,59 @@
+import numpy as np
+from ann_index import IVFIndex, build_index
+from similarity import SimilarityIndex
+
+
+def _universe(n=400, dim=16, seed=0):
+    rng = np.random.default_rng(seed)
+    return [f"T{i}" for i in range(n)], rng.normal(size=(n, dim)).astype(np.float32), rng
+
+
+def test_scanning_every_list_is_exact():
+    tickers, matrix, rng = _universe()
+    index = IVFIndex.build(tickers, matrix, nlist=8)
+    exact = SimilarityIndex(tickers, matrix)
+    for query in rng.normal(size=(5, 16)):
+        positions, scores = index.top_k_positions(query, 10, nprobe=index.nlist)
+        expected, expected_scores = exact.top_k_positions(query, 10)
+        assert positions.tolist() == expected.tolist()
+        np.testing.assert_allclose(scores, expected_scores, rtol=1e-5)
+
+
+def test_candidates_are_searched_exactly():
+    tickers, matrix, rng = _universe()
+    index = IVFIndex.build(tickers, matrix, nlist=8, nprobe=1)
+    exact = SimilarityIndex(tickers, matrix)
+    query = rng.normal(size=16)
+    candidates = np.arange(0, 400, 7)
+    assert index.top_k(query, 5, candidates=candidates) == exact.top_k(query, 5, candidates=candidates)
+
+
+def test_exact_index_restores_the_original_order():
+    tickers, matrix, _ = _universe(n=100)
+    index = IVFIndex.build(tickers, matrix, nlist=4)
+    np.testing.assert_allclose(index.exact_index().matrix, SimilarityIndex(tickers, matrix).matrix, rtol=1e-6)
+
+
+def test_save_and_load_round_trip(tmp_path):
+    tickers, matrix, rng = _universe(n=200)
+    index = IVFIndex.build(tickers, matrix, nlist=6, nprobe=2)
+    index.save(str(tmp_path))
+    loaded = IVFIndex.load(str(tmp_path))
+    assert loaded.tickers == tickers
+    assert loaded.nprobe == 2
+    query = rng.normal(size=16)
+    assert loaded.top_k(query, 5) == index.top_k(query, 5)
+    assert IVFIndex.load(str(tmp_path), nprobe=6).nprobe == 6
+
+
+def test_measure_recall_is_complete_with_every_list():
+    tickers, matrix, rng = _universe(n=200)
+    index = IVFIndex.build(tickers, matrix, nlist=4)
+    report = index.measure_recall(rng.normal(size=(5, 16)), k=5, nprobe_values=[4])
+    assert report[0]['recall'] == 1.0
+
+
+def test_build_index_uses_exact_search_for_small_universes():
+    tickers, matrix, _ = _universe(n=50)
+    assert isinstance(build_index(tickers, matrix, min_ann_universe=100), SimilarityIndex)
+    assert isinstance(build_index(tickers, matrix, min_ann_universe=10, nlist=4), IVFIndex)
@@ -0,0 +1,95 @@
+import json
+import threading
+from backfill_runner import BackfillProvider, BackfillRunner, CheckpointJournal
+from embedding_storage import content_fingerprint
+
+
+def test_journal_survives_a_restart_and_a_torn_line(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    journal = CheckpointJournal(path)
+    journal.record([('AAPL', 'vertex', 'abc'), ('MSFT', 'vertex', 'def')])
+    with open(path, 'a') as file:
+        file.write('{"key": "GOOG", "mod')
+    assert CheckpointJournal(path).done() == {('AAPL', 'vertex', 'abc'), ('MSFT', 'vertex', 'def')}
+    journal.clear()
+    assert CheckpointJournal(path).done() == set()
+
+
+def _runner(tmp_path, commits, fail=(), model=None, **options):
+    def embed(texts):
+        return [None if text in fail else len(text) for text in texts]
+
+    providers = [BackfillProvider('vertex', embed, workers=2, batch_size=2, model=model),
+                 BackfillProvider('openai', embed, workers=2)]
+    return BackfillRunner('test', providers, commits.extend, journal_path=str(tmp_path / 'test.jsonl'),
+                          progress_interval=3600, **options)
+
+
+def test_every_item_is_embedded_by_every_provider(tmp_path):
+    commits = []
+    stats = _runner(tmp_path, commits, commit_batch_size=2).run([('A', 'a'), ('B', 'bb'), ('C', 'ccc')])
+    assert stats == {'total': 3, 'skipped': 0, 'committed': 3, 'failed': 0}
+    assert sorted(commits) == [('A', {'vertex': 1, 'openai': 1}), ('B', {'vertex': 2, 'openai': 2}),
+                               ('C', {'vertex': 3, 'openai': 3})]
+    # A finished backfill clears its journal
+    assert not (tmp_path / 'test.jsonl').exists()
+
+
+def test_restart_skips_committed_items_until_their_text_or_model_changes(tmp_path):
+    commits = []
+    items = [('A', 'a'), ('B', 'bb'), ('C', 'ccc')]
+    stats = _runner(tmp_path, commits, fail={'bb'}).run(items)
+    assert stats['failed'] == 1
+    # Every provider failed on B, so it was neither written nor journaled
+    assert sorted(key for key, _ in commits) == ['A', 'C']
+    with open(tmp_path / 'test.jsonl') as file:
+        entries = [json.loads(line) for line in file]
+    assert sorted((entry['key'], entry['model'], entry['fingerprint']) for entry in entries) == [
+        ('A', 'vertex+openai', content_fingerprint('a')), ('C', 'vertex+openai', content_fingerprint('ccc')),
+    ]
+
+    commits.clear()
+    stats = _runner(tmp_path, commits).run([('A', 'a'), ('B', 'bb'), ('C', 'cccc')])
+    assert stats == {'total': 3, 'skipped': 1, 'committed': 2, 'failed': 0}
+    assert sorted(key for key, _ in commits) == ['B', 'C']
+
+
+def test_a_new_model_reruns_committed_items(tmp_path):
+    commits = []
+    _runner(tmp_path, commits, fail={'bb'}).run([('A', 'a'), ('B', 'bb')])
+    commits.clear()
+    stats = _runner(tmp_path, commits, model='vertex@2').run([('A', 'a'), ('B', 'bb')])
+    assert stats['skipped'] == 0
+    assert sorted(key for key, _ in commits) == ['A', 'B']
+
+
+def test_failed_commit_leaves_items_for_the_next_run(tmp_path):
+    def embed(texts):
+        return [1.0 for _ in texts]
+
+    def commit(batch):
+        raise RuntimeError("MERGE failed")
+
+    runner = BackfillRunner('test', [BackfillProvider('vertex', embed)], commit,
+                            journal_path=str(tmp_path / 'test.jsonl'))
+    stats = runner.run([('A', 'a'), ('B', 'b')])
+    assert stats['committed'] == 0
+    assert stats['failed'] == 2
+    assert runner.journal.done() == set()
+
+
+def test_provider_errors_count_as_failures(tmp_path):
+    lock = threading.Lock()
+    calls = []
+
+    def embed(texts):
+        with lock:
+            calls.append(texts)
+        raise RuntimeError("quota")
+
+    commits = []
+    runner = BackfillRunner('test', [BackfillProvider('vertex', embed)], commits.extend,
+                            journal_path=str(tmp_path / 'test.jsonl'))
+    assert runner.run([('A', 'a')])['failed'] == 1
+    assert commits == []
+    assert calls == [['a']]
@@ -0,0 +1,35 @@
+import time
+import pytest
+from deadline import Deadline, DeadlineExceeded, stop_at_deadline, wait_within
+
+
+def test_timeout_is_capped_by_the_remaining_budget():
+    deadline = Deadline(10)
+    assert deadline.timeout(2) == 2
+    assert 9 < deadline.timeout() <= 10
+    assert not deadline.expired()
+
+
+def test_expired_deadline_raises():
+    deadline = Deadline(0)
+    assert deadline.expired()
+    assert deadline.remaining() == 0.0
+    with pytest.raises(DeadlineExceeded, match="API call"):
+        deadline.timeout(5, "API call")
+    with pytest.raises(TimeoutError):
+        deadline.check()
+
+
+def test_sleep_stops_at_the_deadline():
+    deadline = Deadline(0.05)
+    start_time = time.monotonic()
+    deadline.sleep(5)
+    assert time.monotonic() - start_time < 1
+    assert deadline.expired()
+
+
+def test_retry_helpers_respect_the_budget():
+    assert not stop_at_deadline(Deadline(10))(None)
+    assert stop_at_deadline(Deadline(0.5))(None)
+    assert wait_within(Deadline(10), lambda retry_state: 4)(None) == 4
+    assert wait_within(Deadline(1), lambda retry_state: 4)(None) <= 1
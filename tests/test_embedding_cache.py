@@ -0,0 +1,85 @@
+import time
+import threading
+import numpy as np
+import pytest
+from embedding_cache import EmbeddingCache, text_key
+
+
+def test_text_key_ignores_whitespace():
+    assert text_key("Apple  makes\nphones ") == text_key("Apple makes phones")
+    assert text_key("Apple") != text_key("apple")
+
+
+def test_vectors_round_trip_with_their_shape(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / 'embeddings.sqlite'))
+    cache.put_many('vertex', ['a', 'b', 'c'], [np.arange(3), np.ones((2, 2)), None])
+    a, b, c = cache.get_many('vertex', ['a', 'b', 'c'])
+    np.testing.assert_array_equal(a, np.arange(3, dtype=np.float32))
+    assert b.shape == (2, 2)
+    assert c is None
+    assert cache.get('openai', 'a') is None
+    assert cache.stats()['hits'] == 2
+
+
+def test_get_or_compute_only_computes_misses(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / 'embeddings.sqlite'))
+    cache.put('vertex', 'a', [1.0])
+    calls = []
+
+    def compute(texts):
+        calls.append(list(texts))
+        return [[float(len(text))] for text in texts]
+
+    results = cache.get_or_compute_many('vertex', ['a', 'bb', 'bb', 'ccc'], compute)
+    assert calls == [['bb', 'ccc']]
+    assert [result.tolist() for result in results] == [[1.0], [2.0], [2.0], [3.0]]
+    assert cache.get('vertex', 'ccc').tolist() == [3.0]
+
+
+def test_concurrent_misses_are_coalesced(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / 'embeddings.sqlite'))
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute(texts):
+        calls.append(texts)
+        started.set()
+        release.wait(5)
+        return [[1.0] for _ in texts]
+
+    results = {}
+    owner = threading.Thread(target=lambda: results.update(owner=cache.get_or_compute('vertex', 'a', lambda: compute(['a'])[0])))
+    owner.start()
+    assert started.wait(5)
+    waiter = threading.Thread(target=lambda: results.update(waiter=cache.get_or_compute('vertex', 'a', lambda: compute(['a'])[0])))
+    waiter.start()
+    give_up = time.monotonic() + 5
+    while not cache.stats()['coalesced'] and time.monotonic() < give_up:
+        time.sleep(0.001)
+    release.set()
+    owner.join(5)
+    waiter.join(5)
+    assert len(calls) == 1
+    assert results['owner'].tolist() == results['waiter'].tolist() == [1.0]
+
+
+def test_failed_compute_is_raised_and_not_cached(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / 'embeddings.sqlite'))
+
+    def compute(texts):
+        raise RuntimeError("quota")
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_compute_many('vertex', ['a'], compute)
+    assert cache.get_or_compute('vertex', 'a', lambda: [2.0]).tolist() == [2.0]
+
+
+def test_eviction_drops_least_recently_used(tmp_path):
+    vector = np.zeros(256, dtype=np.float32)
+    cache = EmbeddingCache(str(tmp_path / 'embeddings.sqlite'), max_bytes=3 * vector.nbytes)
+    cache.put_many('vertex', ['old', 'mid', 'new', 'newest'], [vector] * 4)
+    cache.get('vertex', 'old')
+    cache.evict()
+    remaining = cache.get_many('vertex', ['old', 'mid', 'new', 'newest'])
+    assert [result is not None for result in remaining].count(True) == 2
+    assert remaining[0] is not None
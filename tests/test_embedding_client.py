@@ -0,0 +1,107 @@
+import time
+import threading
+import pytest
+from embedding_client import MIN_HEDGE_DELAY, MIN_LATENCY_SAMPLES, HedgedProvider, LatencyTracker
+from rate_limiter import RateLimiter
+
+
+def _fast_provider(targets, **options):
+    provider = HedgedProvider('test', targets, **options)
+    # Enough quick samples that the hedge delay drops to its floor
+    for _ in range(MIN_LATENCY_SAMPLES):
+        provider.latency.record(0.001)
+    return provider
+
+
+def test_latency_percentile_needs_enough_samples():
+    tracker = LatencyTracker()
+    tracker.record(1.0)
+    assert tracker.percentile(95, default=2.0) == 2.0
+    for _ in range(MIN_LATENCY_SAMPLES):
+        tracker.record(1.0)
+    assert tracker.percentile(95) == 1.0
+
+
+def test_targets_are_required():
+    with pytest.raises(ValueError):
+        HedgedProvider('test', [])
+
+
+def test_primary_answers_without_a_hedge():
+    provider = HedgedProvider('test', ['primary', 'secondary'], max_hedge_ratio=1.0)
+    assert provider.call(lambda target: target) == 'primary'
+    assert provider.stats()['hedges'] == 0
+    assert provider.stats()['failovers'] == 0
+
+
+def test_a_failed_attempt_fails_over_to_the_next_target():
+    def request(target):
+        if target == 'primary':
+            raise ConnectionError("primary down")
+        return target
+
+    provider = HedgedProvider('test', ['primary', 'secondary'])
+    assert provider.call(request) == 'secondary'
+    assert provider.stats()['failovers'] == 1
+
+
+def test_the_last_error_is_raised_when_every_target_fails():
+    def request(target):
+        raise ConnectionError(f"{target} down")
+
+    provider = HedgedProvider('test', ['primary', 'secondary'])
+    with pytest.raises(ConnectionError, match="secondary down"):
+        provider.call(request)
+
+
+def test_a_slow_primary_is_hedged_to_the_next_target():
+    release = threading.Event()
+
+    def request(target):
+        if target == 'primary':
+            release.wait(5)
+        return target
+
+    provider = _fast_provider(['primary', 'secondary'], max_hedge_ratio=1.0)
+    assert provider.hedge_delay() == MIN_HEDGE_DELAY
+    try:
+        start_time = time.monotonic()
+        assert provider.call(request) == 'secondary'
+        assert time.monotonic() - start_time < 1
+    finally:
+        release.set()
+    assert provider.stats()['hedges'] == 1
+
+
+def test_hedges_are_capped_as_a_fraction_of_calls():
+    def request(target):
+        if target == 'primary':
+            time.sleep(0.2)
+        return target
+
+    provider = _fast_provider(['primary', 'secondary'], max_hedge_ratio=0.1)
+    assert provider.call(request) == 'primary'
+    assert provider.stats()['hedges'] == 0
+
+
+def test_timeout_raises():
+    release = threading.Event()
+    provider = HedgedProvider('test', ['primary'])
+    try:
+        with pytest.raises(TimeoutError):
+            provider.call(lambda target: release.wait(5), timeout=0.05)
+    finally:
+        release.set()
+
+
+def test_rate_limit_wait_is_not_counted_as_latency():
+    limiter = RateLimiter('test', rate=10.0, burst=1)
+    limiter.acquire()
+    provider = HedgedProvider('test', ['primary'], limiter=limiter)
+    for _ in range(MIN_LATENCY_SAMPLES - 3):
+        provider.latency.record(0.0)
+    for _ in range(3):
+        provider.call(lambda target: target)
+    # Each call queued about 0.1s for a token, but answered at once
+    assert provider.latency.percentile(100) < 0.05
+    assert limiter.stats()['acquired'] == 4
@@ -0,0 +1,61 @@
+import os
+from types import SimpleNamespace
+import numpy as np
+import pytest
+
+pytest.importorskip('google.cloud.bigquery')
+
+from embedding_snapshot import _claim_version, _prune, _publish, build_matrix, read_current_version  # noqa: E402
+
+
+def test_versions_are_claimed_once_and_only_newer_ones_are_published(tmp_path):
+    snapshot_dir = str(tmp_path)
+    first, second = _claim_version(snapshot_dir), _claim_version(snapshot_dir)
+    assert (first, second) == ('v000001', 'v000002')
+    _publish(snapshot_dir, second)
+    _publish(snapshot_dir, first)
+    assert read_current_version(snapshot_dir) == second
+    assert not [name for name in os.listdir(snapshot_dir) if name.startswith('.')]
+
+
+def test_prune_keeps_the_newest_versions(tmp_path):
+    snapshot_dir = str(tmp_path)
+    for _ in range(5):
+        _claim_version(snapshot_dir)
+    _prune(snapshot_dir, keep=2)
+    assert sorted(os.listdir(snapshot_dir)) == ['v000004', 'v000005']
+
+
+def _previous(tickers, matrix):
+    return SimpleNamespace(tickers=tickers, matrices={'vertex': np.asarray(matrix, dtype=np.float32)})
+
+
+def test_unchanged_rows_are_reused_from_the_previous_version():
+    previous = _previous(['A', 'B'], [[1.0, 0.0], [0.0, 1.0]])
+    fresh = {'C': {'vertex': np.array([3.0, 4.0])}}
+    matrix = build_matrix(['A', 'B', 'C'], fresh, previous, 'vertex')
+    np.testing.assert_allclose(matrix, [[1.0, 0.0], [0.0, 1.0], [0.6, 0.8]], rtol=1e-6)
+
+
+def test_width_comes_from_the_fresh_rows_when_the_model_was_empty():
+    # A model added to SNAPSHOT_MODELS was all NULL, and so 0 wide, last time
+    previous = _previous(['A', 'B'], np.zeros((2, 0)))
+    fresh = {'B': {'vertex': np.array([0.0, 2.0, 0.0])}}
+    matrix = build_matrix(['A', 'B'], fresh, previous, 'vertex')
+    assert matrix.shape == (2, 3)
+    np.testing.assert_allclose(matrix, [[0.0, 0.0, 0.0], [0.0, 1.0, 0.0]])
+
+
+def test_previous_rows_of_another_width_are_dropped():
+    previous = _previous(['A', 'B'], [[1.0, 0.0], [0.0, 1.0]])
+    fresh = {'B': {'vertex': np.array([0.0, 0.0, 1.0])}, 'C': {'vertex': np.array([1.0, 0.0])}}
+    matrix = build_matrix(['A', 'B', 'C'], fresh, previous, 'vertex')
+    # A's old row and C's mismatched vector are left as zeros
+    np.testing.assert_allclose(matrix, [[0.0, 0.0, 0.0], [0.0, 0.0, 1.0], [0.0, 0.0, 0.0]])
+
+
+def test_width_falls_back_to_the_previous_version_and_then_to_zero():
+    previous = _previous(['A'], [[0.0, 5.0]])
+    matrix = build_matrix(['A', 'B'], {'B': {'vertex': None}}, previous, 'vertex')
+    np.testing.assert_allclose(matrix, [[0.0, 1.0], [0.0, 0.0]])
+    assert build_matrix(['A'], {'A': {'vertex': None}}, None, 'vertex').shape == (1, 0)
@@ -0,0 +1,89 @@
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from embedding_storage import (EMBEDDING_COLUMNS, clear_vector_columns_cache, content_fingerprint, decode_vectors,
+                               has_vector_columns, migration_statements, vector_select, vector_values)
+
+
+def test_content_fingerprint_ignores_whitespace_and_blank_text():
+    assert content_fingerprint("Makes  phones\n") == content_fingerprint("Makes phones")
+    assert content_fingerprint("Makes phones") != content_fingerprint("Makes tablets")
+    assert content_fingerprint(None) is None
+    assert content_fingerprint("  ") is None
+
+
+def test_vector_values_flattens_every_embedding_form():
+    assert vector_values('[[1, 2.5]]') == [1.0, 2.5]
+    assert vector_values(np.array([[1.0], [2.0]])) == [1.0, 2.0]
+    assert vector_values(None) == []
+    assert vector_values(' ') == []
+
+
+def test_migration_statements_add_then_fill_every_array_column():
+    statements = migration_statements('p.d.stocks', ('embeddings', 'openai_embeddings'))
+    assert statements[:2] == [
+        "ALTER TABLE `p.d.stocks` ADD COLUMN IF NOT EXISTS embeddings_vec ARRAY<FLOAT64>",
+        "ALTER TABLE `p.d.stocks` ADD COLUMN IF NOT EXISTS openai_embeddings_vec ARRAY<FLOAT64>",
+    ]
+    update = statements[2]
+    assert len(statements) == 3
+    assert "UPDATE `p.d.stocks`" in update
+    for column in ('embeddings', 'openai_embeddings'):
+        assert f"{column}_vec = IF(" in update
+        # Already migrated rows keep their array; nested Vertex AI predictions are flattened
+        assert f"{column} IS NULL OR ARRAY_LENGTH({column}_vec) > 0" in update
+        assert f"JSON_VALUE_ARRAY({column}, '$[0]')" in update
+    assert len(migration_statements('p.d.stocks')) == len(EMBEDDING_COLUMNS) + 1
+
+
+def test_vector_select_only_returns_json_for_unmigrated_rows():
+    assert vector_select(['embeddings']) == (
+        "embeddings_vec, IF(ARRAY_LENGTH(embeddings_vec) = 0, embeddings, NULL) AS embeddings"
+    )
+
+
+def test_decode_vectors_reads_arrays_and_falls_back_to_json():
+    pa = pytest.importorskip('pyarrow')
+    table = pa.table({
+        'embeddings_vec': pa.array([[1.0, 2.0], [], None, [3.0, 4.0], [5.0]], type=pa.list_(pa.float64())),
+        'embeddings': [None, '[[6, 7]]', None, None, None],
+    })
+    matrix = decode_vectors(table, 'embeddings')
+    assert matrix.dtype == np.float32
+    # Rows with no vector, or with the wrong length, are zeros
+    np.testing.assert_array_equal(matrix, [[1, 2], [6, 7], [0, 0], [3, 4], [0, 0]])
+
+
+def test_decode_vectors_takes_the_width_from_json_when_no_row_is_migrated():
+    pa = pytest.importorskip('pyarrow')
+    table = pa.table({
+        'embeddings_vec': pa.array([[], []], type=pa.list_(pa.float64())),
+        'embeddings': ['[1, 2, 3]', None],
+    })
+    np.testing.assert_array_equal(decode_vectors(table, 'embeddings'), [[1, 2, 3], [0, 0, 0]])
+    empty = pa.table({'embeddings_vec': pa.array([[]], type=pa.list_(pa.float64()))})
+    assert decode_vectors(empty, 'embeddings').shape == (1, 0)
+
+
+class _Client:
+    def __init__(self, fields):
+        self.fields = fields
+        self.lookups = 0
+
+    def get_table(self, table_id):
+        self.lookups += 1
+        return SimpleNamespace(schema=[SimpleNamespace(name=name) for name in self.fields])
+
+
+def test_has_vector_columns_is_cached_until_the_ttl_or_a_clear():
+    clear_vector_columns_cache()
+    client = _Client(['embeddings', 'embeddings_vec', 'openai_embeddings'])
+    assert has_vector_columns(client, 'p.d.stocks', ('embeddings',))
+    assert not has_vector_columns(client, 'p.d.stocks', ('embeddings', 'openai_embeddings'))
+    client.fields.append('openai_embeddings_vec')
+    assert not has_vector_columns(client, 'p.d.stocks', ('embeddings', 'openai_embeddings'))
+    assert client.lookups == 2
+    assert has_vector_columns(client, 'p.d.stocks', ('embeddings', 'openai_embeddings'), ttl=0)
+    clear_vector_columns_cache()
+    assert has_vector_columns(client, 'p.d.stocks', ('embeddings', 'openai_embeddings'))
+    assert client.lookups == 4
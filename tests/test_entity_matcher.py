@@ -0,0 +1,45 @@
+from entity_matcher import BM25Index, EntityMatcher, fuse_rankings, normalize_company_name
+
+
+def test_normalize_company_name_drops_suffixes():
+    assert normalize_company_name('Apple Inc.') == ('apple',)
+    assert normalize_company_name('Alphabet Inc. Class A') == ('alphabet',)
+
+
+def test_matches_names_and_explicit_tickers():
+    matcher = EntityMatcher(['AAPL', 'MSFT', 'GOOG'], ['Apple Inc.', 'Microsoft Corporation', 'Alphabet Inc.'])
+    text = "Microsoft rallied. Apple and $AAPL gained; NASDAQ: GOOG was flat. Microsoft again."
+    assert matcher.match(text) == [('MSFT', 2), ('AAPL', 2), ('GOOG', 1)]
+
+
+def test_single_word_names_must_be_capitalised():
+    matcher = EntityMatcher(['AAPL'], ['Apple Inc.'])
+    assert matcher.match("an apple a day") == []
+
+
+def test_bare_tickers_are_not_matched():
+    matcher = EntityMatcher(['IT'], ['Gartner Inc.'])
+    assert matcher.match("IT spending rose") == []
+
+
+def test_bm25_ranks_the_matching_summary_first():
+    index = BM25Index(
+        ['BIO', 'CAR', 'BANK'],
+        ['Develops antibody therapies for oncology',
+         'Manufactures electric cars and batteries',
+         'Retail bank offering loans and deposits'],
+    )
+    assert [ticker for ticker, _ in index.top_k("New battery plant for electric cars", 3)] == ['CAR']
+    assert index.top_k("the and of", 3) == []
+
+
+def test_bm25_rare_terms_weigh_more():
+    index = BM25Index(['A', 'B', 'C'], ['chips chips software', 'software', 'software services'])
+    scores = index.scores("chips software")
+    assert scores[0] > scores[1] > 0
+
+
+def test_fuse_rankings_rewards_agreement():
+    dense = [('A', 0.9), ('B', 0.8), ('C', 0.7)]
+    lexical = [('B', 12.0), ('D', 9.0)]
+    assert [ticker for ticker, _ in fuse_rankings([dense, lexical], 3)] == ['B', 'A', 'D']
@@ -0,0 +1,105 @@
+import json
+import time
+import pytest
+from llm_cache import LLMCacheMiss, LLMResponseCache, load_template, replay_tag, response_key, write_replay_rows
+
+
+def _request(prompt, model='claude', max_tokens=100):
+    return {'max_tokens': max_tokens, 'messages': [{'role': 'user', 'content': prompt}], 'model': model}
+
+
+def test_response_key_covers_model_prompt_params_and_template():
+    key = response_key(_request('hi'), 'stock@1')
+    assert key == response_key(_request('hi'), 'stock@1')
+    assert key != response_key(_request('hi', model='other'), 'stock@1')
+    assert key != response_key(_request('hello'), 'stock@1')
+    assert key != response_key(_request('hi', max_tokens=200), 'stock@1')
+    assert key != response_key(_request('hi'), 'stock@2')
+
+
+def test_load_template_versions_by_content(tmp_path):
+    path = tmp_path / 'stockprice.txt'
+    path.write_text('Price of {ticker}?')
+    text, version = load_template(str(path))
+    assert text == 'Price of {ticker}?'
+    assert version.startswith('stockprice@')
+    path.write_text('Price of {ticker} today?')
+    assert load_template(str(path))[1] != version
+
+
+def test_on_mode_stores_and_answers(tmp_path):
+    cache = LLMResponseCache(str(tmp_path / 'llm.sqlite'), mode='on')
+    assert cache.lookup(_request('hi'), 'stock@1', 'article') == (None, None)
+    cache.put(_request('hi'), 'answer', 'stock@1', 'article')
+    assert cache.lookup(_request('hi'), 'stock@1', 'article') == ('answer', 'exact')
+    assert cache.get(_request('hi'), 'stock@2') is None
+    assert cache.stats()['hits'] == 1
+
+
+def test_expired_entries_are_ignored(tmp_path):
+    path = str(tmp_path / 'llm.sqlite')
+    LLMResponseCache(path, mode='on').put(_request('hi'), 'answer')
+    assert LLMResponseCache(path, ttl=-1, mode='on').get(_request('hi')) is None
+
+
+def test_off_mode_bypasses_the_cache(tmp_path):
+    cache = LLMResponseCache(str(tmp_path / 'llm.sqlite'), mode='off')
+    cache.put(_request('hi'), 'answer')
+    assert cache.lookup(_request('hi')) == (None, None)
+    assert not (tmp_path / 'llm.sqlite').exists()
+
+
+def test_unknown_mode_raises(tmp_path):
+    with pytest.raises(ValueError):
+        LLMResponseCache(str(tmp_path / 'llm.sqlite'), mode='record')
+
+
+def test_replay_fails_on_a_changed_prompt(tmp_path):
+    path = str(tmp_path / 'llm.sqlite')
+    LLMResponseCache(path, mode='on').put(_request('price is 10'), 'buy', 'stock@1', 'article')
+    replay = LLMResponseCache(path, mode='replay')
+    assert replay.lookup(_request('price is 10'), 'stock@1', 'article') == ('buy', 'exact')
+    with pytest.raises(LLMCacheMiss):
+        replay.lookup(_request('price is 12'), 'stock@1', 'article')
+    # Replays never write
+    replay.put(_request('price is 12'), 'sell', 'stock@1', 'article')
+    assert LLMResponseCache(path, mode='on').get(_request('price is 12'), 'stock@1') is None
+
+
+def test_replay_latest_falls_back_to_the_latest_answer_for_the_scope(tmp_path):
+    path = str(tmp_path / 'llm.sqlite')
+    cache = LLMResponseCache(path, mode='on')
+    cache.put(_request('price is 10'), 'buy', 'stock@1', 'article')
+    time.sleep(0.01)
+    cache.put(_request('price is 11'), 'hold', 'stock@1', 'article')
+    time.sleep(0.01)
+    cache.put(_request('other price is 11'), 'sell', 'stock@1', 'another')
+
+    replay = LLMResponseCache(path, mode='replay_latest')
+    assert replay.lookup(_request('price is 10'), 'stock@1', 'article') == ('buy', 'exact')
+    assert replay.lookup(_request('price is 12'), 'stock@1', 'article') == ('hold', 'latest')
+    assert replay.stats()['fallbacks'] == 1
+    # The fallback stays within the model, template and scope
+    for request, template, scope in [(_request('price is 12', model='other'), 'stock@1', 'article'),
+                                     (_request('price is 12'), 'stock@2', 'article'),
+                                     (_request('price is 12'), 'stock@1', 'unknown'),
+                                     (_request('price is 12'), 'stock@1', None)]:
+        with pytest.raises(LLMCacheMiss):
+            replay.lookup(request, template, scope)
+
+
+def test_replay_tag():
+    assert replay_tag(['exact', 'exact']) == 'exact'
+    assert replay_tag(['exact', 'latest']) == 'latest'
+
+
+def test_write_replay_rows_appends_jsonl(tmp_path):
+    path = str(tmp_path / 'replay' / 'rows.jsonl')
+    write_replay_rows('project.dataset.predictions', [{'ticker': 'AAPL', 'replay': 'exact'}], path)
+    write_replay_rows('project.dataset.predictions', [{'ticker': 'MSFT', 'replay': 'latest'}], path)
+    with open(path) as file:
+        lines = [json.loads(line) for line in file]
+    assert lines == [
+        {'table': 'project.dataset.predictions', 'row': {'ticker': 'AAPL', 'replay': 'exact'}},
+        {'table': 'project.dataset.predictions', 'row': {'ticker': 'MSFT', 'replay': 'latest'}},
+    ]
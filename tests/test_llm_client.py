@@ -0,0 +1,176 @@
+import asyncio
+import httpx
+import anthropic
+import pytest
+from tenacity import wait_none
+import llm_client
+from deadline import Deadline, DeadlineExceeded
+from llm_cache import LLMCacheMiss, LLMResponseCache
+from rate_limiter import RateLimiter
+
+
+def _connection_error():
+    return anthropic.APIConnectionError(request=httpx.Request('POST', 'https://example.com'))
+
+
+class _Messages:
+    # Stands in for client.messages: each create() pops the next outcome
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.timeouts = []
+        self.with_raw_response = self
+
+    async def create(self, timeout=None, **kwargs):
+        self.timeouts.append(timeout)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return _RawResponse(outcome)
+
+
+class _RawResponse:
+    headers = {}
+
+    def __init__(self, text):
+        self.text = text
+
+    def parse(self):
+        return type('Message', (), {'content': [type('Block', (), {'text': self.text})()]})()
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    # An in-memory limiter, so tests never touch the shared rate limit state
+    monkeypatch.setattr(llm_client, 'get_limiter', lambda provider: RateLimiter(provider, rate=1000.0, burst=100))
+    retry_policy = llm_client.retry_policy
+
+    def no_backoff(deadline, **options):
+        policy = retry_policy(deadline, **options)
+        policy['wait'] = wait_none()
+        return policy
+
+    monkeypatch.setattr(llm_client, 'retry_policy', no_backoff)
+    return llm_client.AsyncLLMClient('project', cache=LLMResponseCache(str(tmp_path / 'llm.sqlite'), mode='off'))
+
+
+def _request():
+    return {'model': 'claude', 'max_tokens': 10, 'messages': [{'role': 'user', 'content': 'hi'}]}
+
+
+def test_retryable_errors_are_retried(client):
+    client.client.messages = _Messages([_connection_error(), _connection_error(), 'answer'])
+    response = asyncio.run(client.create(**_request()))
+    assert response.content[0].text == 'answer'
+    assert client.stats() == {'calls': 3, 'retries': 2, 'failures': 0}
+
+
+def test_other_errors_are_not_retried(client):
+    client.client.messages = _Messages([ValueError("bad request"), 'answer'])
+    with pytest.raises(ValueError):
+        asyncio.run(client.create(**_request()))
+    assert client.stats() == {'calls': 1, 'retries': 0, 'failures': 1}
+
+
+def test_attempts_stop_at_the_limit(client):
+    client.client.messages = _Messages([_connection_error()] * llm_client.ANTHROPIC_MAX_ATTEMPTS)
+    with pytest.raises(anthropic.APIConnectionError):
+        asyncio.run(client.create(**_request()))
+    assert client.stats()['calls'] == llm_client.ANTHROPIC_MAX_ATTEMPTS
+    assert client.stats()['failures'] == 1
+
+
+def test_request_timeouts_are_capped_by_the_deadline(client):
+    client.client.messages = _Messages(['answer'])
+    asyncio.run(client.create(deadline=Deadline(5), **_request()))
+    assert 4 < client.client.messages.timeouts[0] <= 5
+
+
+def test_an_expired_deadline_sends_nothing(client):
+    client.client.messages = _Messages(['answer'])
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(client.create(deadline=Deadline(0), **_request()))
+    assert client.client.messages.timeouts == []
+
+
+
+def test_complete_answers_from_the_cache_and_records_the_source(client, tmp_path):
+    path = str(tmp_path / 'responses.sqlite')
+    client.cache = LLMResponseCache(path, mode='on')
+    client.client.messages = _Messages(['answer'])
+    sources = []
+    assert asyncio.run(client.complete('hi', 'claude', 10, template='t@1', scope='a', sources=sources)) == 'answer'
+    assert asyncio.run(client.complete('hi', 'claude', 10, template='t@1', scope='a', sources=sources)) == 'answer'
+    assert sources == ['api', 'exact']
+    assert client.stats()['calls'] == 1
+
+
+def test_replay_never_calls_the_api(client, tmp_path):
+    path = str(tmp_path / 'responses.sqlite')
+    LLMResponseCache(path, mode='on').put(
+        {'max_tokens': 10, 'messages': [{'role': 'user', 'content': 'price 10'}], 'model': 'claude'}, 'buy', 't@1', 'a')
+    client.client.messages = _Messages(['answer'])
+    client.cache = LLMResponseCache(path, mode='replay')
+    with pytest.raises(LLMCacheMiss):
+        asyncio.run(client.complete('price 11', 'claude', 10, template='t@1', scope='a'))
+    client.cache = LLMResponseCache(path, mode='replay_latest')
+    sources = []
+    assert asyncio.run(client.complete('price 11', 'claude', 10, template='t@1', scope='a', sources=sources)) == 'buy'
+    assert sources == ['latest']
+    assert client.stats()['calls'] == 0
+
+
+class _Stream:
+    # Stands in for the messages.stream() context manager
+    def __init__(self, chunks, stall=False):
+        self.chunks = chunks
+        self.stall = stall
+        self.response = type('Response', (), {'headers': {}})()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    @property
+    async def text_stream(self):
+        for chunk in self.chunks:
+            yield chunk
+        if self.stall:
+            await asyncio.sleep(3600)
+
+
+class _StreamingMessages:
+    def __init__(self, attempts):
+        self.attempts = list(attempts)
+        self.calls = 0
+
+    def stream(self, timeout=None, **kwargs):
+        self.calls += 1
+        return self.attempts.pop(0)
+
+
+def test_stream_passes_the_text_so_far(client):
+    client.client.messages = _StreamingMessages([_Stream(['Hel', 'lo'])])
+    seen = []
+    assert asyncio.run(client.stream(on_text=seen.append, **_request())) == 'Hello'
+    assert seen == ['Hel', 'Hello']
+
+
+def test_a_stalled_stream_times_out_and_is_retried_from_the_start(client):
+    client.timeout = 0.05
+    client.client.messages = _StreamingMessages([_Stream(['Par'], stall=True), _Stream(['Part', 'ial'])])
+    seen = []
+    assert asyncio.run(client.stream(on_text=seen.append, **_request())) == 'Partial'
+    # The retried attempt starts again from the beginning
+    assert seen == ['Par', 'Part', 'Partial']
+    assert client.stats() == {'calls': 2, 'retries': 1, 'failures': 0}
+
+
+def test_a_stream_that_keeps_stalling_fails_with_stream_timeout(client):
+    client.timeout = 0.05
+    client.client.messages = _StreamingMessages([_Stream([], stall=True) for _ in range(llm_client.ANTHROPIC_MAX_ATTEMPTS)])
+    with pytest.raises(llm_client.StreamTimeout):
+        asyncio.run(client.stream(**_request()))
+    assert client.stats()['retries'] == llm_client.ANTHROPIC_MAX_ATTEMPTS
+    assert client.stats()['failures'] == 1
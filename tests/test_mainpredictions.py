@@ -0,0 +1,88 @@
+import json
+import pytest
+from embedding_models import get_model
+from embedding_storage import article_key
+
+mainpredictions = pytest.importorskip('mainpredictions')
+
+
+def _generated(**vectors):
+    # One JSON string (or None) per retrieval model, as the embedding batcher returns them
+    return tuple(json.dumps(vectors[model]) if model in vectors else None for model in mainpredictions.RETRIEVAL_MODELS)
+
+
+def test_embed_article_keeps_the_models_that_answered():
+    first, *rerank = mainpredictions.RETRIEVAL_MODELS
+    embeddings = mainpredictions.embed_article('a1', _generated(**{first: [1.0, 2.0]}), required=(first,))
+    assert list(embeddings) == [first]
+    assert embeddings[first].tolist() == [1.0, 2.0]
+
+
+def test_embed_article_skips_articles_missing_a_required_model():
+    first = mainpredictions.RETRIEVAL_MODELS[0]
+    assert mainpredictions.embed_article('a1', _generated(), required=(first,)) is None
+    assert mainpredictions.embed_article('a1', _generated(), required=()) is None
+
+
+def test_local_first_stage_ranks_articles_when_every_endpoint_failed():
+    # The local vector is added after embed_article, so an empty result still goes ahead
+    assert mainpredictions.embed_article('a1', _generated(), required=(), allow_empty=True) == {}
+
+
+class _BigQueryClient:
+    inserts = []
+
+    def __init__(self, project=None):
+        pass
+
+    def insert_rows_json(self, table_id, rows, row_ids=None):
+        self.inserts.append((table_id, rows, row_ids))
+        return []
+
+
+def test_article_embeddings_are_keyed_by_content_model_and_version(monkeypatch):
+    monkeypatch.setattr(mainpredictions.bigquery, 'Client', _BigQueryClient)
+    monkeypatch.setattr(_BigQueryClient, 'inserts', [])
+    models = list(mainpredictions.RETRIEVAL_MODELS[:2])
+    embeddings = {model: [0.5, 0.25] for model in models}
+    embeddings[mainpredictions.LOCAL_MODEL] = [1.0]
+
+    mainpredictions.insert_article_embeddings("Article text", embeddings)
+    mainpredictions.insert_article_embeddings("Article text", embeddings)
+    (table_id, rows, row_ids), retried = _BigQueryClient.inserts
+    key = article_key("Article text")
+    assert table_id == mainpredictions.ARTICLE_EMBEDDINGS_TABLE_ID
+    # The local vector is not a registered model and stays out of the store
+    assert [row['model'] for row in rows] == models
+    assert row_ids == [f"{key}:{model}:{get_model(model).version}" for model in models]
+    # A resent article reuses its insert ids, so BigQuery drops the duplicates
+    assert retried[2] == row_ids
+
+
+def test_ticker_scanner_waits_for_tokens_cut_off_between_chunks():
+    scanner = mainpredictions.TickerStreamScanner()
+    text = "Picks: {{TICKER 1: AAPL}}, {{TICKER 2: MSFT}}."
+    assert scanner.scan(text[:12]) == []
+    assert scanner.scan(text[:32]) == ['AAPL']
+    assert scanner.scan(text[:42]) == []
+    assert scanner.scan(text) == ['MSFT']
+    # Text already scanned is not scanned again
+    assert scanner.scan(text + " Done.") == []
+
+
+def test_ticker_scanner_is_not_held_back_by_stray_braces():
+    scanner = mainpredictions.TickerStreamScanner()
+    text = "A {literal} brace " + "x" * mainpredictions.TICKER_TOKEN_MAX
+    assert scanner.scan(text) == []
+    assert scanner.offset == len(text)
+    assert scanner.scan(text + " {{TICKER 1: NVDA}}") == ['NVDA']
+
+
+def test_ticker_scanner_starts_over_when_a_retried_stream_restarts():
+    scanner = mainpredictions.TickerStreamScanner()
+    assert scanner.scan("First attempt: {{TICKER 1: AAPL}} and more text") == ['AAPL']
+    # A retried attempt sends its text from the beginning again: shorter ...
+    assert scanner.scan("Retry: {{TICKER 1: GOOG}}") == ['GOOG']
+    # ... or longer than the previous offset but different before it
+    retried = "Second retry with a longer preamble: {{TICKER 1: AMZN}} {{TICKER 2: META}}"
+    assert scanner.scan(retried) == ['AMZN', 'META']
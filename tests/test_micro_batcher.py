@@ -0,0 +1,65 @@
+import pytest
+from micro_batcher import MicroBatcher
+
+
+def test_results_come_back_in_order_and_batches_are_bounded():
+    sizes = []
+
+    def double(items):
+        sizes.append(len(items))
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(double, max_batch_size=4, max_wait=0.05)
+    try:
+        assert batcher.map(range(10)) == [item * 2 for item in range(10)]
+    finally:
+        batcher.close()
+    assert sum(sizes) == 10
+    assert max(sizes) <= 4
+
+
+def test_concurrent_submits_share_a_batch():
+    sizes = []
+
+    def process(items):
+        sizes.append(len(items))
+        return items
+
+    batcher = MicroBatcher(process, max_batch_size=8, max_wait=1.0)
+    try:
+        futures = [batcher.submit(i) for i in range(8)]
+        assert [future.result(timeout=5) for future in futures] == list(range(8))
+    finally:
+        batcher.close()
+    # A full batch is sent without waiting out max_wait
+    assert sizes == [8]
+
+
+def test_errors_reach_every_caller_of_the_batch():
+    def fail(items):
+        raise RuntimeError("upstream down")
+
+    batcher = MicroBatcher(fail, max_batch_size=4, max_wait=0.01)
+    try:
+        futures = [batcher.submit(i) for i in range(3)]
+        for future in futures:
+            with pytest.raises(RuntimeError):
+                future.result(timeout=5)
+    finally:
+        batcher.close()
+
+
+def test_wrong_result_count_is_an_error():
+    batcher = MicroBatcher(lambda items: items[:-1], max_batch_size=2, max_wait=0.01)
+    try:
+        with pytest.raises(ValueError):
+            batcher.map([1, 2])
+    finally:
+        batcher.close()
+
+
+def test_close_processes_pending_items():
+    batcher = MicroBatcher(lambda items: [item + 1 for item in items], max_batch_size=2, max_wait=10)
+    future = batcher.submit(1)
+    batcher.close()
+    assert future.result(timeout=0) == 2
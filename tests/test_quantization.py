@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from quantization import QuantizedIndex, load_quantized, quantize_binary, quantize_int8, save_quantized
+from similarity import SimilarityIndex, normalize_rows
+
+
+def _assert_same_results(results, expected):
+    # Batched and single-query products may differ in the last float32 bit
+    assert [[ticker for ticker, _ in top] for top in results] == [[ticker for ticker, _ in top] for top in expected]
+    for top, expected_top in zip(results, expected):
+        assert [score for _, score in top] == pytest.approx([score for _, score in expected_top], rel=1e-5)
+
+
+def _universe(n=300, dim=32, seed=0):
+    rng = np.random.default_rng(seed)
+    return [f"T{i}" for i in range(n)], normalize_rows(rng.normal(size=(n, dim))), rng
+
+
+def test_int8_codes_approximate_the_rows():
+    _, matrix, _ = _universe()
+    codes, scales = quantize_int8(matrix)
+    assert codes.dtype == np.int8
+    np.testing.assert_allclose(codes * scales[:, None], matrix, atol=scales.max())
+
+
+def test_int8_keeps_zero_rows_at_zero():
+    codes, scales = quantize_int8(np.zeros((2, 4), dtype=np.float32))
+    assert not codes.any()
+    assert (scales == 1.0).all()
+
+
+def test_binary_packs_signs():
+    bits = quantize_binary(np.array([[1.0, -1.0, 2.0, -0.5, 0.1, 0.2, -0.3, 0.4, 5.0]]))
+    assert bits.shape == (1, 2)
+    assert bits[0].tolist() == [0b10101101, 0b10000000]
+
+
+@pytest.mark.parametrize('mode', ['int8', 'binary'])
+def test_full_shortlist_matches_exact_search(mode):
+    tickers, matrix, rng = _universe()
+    # A shortlist covering the whole universe makes the rescoring exact
+    index = QuantizedIndex(tickers, matrix, mode=mode, min_shortlist=len(tickers))
+    exact = SimilarityIndex(tickers, matrix, normalized=True)
+    queries = rng.normal(size=(4, 32))
+    _assert_same_results(index.top_k_batch(queries, 5), exact.top_k_batch(queries, 5))
+
+
+def test_int8_finds_the_nearest_rows():
+    tickers, matrix, rng = _universe()
+    index = QuantizedIndex(tickers, matrix, mode='int8', min_shortlist=20)
+    exact = SimilarityIndex(tickers, matrix, normalized=True)
+    for query in rng.normal(size=(5, 32)):
+        _assert_same_results([index.top_k(query, 3)], [exact.top_k(query, 3)])
+
+
+def test_unknown_mode_raises():
+    tickers, matrix, _ = _universe(n=4)
+    with pytest.raises(ValueError):
+        QuantizedIndex(tickers, matrix, mode='int4')
+
+
+def test_saved_codes_are_loaded(tmp_path):
+    tickers, matrix, rng = _universe()
+    save_quantized(str(tmp_path), 'vertex', matrix)
+    index = load_quantized(str(tmp_path), 'vertex', tickers, matrix)
+    np.testing.assert_array_equal(index.codes, quantize_int8(matrix)[0])
+    binary = load_quantized(str(tmp_path), 'vertex', tickers, matrix, mode='binary')
+    np.testing.assert_array_equal(binary.bits, quantize_binary(matrix))
+    query = rng.normal(size=32)
+    _assert_same_results([index.top_k(query, 3)], [QuantizedIndex(tickers, matrix).top_k(query, 3)])
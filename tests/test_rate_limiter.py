@@ -0,0 +1,122 @@
+import time
+import asyncio
+import pytest
+from deadline import DeadlineExceeded
+from rate_limiter import RateLimiter, _seconds_until, is_rate_limit_error
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.headers = headers
+
+
+def test_burst_is_served_without_waiting():
+    limiter = RateLimiter('test', rate=1.0, burst=3)
+    assert [limiter.acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert limiter.stats()['acquired'] == 3
+
+
+def test_timeout_raises_and_gives_the_token_back():
+    limiter = RateLimiter('test', rate=10.0, burst=1)
+    limiter.acquire()
+    with pytest.raises(DeadlineExceeded):
+        limiter.acquire(timeout=0.01)
+    assert limiter.stats()['timeouts'] == 1
+    assert limiter.stats()['acquired'] == 1
+    # Had the timed-out caller kept its token this wait would be 0.2s
+    start_time = time.monotonic()
+    assert limiter.acquire(timeout=0.15) <= 0.1
+    assert time.monotonic() - start_time < 0.15
+
+
+def test_async_timeout_raises():
+    limiter = RateLimiter('test', rate=10.0, burst=1)
+
+    async def run():
+        await limiter.acquire_async()
+        with pytest.raises(DeadlineExceeded):
+            await limiter.acquire_async(timeout=0.01)
+        return await limiter.acquire_async(timeout=1.0)
+
+    assert 0 < asyncio.run(run()) <= 0.1
+    assert limiter.stats()['timeouts'] == 1
+
+
+def test_throttle_halves_the_rate_and_pauses():
+    limiter = RateLimiter('test', rate=10.0, burst=5, max_rate=20.0)
+    limiter.throttle(retry_after=0.5)
+    assert limiter.rate == 5.0
+    with pytest.raises(DeadlineExceeded):
+        limiter.acquire(timeout=0.3)
+    for _ in range(20):
+        limiter.throttle(retry_after=0)
+    assert limiter.rate == pytest.approx(0.5)
+
+
+def test_success_raises_the_rate_up_to_the_ceiling():
+    limiter = RateLimiter('test', rate=10.0, burst=1, max_rate=11.0)
+    limiter.success()
+    assert limiter.rate == pytest.approx(10.5)
+    for _ in range(10):
+        limiter.success()
+    assert limiter.rate == 11.0
+
+
+def test_headers_set_the_rate():
+    limiter = RateLimiter('test', rate=1.0, burst=1, max_rate=10.0)
+    limiter.update({'X-RateLimit-Remaining-Requests': '30', 'X-RateLimit-Reset-Requests': '10s'})
+    assert limiter.rate == pytest.approx(3.0)
+    limiter.update({'x-ratelimit-remaining': '0', 'x-ratelimit-reset': '1m'})
+    with pytest.raises(DeadlineExceeded):
+        limiter.acquire(timeout=30)
+
+
+def test_rate_limit_errors_are_recognised():
+    assert is_rate_limit_error(HTTPError(429))
+    assert is_rate_limit_error(RuntimeError("Too Many Requests"))
+    assert not is_rate_limit_error(HTTPError(500))
+
+
+def test_observe_error_honours_retry_after():
+    limiter = RateLimiter('test', rate=10.0, burst=5)
+    assert not limiter.observe_error(HTTPError(500))
+    assert limiter.observe_error(HTTPError(429, {'Retry-After': '2'}))
+    assert limiter.stats()['throttled'] == 1
+    with pytest.raises(DeadlineExceeded):
+        limiter.acquire(timeout=1.5)
+
+
+def test_seconds_until_parses_header_formats():
+    assert _seconds_until('2') == 2
+    assert _seconds_until('6m0s') == 360
+    assert _seconds_until('250ms') == pytest.approx(0.25)
+    assert _seconds_until(time.time() + 30) == pytest.approx(30, abs=1)
+    assert _seconds_until('soon') is None
+
+
+def test_limiters_sharing_a_state_file_share_one_bucket(tmp_path):
+    path = str(tmp_path / 'rate_limits.sqlite')
+    first = RateLimiter('vertex', rate=10.0, burst=2, state_path=path)
+    second = RateLimiter('vertex', rate=10.0, burst=2, state_path=path)
+    other = RateLimiter('openai', rate=10.0, burst=2, state_path=path)
+    first.acquire()
+    first.acquire()
+    with pytest.raises(DeadlineExceeded):
+        second.acquire(timeout=0.05)
+    assert other.acquire() == 0.0
+    # A throttle seen by one process slows the others
+    second.throttle(retry_after=0)
+    first.acquire(timeout=1)
+    assert first.rate == pytest.approx(5.0)
+
+
+def test_timed_out_shared_reservation_is_rolled_back(tmp_path):
+    path = str(tmp_path / 'rate_limits.sqlite')
+    first = RateLimiter('vertex', rate=10.0, burst=1, state_path=path)
+    second = RateLimiter('vertex', rate=10.0, burst=1, state_path=path)
+    first.acquire()
+    with pytest.raises(DeadlineExceeded):
+        second.acquire(timeout=0.01)
+    assert first.acquire(timeout=0.15) <= 0.1
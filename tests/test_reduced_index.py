@@ -0,0 +1,65 @@
+import os
+import numpy as np
+import pytest
+from reduced_index import DEFAULT_REDUCTION, REDUCED_DIMENSIONS, ReducedIndex, reduction_for
+from similarity import SimilarityIndex
+
+
+def _assert_same_results(results, expected):
+    # Batched and single-query products may differ in the last float32 bit
+    assert [[ticker for ticker, _ in top] for top in results] == [[ticker for ticker, _ in top] for top in expected]
+    for top, expected_top in zip(results, expected):
+        assert [score for _, score in top] == pytest.approx([score for _, score in expected_top], rel=1e-5)
+
+
+def _exact(n=300, dim=64, seed=0):
+    rng = np.random.default_rng(seed)
+    return SimilarityIndex([f"T{i}" for i in range(n)], rng.normal(size=(n, dim))), rng
+
+
+def test_reduction_for_unlisted_models_uses_the_default():
+    assert reduction_for('openai') == REDUCED_DIMENSIONS['openai']
+    assert reduction_for('some_new_model') == DEFAULT_REDUCTION
+
+
+@pytest.mark.parametrize('method', ['prefix', 'pca'])
+def test_full_shortlist_matches_exact_search(method):
+    exact, rng = _exact()
+    index = ReducedIndex.build(exact, method, 16)
+    index.min_shortlist = len(exact)
+    queries = rng.normal(size=(4, 64))
+    _assert_same_results(index.top_k_batch(queries, 5), exact.top_k_batch(queries, 5))
+
+
+def test_dims_are_capped_at_the_full_dimension():
+    exact, _ = _exact(dim=8)
+    assert ReducedIndex.build(exact, 'prefix', 256).dims == 8
+    assert ReducedIndex.build(exact, 'pca', 128).dims == 8
+
+
+def test_prefix_projection_keeps_the_leading_dimensions():
+    exact, _ = _exact()
+    index = ReducedIndex.build(exact, 'prefix', 4)
+    projected = index.project(np.arange(64, dtype=np.float32))
+    np.testing.assert_allclose(projected, [np.arange(4) / np.linalg.norm(np.arange(4))], rtol=1e-6)
+
+
+def test_unknown_method_raises():
+    exact, _ = _exact(n=10)
+    with pytest.raises(ValueError):
+        ReducedIndex.build(exact, 'random', 4)
+
+
+def test_save_and_load_round_trip(tmp_path):
+    exact, rng = _exact()
+    index = ReducedIndex.build(exact, 'pca', 16)
+    index.save(str(tmp_path), 'vertex')
+    # Nothing is left behind in the staging directory
+    assert sorted(os.listdir(tmp_path)) == sorted([
+        'vertex.reduced.npy', 'vertex.pca_mean.npy', 'vertex.pca_components.npy', 'vertex.reduced.json',
+    ])
+    loaded = ReducedIndex.load(str(tmp_path), 'vertex', exact)
+    assert (loaded.method, loaded.dims) == ('pca', 16)
+    query = rng.normal(size=64)
+    _assert_same_results([loaded.top_k(query, 5)], [index.top_k(query, 5)])
+    assert ReducedIndex.load(str(tmp_path), 'openai', exact) is None
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from similarity import SimilarityIndex, normalize_rows, select_top_k, two_stage_rerank
+
+
+def test_normalize_rows_keeps_zero_rows():
+    matrix = normalize_rows([[3.0, 4.0], [0.0, 0.0]])
+    assert matrix.dtype == np.float32
+    np.testing.assert_allclose(matrix, [[0.6, 0.8], [0.0, 0.0]], rtol=1e-6)
+
+
+def test_select_top_k_breaks_ties_by_position():
+    scores = np.array([0.5, 0.9, 0.5, 0.9, 0.1], dtype=np.float32)
+    assert select_top_k(scores, 3).tolist() == [1, 3, 0]
+    assert select_top_k(scores, 10).tolist() == [1, 3, 0, 2, 4]
+    assert select_top_k(scores, 0).tolist() == []
+
+
+def test_top_k_matches_cosine_ranking():
+    rng = np.random.default_rng(0)
+    matrix = rng.normal(size=(50, 8))
+    tickers = [f"T{i}" for i in range(50)]
+    index = SimilarityIndex(tickers, matrix)
+    query = rng.normal(size=8)
+
+    cosine = matrix @ query / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query))
+    expected = np.argsort(-cosine)[:5]
+    positions, scores = index.top_k_positions(query, 5)
+    assert positions.tolist() == expected.tolist()
+    np.testing.assert_allclose(scores, cosine[expected], rtol=1e-5)
+    assert [ticker for ticker, _ in index.top_k(query, 5)] == [tickers[i] for i in expected]
+
+
+def test_candidates_restrict_the_search():
+    index = SimilarityIndex(['A', 'B', 'C'], np.eye(3))
+    assert [ticker for ticker, _ in index.top_k([1.0, 0.0, 0.0], 2, candidates=[1, 2])] == ['B', 'C']
+
+
+def test_batch_matches_single_queries():
+    rng = np.random.default_rng(1)
+    index = SimilarityIndex([f"T{i}" for i in range(30)], rng.normal(size=(30, 6)))
+    queries = rng.normal(size=(4, 6))
+    assert index.top_k_batch(queries, 3) == [index.top_k(query, 3) for query in queries]
+
+
+def test_mismatched_tickers_raise():
+    with pytest.raises(ValueError):
+        SimilarityIndex(['A'], np.eye(2))
+
+
+def test_two_stage_rerank_scores_the_shortlist_with_the_second_model():
+    tickers = ['A', 'B', 'C']
+    first = SimilarityIndex(tickers, [[1.0, 0.0], [0.9, 0.1], [0.0, 1.0]])
+    second = SimilarityIndex(tickers, [[0.0, 1.0], [1.0, 0.0], [1.0, 0.0]])
+    shortlist, top_k = two_stage_rerank({'first': first, 'second': second},
+                                        {'first': [1.0, 0.0], 'second': [1.0, 0.0]}, 'first', shortlist=2, k=1)
+    assert [ticker for ticker, _ in shortlist] == ['A', 'B']
+    assert [ticker for ticker, _ in top_k['first']] == ['A']
+    # C scores highest on the second model but did not make the shortlist
+    assert [ticker for ticker, _ in top_k['second']] == ['B']
@@ -8,6 +8,7 @@ from google.api_core import exceptions as google_exceptions
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 import requests
 import time
+from rate_limiter import get_limiter
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -60,7 +61,7 @@ def fetch_hourly_stock_prices(ticker, start_date):
     stock = yf.Ticker(ticker)
     end_date = datetime.now(pytz.UTC)
     try:
-        hist = stock.history(start=start_date, end=end_date, interval="1h")
+        hist = get_limiter('yahoo_finance').call(stock.history, start=start_date, end=end_date, interval="1h")
         if hist.empty:
             logging.warning(f"No historical data available for ticker {ticker}")
             return None
@@ -74,7 +75,7 @@ def get_price_24_hours_ago(ticker):
     end_time = datetime.now(pytz.UTC)
     time_24hrs_ago = end_time - timedelta(hours=24)
     stock = yf.Ticker(ticker)
-    hist_daily = stock.history(start=time_24hrs_ago - timedelta(days=1), end=end_time, interval="1d")
+    hist_daily = get_limiter('yahoo_finance').call(stock.history, start=time_24hrs_ago - timedelta(days=1), end=end_time, interval="1d")
 
     if not hist_daily.empty:
         target_date = time_24hrs_ago.date()